@@ -3,147 +3,298 @@ import sys
 import subprocess
 import numpy as np
 import os
-import shutil
+from parmela_deck import Deck
+from parmela_cache import ResultCache, pop_no_cache_flag
+from parmela_table import final_row, read_table
+from parmela_checkpoint import CheckpointStore, pop_no_checkpoint_flag
+from parmela_runner import make_workdir, remove_workdir, write_deck, run_many, run_parmela as run_in_dir
+from parmela_trace import tags
 
 # Usage:
-#   python autocorrection.py <input_file.inp> <delta_val> <start_sect> <iterations>
+#   python autocorrection.py <input_file.inp> <delta_val> <start_sect> <iterations> [s|m] [--no-cache] [--no-checkpoint]
 #
 # Example:
 #   python3 autocorrection.py rr6_with_cors.inp 0.1 0 10
+#   python3 autocorrection.py rr6_with_cors.inp 0.1 0 5 m
 # 
 #0.1: change 10% from original value
 #0: first cor indices is 0
 # 
-# This script sequentially optimizes all steerer settings in a file to minimize beam orbit.
+# Mode s (default) sequentially optimizes all steerer settings in a file to minimize beam orbit.
+# Mode m measures the orbit response matrix at every '!cor' marker with one parallel batch of
+# +-kick runs (two per steerer, X and Y kicked together) and then corrects all steerers at once
+# with a Tikhonov-regularized SVD solve, iterating with the same matrix: 2N+1+iterations runs.
+# X and Y are treated as uncoupled planes.
+# Orbits of every evaluated deck are cached in .parmela_cache, so re-running a converged
+# correction does not repeat the PARMELA runs. --no-cache always runs parmela.
+# Each trial restarts from the last `save` checkpoint upstream of the steerer being tuned
+# (.parmela_checkpoints) instead of tracking from the cathode. --no-checkpoint disables this.
+# Every parmela run is recorded in parmela_trace.jsonl with its section and iteration
+# (python parmela_trace.py summary).
 
 # --- Configuration ---
 # Convergence tolerance: optimization stops if orbit change is less than this value. tolerance cannot be too small. If set to 1e-7, it may not converaged. suggest no more than 1e-5
 TOLERANCE = 2e-4
+# Tikhonov parameter of the response-matrix solve, relative to the largest singular value.
+# Larger values give smaller, smoother kicks at the cost of a larger residual orbit.
+TIKHONOV = 1e-2
 
 # --- Global State ---
 # These will be initialized once in the main execution block.
 steerer_indices = []
 cor_indices = []
+deck = None
+cache = None
+checkpoints = None
 
 def print_usage_and_exit():
     """Prints the script usage information and exits."""
-    print("Usage: python autocorrection.py <input_file.inp> <delta_val> <start_sect> <iterations>")
+    print("Usage: python autocorrection.py <input_file.inp> <delta_val> <start_sect> <iterations> [s|m] [--no-cache] [--no-checkpoint]")
     sys.exit(1)
 
 # --- Core Functions ---
 
-def find_indices(filename):
+def find_indices(deck):
     """
-    Finds the line numbers of all 'steerer' and '!cor' entries in a file.
+    Finds the line numbers of all 'steerer' and '!cor' entries in a deck.
     
     Args:
-        filename (str): The path to the input file.
+        deck (Deck): The parsed input deck.
         
     Returns:
         tuple: (list of steerer indices, list of !cor marker indices).
     """
-    s_indices = []
-    c_indices = []
-    try:
-        with open(filename, 'r') as f:
-            lines = f.readlines()
-        for i, line in enumerate(lines):
-            stripped_line = line.strip().lower()
-            if stripped_line.startswith("steerer"):
-                s_indices.append(i)
-            elif stripped_line.startswith("!cor"):
-                c_indices.append(i)
-    except FileNotFoundError:
-        print(f"Error: Input file {filename} not found.")
-        sys.exit(1)
-    return s_indices, c_indices
+    return deck.find("steerer"), list(deck.cor)
+
+def run_parmela(line=None, full=False):
+    """
+    Runs the Parmela simulation, unless the same deck has been run before.
+    The run restarts from the last stored checkpoint upstream of line.
+
+    Args:
+        line (int): Line index of the steerer being varied, or None.
+        full (bool): If True, always runs the whole deck and leaves its output files.
 
-def run_parmela():
-    """Runs the Parmela simulation."""
+    Returns:
+        dict: The final row of the output table by column name, or None if it was not written.
+    """
+    key = None
+    if not full and cache is not None:
+        key = cache.key(default_temp)
+        hit = cache.get(key)
+        if hit is not None:
+            return hit["final"]
+    run_file, restarted_from = default_temp, None
+    if not full and checkpoints is not None and line is not None:
+        text, restarted_from = checkpoints.prepare(deck, line)
+        if restarted_from is not None:
+            run_file = default_restart
+            with open(run_file, 'w', encoding='latin-1') as f:
+                f.write(text)
     try:
-        # Using DEVNULL to hide Parmela's stdout for a cleaner output
-        subprocess.run(["parmela", default_temp], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Parmela's stdout/stderr go to <deck>.out/.err for a cleaner output
+        run_in_dir('.', run_file)
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
         print(f"Error running Parmela: {e}")
         print("Please ensure 'parmela' is in your system's PATH.")
         sys.exit(1)
-
-def parse_orbits():
+    if checkpoints is not None:
+        checkpoints.record(deck, '.', default_tbl, restarted_from=restarted_from)
+    try:
+        row = final_row(default_tbl)
+    except (FileNotFoundError, ValueError):
+        return None
+    if key is not None:
+        cache.put(key, {"final": row})
+    return row
+
+def parse_orbits(row):
     """
-    Parses the output file to get the final X and Y orbits.
+    Gets the final X and Y orbits from the final row of the output table.
+
+    Args:
+        row (dict): The final row by column name, as returned by run_parmela().
 
     Returns:
         tuple: A tuple containing the x_orbit (float) and y_orbit (float).
                Returns (None, None) if parsing fails.
     """
     try:
-        with open(default_tbl, 'r') as f:
-            lines = f.read().splitlines()
-        # The orbit data is in the second to last line of the table
-        cols = lines[-2].split()
-        x_orbit = float(cols[13])
-        y_orbit = float(cols[15])
-        return x_orbit, y_orbit
-    except (FileNotFoundError, IndexError, ValueError) as e:
+        return row["<X>(mm)"], row["<Y>(mm)"]
+    except (TypeError, KeyError) as e:
         print(f"Error parsing orbit file {default_tbl}: {e}")
         return None, None
 
-def modify_steerer(xvalue, yvalue, sect, filename, truncate=False):
+def cor_positions(deck):
+    """
+    Finds the Z position of every '!cor' marker: the summed length of the
+    elements before it. Negative lengths do not advance Z.
+
+    Args:
+        deck (Deck): The parsed input deck.
+
+    Returns:
+        numpy.ndarray: Z (cm) of each marker, in marker order.
+    """
+    z, k = 0.0, 0
+    zc = []
+    for cor in deck.cor:
+        while k < len(deck.elements) and deck.elements[k].line < cor:
+            try:
+                length = float(deck.fields(deck.elements[k].line)[1])
+            except (IndexError, ValueError):
+                length = 0.0
+            if length > 0:
+                z += length
+            k += 1
+        zc.append(z)
+    return np.array(zc)
+
+def read_orbit(path):
     """
-    Changes a steerer's values and optionally truncates the file for simulation.
+    Reads the Z(cm), <X>(mm) and <Y>(mm) columns of every data row of the
+    output table.
+
+    Args:
+        path (str): The TIMESTEPEMITTANCE table.
+
+    Returns:
+        tuple: (z, x, y) arrays; empty if the table has no rows.
+    """
+    table = read_table(path, ['Z(cm)', '<X>(mm)', '<Y>(mm)'])
+    return table['Z(cm)'], table['<X>(mm)'], table['<Y>(mm)']
+
+def orbit_at_cors(path, zc):
+    """
+    Interpolates the X and Y orbit of the output table at the '!cor' markers.
+    Markers upstream of the first row (a run restarted from a checkpoint)
+    are NaN; markers beyond the last row get its orbit.
+
+    Returns:
+        tuple: (x, y) arrays, one value per marker.
+    """
+    z, x, y = read_orbit(path)
+    if z.size == 0:
+        return np.full(zc.size, np.nan), np.full(zc.size, np.nan)
+    order = np.argsort(z, kind='stable')
+    z, x, y = z[order], x[order], y[order]
+    outside = zc < z[0]
+    return (np.where(outside, np.nan, np.interp(zc, z, x)),
+            np.where(outside, np.nan, np.interp(zc, z, y)))
+
+def set_steerers(values):
+    """
+    Sets X and Y of several steerers.
+
+    Args:
+        values (dict): steerer line index -> (x, y).
+
+    Returns:
+        list: The replaced fields, for restore_steerers().
+    """
+    saved = []
+    for i, (x, y) in values.items():
+        saved += [(i, 4, deck.fields(i)[4]), (i, 5, deck.fields(i)[5])]
+        deck.set(i, 4, x)
+        deck.set(i, 5, y)
+    return saved
+
+def restore_steerers(saved):
+    for i, col, value in saved:
+        deck.set(i, col, value)
+
+def measure(settings, lines):
+    """
+    Runs several steerer settings at the same time, each in its own work
+    directory, and reads the orbit at every '!cor' marker. The deck itself
+    is left unchanged.
+
+    Args:
+        settings (list): One {steerer line: (x, y)} dict per run, applied on top of the deck.
+        lines (list): For each run, the steerer line it may restart upstream of, or None.
+
+    Returns:
+        list: (x, y) arrays per run, see orbit_at_cors().
+    """
+    src_dir = os.path.dirname(os.path.abspath(default_temp))
+    zc = cor_positions(deck)
+    results = [None] * len(settings)
+    pending = []
+    for k, (values, line) in enumerate(zip(settings, lines)):
+        saved = set_steerers(values)
+        text = deck.render()
+        key = cache.key_text(text, src_dir) if cache is not None else None
+        hit = cache.get(key) if key is not None else None
+        if hit is not None and "cor_x" in hit:
+            results[k] = (np.array(hit["cor_x"], dtype=float), np.array(hit["cor_y"], dtype=float))
+            restore_steerers(saved)
+            continue
+        workdir = make_workdir(src_dir)
+        name, restarted_from = default_temp, None
+        if checkpoints is not None and line is not None:
+            text, restarted_from = checkpoints.prepare(deck, line, workdir)
+            if restarted_from is not None:
+                name = default_restart
+        name = os.path.basename(name)
+        write_deck(workdir, name, text)
+        restore_steerers(saved)
+        pending.append((k, values, key, workdir, name, restarted_from))
+
+    try:
+        finals = run_many([(workdir, name) for _, _, _, workdir, name, _ in pending])
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        print(f"Error running Parmela: {e}")
+        print("Please ensure 'parmela' is in your system's PATH.")
+        sys.exit(1)
+    for (k, values, key, workdir, _, restarted_from), row in zip(pending, finals):
+        tbl = os.path.join(workdir, default_tbl)
+        if row is None:
+            print(f"Error: Parmela did not write {default_tbl} in {workdir}.")
+            sys.exit(1)
+        x, y = orbit_at_cors(tbl, zc)
+        saved = set_steerers(values)
+        if checkpoints is not None:
+            checkpoints.record(deck, workdir, tbl, restarted_from=restarted_from)
+        restore_steerers(saved)
+        if key is not None:
+            cache.put(key, {"final": row, "cor_x": x.tolist(), "cor_y": y.tolist()})
+        remove_workdir(workdir)
+        results[k] = (x, y)
+    return results
+
+def modify_steerer(xvalue, yvalue, sect, deck, truncate=False):
+    """
+    Changes a steerer's values and optionally truncates the deck for simulation.
+    The deck is flushed to its file afterwards; only changed lines are re-rendered.
+    Earlier sections are not commented out any more: run_parmela() restarts
+    from the checkpoint saved upstream of the steerer instead.
 
     Args:
         xvalue (float): The new X value for the steerer.
         yvalue (float): The new Y value for the steerer.
         sect (int): The index of the steerer to modify.
-        filename (str): The file to modify.
-        truncate (bool): If True, adds an 'end' command and comments out the previous section.
+        deck (Deck): The parsed deck to modify.
+        truncate (bool): If True, adds an 'end' command after the current section.
     """
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-
-    # If truncating, modify the file for a temporary simulation run.
-    if truncate:
-        # Remove any 'end' command from a previous run
-        lines = [line for line in lines if line.strip().lower() != 'end']
-
-        # If this is not the first section, comment out the previous section
-        # to isolate the effect of the current steerer.
-        if sect > 0:
-            start_comment_idx = cor_indices[sect - 1]
-            end_comment_idx = cor_indices[sect]
-            
-            for i in range(start_comment_idx, end_comment_idx):
-                # BUG FIX: Do not comment out the previous steerer line. Its correction must remain active.
-                if i == steerer_indices[sect - 1]:
-                    continue
-                # Only add '!' if the line is not empty and not already a comment.
-                if lines[i].strip() and not lines[i].lstrip().startswith('!'):
-                    lines[i] = '!' + lines[i]
-
     # Update the specified steerer's X and Y values
     if sect < len(steerer_indices):
         line_index = steerer_indices[sect]
-        parts = lines[line_index].split()
-        parts[4] = str(xvalue)
-        parts[5] = str(yvalue)
-        lines[line_index] = " ".join(parts) + "\n"
+        deck.set(line_index, 4, xvalue)
+        deck.set(line_index, 5, yvalue)
     else:
         print(f"Error: Steerer section {sect} is out of bounds.")
         return
 
-    # If truncating, add a new 'end' command to stop the simulation after this section
+    # If truncating, add a new 'end' command to stop the simulation after this section.
+    # This replaces any 'end' from a previous run.
     if truncate:
         if sect < len(cor_indices):
-            cor_line_index = cor_indices[sect]
-            end_pos = min(cor_line_index + 4, len(lines))
-            lines.insert(end_pos, "end\n")
+            deck.set_end(cor_indices[sect] + 4)
         else:
-            lines.append("end\n")
+            deck.set_end(len(deck.lines))
             print(f"Warning: No '!cor' marker for section {sect}. Appending 'end' to file.")
 
-    with open(filename, 'w') as f:
-        f.writelines(lines)
+    deck.flush()
 
 # --- Optimization Logic ---
 
@@ -168,11 +319,11 @@ def _fit_linear(initial_val, fixed_val, sect, its, dp, optimize_x):
     # Evaluate the initial points
     for p in pts:
         if optimize_x:
-            modify_steerer(p, fixed_val, sect, default_temp, truncate=True)
+            modify_steerer(p, fixed_val, sect, deck, truncate=True)
         else:
-            modify_steerer(fixed_val, p, sect, default_temp, truncate=True)
-        run_parmela()
-        x_orbit, y_orbit = parse_orbits()
+            modify_steerer(fixed_val, p, sect, deck, truncate=True)
+        with tags(iteration=0):
+            x_orbit, y_orbit = parse_orbits(run_parmela(steerer_indices[sect]))
         current_orbit = x_orbit if optimize_x else y_orbit
         if current_orbit is None: continue
         
@@ -204,11 +355,11 @@ def _fit_linear(initial_val, fixed_val, sect, its, dp, optimize_x):
         next_val = -c_linear / m
         
         if optimize_x:
-            modify_steerer(next_val, fixed_val, sect, default_temp, truncate=True)
+            modify_steerer(next_val, fixed_val, sect, deck, truncate=True)
         else:
-            modify_steerer(fixed_val, next_val, sect, default_temp, truncate=True)
-        run_parmela()
-        x_orbit, y_orbit = parse_orbits()
+            modify_steerer(fixed_val, next_val, sect, deck, truncate=True)
+        with tags(iteration=i):
+            x_orbit, y_orbit = parse_orbits(run_parmela(steerer_indices[sect]))
         current_orbit = x_orbit if optimize_x else y_orbit
         if current_orbit is None: continue
 
@@ -222,14 +373,10 @@ def optimize_p(dp, sect, its):
     """
     Main optimization function for a single section.
     """
-    # Get original X and Y values from the current state of the temp file
-    with open(default_temp, 'r') as f:
-        line = f.read().splitlines()[steerer_indices[sect]]
-    
+    # Get original X and Y values from the current state of the deck
     try:
-        parts = line.split()
-        orig_x = float(parts[4])
-        orig_y = float(parts[5])
+        orig_x = deck.get(steerer_indices[sect], 4)
+        orig_y = deck.get(steerer_indices[sect], 5)
     except (ValueError, IndexError):
         print("\nError: Could not read initial X and Y values for the steerer.")
         sys.exit(1)
@@ -247,16 +394,110 @@ def optimize_p(dp, sect, its):
     print(f"--> Best Y value found: {best_y:.6f} (y-orbit: {best_y_orbit:.6f})")
 
     # --- Final Check ---
-    modify_steerer(best_x, best_y, sect, default_temp, truncate=True)
-    run_parmela()
-    final_x_orbit, final_y_orbit = parse_orbits()
+    modify_steerer(best_x, best_y, sect, deck, truncate=True)
+    final_x_orbit, final_y_orbit = parse_orbits(run_parmela(steerer_indices[sect]))
     print(f"Final orbits for section {sect}: x-orbit={final_x_orbit:.6f}, y-orbit={final_y_orbit:.6f}")
 
     return best_x, best_y, final_x_orbit, final_y_orbit
 
+# --- Response-Matrix Correction ---
+
+def kick_size(value, dp):
+    """The probe kick of a steerer field: relative to its value, or dp if it is zero."""
+    return abs(value) * dp if value != 0 else dp
+
+def response_matrix(steerers, dp):
+    """
+    Measures the orbit response at every '!cor' marker to each steerer with
+    one batch of +kick/-kick runs. X and Y of a steerer are kicked together;
+    the planes are taken as uncoupled.
+
+    Args:
+        steerers (list): Steerer line indices.
+        dp (float): Relative kick, see kick_size().
+
+    Returns:
+        tuple: (Rx, Ry), each (markers x steerers), in orbit mm per steerer unit.
+    """
+    settings, lines, kicks = [], [], []
+    for i in steerers:
+        x0, y0 = deck.get(i, 4), deck.get(i, 5)
+        kx, ky = kick_size(x0, dp), kick_size(y0, dp)
+        settings += [{i: (x0 + kx, y0 + ky)}, {i: (x0 - kx, y0 - ky)}]
+        lines += [i, i]
+        kicks.append((kx, ky))
+    orbits = measure(settings, lines)
+    n = len(cor_indices)
+    Rx = np.zeros((n, len(steerers)))
+    Ry = np.zeros((n, len(steerers)))
+    for k, (kx, ky) in enumerate(kicks):
+        (xp, yp), (xm, ym) = orbits[2 * k], orbits[2 * k + 1]
+        # markers upstream of the restart point do not see the steerer
+        Rx[:, k] = np.nan_to_num((xp - xm) / (2 * kx))
+        Ry[:, k] = np.nan_to_num((yp - ym) / (2 * ky))
+    return Rx, Ry
+
+def tikhonov_solve(R, orbit, alpha=TIKHONOV):
+    """
+    Kicks that minimize |orbit + R dk|^2 + lam^2 |dk|^2, with lam = alpha
+    times the largest singular value of R.
+
+    Returns:
+        numpy.ndarray: The kick changes dk.
+    """
+    U, s, Vt = np.linalg.svd(R, full_matrices=False)
+    if s.size == 0 or s[0] == 0:
+        return np.zeros(R.shape[1])
+    lam = alpha * s[0]
+    return -Vt.T @ (s / (s**2 + lam**2) * (U.T @ orbit))
+
+def optimize_m(dp, start, its):
+    """
+    Corrects the steerers from index start on all at once with the measured
+    response matrix, iterating until the rms orbit at the markers stops
+    improving by more than TOLERANCE.
+
+    Returns:
+        tuple: (dict of steerer line -> (x, y), rms orbit of that setting).
+    """
+    steerers = steerer_indices[start:]
+    rows = slice(start, None)
+    deck.set_end(None)
+    print(f"Measuring the response matrix of {len(steerers)} steerers ({2 * len(steerers) + 1} runs)")
+    (x, y), = measure([{}], [steerers[0]])
+    Rx, Ry = response_matrix(steerers, dp)
+
+    def rms(x, y):
+        ox, oy = x[rows], y[rows]
+        return np.sqrt(np.nanmean(np.concatenate([ox, oy]) ** 2))
+
+    current = {i: (deck.get(i, 4), deck.get(i, 5)) for i in steerers}
+    best = (dict(current), rms(x, y))
+    print(f"  Initial rms orbit at the markers: {best[1]:.6f}")
+    prev = best[1]
+    for it in range(1, its + 1):
+        ox, oy = x[rows], y[rows]
+        okx, oky = ~np.isnan(ox), ~np.isnan(oy)
+        dx = tikhonov_solve(Rx[rows][okx], ox[okx])
+        dy = tikhonov_solve(Ry[rows][oky], oy[oky])
+        current = {i: (current[i][0] + dx[k], current[i][1] + dy[k]) for k, i in enumerate(steerers)}
+        with tags(iteration=it):
+            (x, y), = measure([current], [steerers[0]])
+        r = rms(x, y)
+        print(f"  Matrix it {it}: rms orbit={r:.6f}, max |dx|={np.max(np.abs(dx)):.6f}, max |dy|={np.max(np.abs(dy)):.6f}")
+        if r < best[1]:
+            best = (dict(current), r)
+        if r < TOLERANCE or abs(prev - r) < TOLERANCE:
+            print(f"  Converged: rms orbit change is less than {TOLERANCE}.")
+            break
+        prev = r
+    return best
+
 # --- Main Execution ---
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
+    no_cache = pop_no_cache_flag(sys.argv)
+    no_checkpoint = pop_no_checkpoint_flag(sys.argv)
+    if len(sys.argv) not in (5, 6):
         print_usage_and_exit()
 
     base_inp = sys.argv[1]
@@ -264,6 +505,7 @@ if __name__ == "__main__":
         delta_val = float(sys.argv[2])
         start_section = int(sys.argv[3])
         iterations = int(sys.argv[4])
+        mode = sys.argv[5].lower() if len(sys.argv) > 5 else 's'
     except ValueError:
         print("Error: <delta_val>, <start_sect>, and <iterations> must be numbers.")
         print_usage_and_exit()
@@ -274,17 +516,21 @@ if __name__ == "__main__":
         sys.exit(1)
         
     default_temp = f"{root}_temp{ext}"
+    default_restart = f"{root}_restart{ext}"
     default_tbl = "TIMESTEPEMITTANCE.TBL"
+    cache = None if no_cache else ResultCache()
+    checkpoints = None if no_checkpoint else CheckpointStore()
 
-    # Create a fresh temporary copy of the input file to work with.
+    # Parse the input file once and write a fresh temporary copy to work with.
     try:
-        shutil.copy(base_inp, default_temp)
+        deck = Deck(base_inp)
+        deck.flush(default_temp)
     except (FileNotFoundError, IOError) as e:
         print(f"Error: Could not copy '{base_inp}' to '{default_temp}': {e}")
         sys.exit(1)
 
-    # Find all steerers and markers once from the clean file.
-    steerer_indices, cor_indices = find_indices(default_temp)
+    # Find all steerers and markers once from the clean deck.
+    steerer_indices, cor_indices = find_indices(deck)
     #print(f"steerer num='{steerer_indices}'; cor num='{cor_indices}'")
     if not steerer_indices:
         print("Error: No 'steerer' elements found in the input file.")
@@ -296,6 +542,21 @@ if __name__ == "__main__":
         sys.exit(1)
 
     num_sections = len(cor_indices)
+    if mode not in ('s', 'm'):
+        print_usage_and_exit()
+
+    # --- Response-matrix correction of all steerers at once ---
+    if mode == 'm':
+        if start_section >= len(steerer_indices):
+            print(f"Error: Steerer section {start_section} is out of bounds.")
+            sys.exit(1)
+        best, best_rms = optimize_m(delta_val, start_section, iterations)
+        set_steerers(best)
+        deck.flush()
+        for k, i in enumerate(steerer_indices[start_section:], start_section):
+            print(f"Applied correction for section {k}: X={best[i][0]:.6f}, Y={best[i][1]:.6f}")
+        print(f"rms orbit at the markers: {best_rms:.6f}")
+        num_sections = start_section  # skip the sequential loop
 
     # --- Main Automation Loop ---
     for sect in range(start_section, num_sections):
@@ -304,32 +565,25 @@ if __name__ == "__main__":
         print("="*50)
 
         # Run optimization for the current section. This will leave default_temp
-        # in a temporary state (with comments and an 'end' command).
-        bestx, besty, _, _ = optimize_p(delta_val, sect, iterations)
+        # in a temporary state (with an 'end' command).
+        with tags(section=sect):
+            bestx, besty, _, _ = optimize_p(delta_val, sect, iterations)
         
         if bestx is None:
             print(f"Optimization failed for section {sect}. Stopping.")
             break
         
         # Finalize the state of default_temp for this section.
-        # 1. Read the current temporary file state.
-        with open(default_temp, 'r') as f:
-            lines = f.readlines()
-            
-        # 2. Remove the temporary 'end' command added by the optimizer.
-        lines = [line for line in lines if line.strip().lower() != 'end']
+        # 1. Remove the temporary 'end' command added by the optimizer.
+        deck.set_end(None)
 
-        # 3. Permanently set the new best steerer values in the lines.
-        #    The comments added by modify_steerer() will remain.
+        # 2. Permanently set the new best steerer values in the deck.
         line_index = steerer_indices[sect]
-        parts = lines[line_index].split()
-        parts[4] = str(bestx)
-        parts[5] = str(besty)
-        lines[line_index] = " ".join(parts) + "\n"
+        deck.set(line_index, 4, bestx)
+        deck.set(line_index, 5, besty)
         
-        # 4. Write the finalized, corrected lines back to the temp file.
-        with open(default_temp, 'w') as f:
-            f.writelines(lines)
+        # 3. Write the finalized, corrected deck back to the temp file.
+        deck.flush()
 
         print(f"\nApplied final correction for section {sect}: X={bestx:.6f}, Y={besty:.6f}")
 
@@ -337,32 +591,9 @@ if __name__ == "__main__":
     print("      ALL SECTIONS OPTIMIZED")
     print("="*50)
     
-    # For the final run, re-enable all simulation sections by removing the '!'
-    # comments that were added during the optimization steps.
-    print("Re-enabling all sections for final simulation...")
-    with open(default_temp, 'r') as f:
-        lines = f.readlines()
-
-    uncommented_lines = []
-    # These are the keywords for lines that get commented out by the optimizer.
-    keywords_to_uncomment = ('!scheff', '!restart', '!save','!start')
-    for line in lines:
-        stripped_line = line.lstrip()
-        # Check if the line is one of the commented-out types.
-        if stripped_line.lower().startswith(keywords_to_uncomment):
-            # Find the position of the '!' and remove it, preserving original indentation.
-            first_char_index = len(line) - len(stripped_line)
-            uncommented_lines.append(line[:first_char_index] + line[first_char_index+1:])
-        else:
-            uncommented_lines.append(line)
-            
-    with open(default_temp, 'w') as f:
-        f.writelines(uncommented_lines)
-
     # Run a final simulation with all corrections applied to get the final orbit.
     print("Running final simulation with all corrections...")
-    run_parmela()
-    final_x_orbit, final_y_orbit = parse_orbits()
+    final_x_orbit, final_y_orbit = parse_orbits(run_parmela(full=True))
 
     print("\n--- FINAL RESULTS ---")
     print(f"  Final X orbit:   {final_x_orbit:.6f}")
@@ -1,17 +1,39 @@
 #!/usr/bin/env python3
 import sys
-import subprocess
 import numpy as np
 import os
+import contextvars
+from parmela_deck import Deck
+from parmela_cache import ResultCache, pop_no_cache_flag
+from parmela_table import final_row
+from parmela_checkpoint import CheckpointStore, pop_no_checkpoint_flag
+from parmela_runner import make_workdir, remove_workdir, write_deck, run_deck, run_parmela as run_in_dir, WORKERS
+from parmela_trace import tags
+from concurrent.futures import ThreadPoolExecutor
 
 # Usage:
-#   python optimize_parmela.py <input_file.inp> <mode> [params...]
+#   python optimize_parmela.py <input_file.inp> <mode> [params...] [--no-cache] [--no-checkpoint]
 # Modes:
 #   g: gradient descent with adaptive step size
 #     params: <init_step> [sect] [max_iters] [lr]
 #   p: parabola fitting
 #     params: <delphase> [sect] [iterations]
+#   b: batched quadratic fitting, k phases per iteration
+#     params: <delphase> [sect] [iterations] [points]
+#   all: parabola fitting of every cell/trwave section in beam order
+#     params: <delphase> [iterations] [first_sect]
 # e.g.:python3 autophase.py rr6.inp p 10 13 10 ; inital delta phase is 10 degree, section is 14 (start from 0), maximum iterations is 10
+# e.g.:python3 autophase.py rr6.inp b 10 13 10 5 ; as p, but 5 phases are run at once per iteration
+# e.g.:python3 autophase.py rr6.inp all 10 10 ; phases all sections one after the other, writes rr6_phases.txt
+#   with phase, ΔE and parmela run count per section. While a section converges, the first
+#   points of the next one are already run speculatively.
+# Probes that do not depend on each other run at the same time in isolated work directories
+# (.parmela_work); set PARMELA_WORKERS to limit how many.
+# Results of every evaluated deck are cached in .parmela_cache; --no-cache always runs parmela.
+# Trials restart from the last `save` upstream of the cavity (.parmela_checkpoints); --no-checkpoint
+# always tracks from the cathode.
+# Every parmela run is recorded in parmela_trace.jsonl with its section and iteration
+# (python parmela_trace.py summary).
 # Convergence and optimization settings
 tol = 2e-7  # dE convergence tolerance
 momentum = 0.9  # momentum for gradient descent
@@ -19,10 +41,12 @@ step_up = 1.2   # factor to increase step when improving
 step_down = 0.5 # factor to decrease step when not improving
 
 def print_usage_and_exit():
-    print("Usage: python optimize_parmela.py <input_file.inp> <g|p> [...]")
+    print("Usage: python optimize_parmela.py <input_file.inp> <g|p|b|all> [...]")
     sys.exit(1)
 
 # Validate args
+no_cache = pop_no_cache_flag(sys.argv)
+no_checkpoint = pop_no_checkpoint_flag(sys.argv)
 if len(sys.argv) < 3:
     print_usage_and_exit()
 
@@ -33,63 +57,210 @@ root, ext = os.path.splitext(base_inp)
 if ext.lower() != ".inp":
     print_usage_and_exit()
 default_temp = f"{root}_temp{ext}"
+default_restart = f"{root}_restart{ext}"
 default_tbl = "TIMESTEPEMITTANCE.TBL"
+default_report = f"{root}_phases.txt"
+cache = None if no_cache else ResultCache()
+checkpoints = None if no_checkpoint else CheckpointStore()
+varied_line = None  # cell line of the section being phased
+pool = ThreadPoolExecutor(max_workers=WORKERS)  # parmela runs of the parallel probes
+inflight = {}  # cache key -> speculative run not asked for yet
+stats = {}  # sect -> {'evals': ΔE evaluations, 'runs': parmela runs made for it}
 
-# Prepare temp file (fresh copy)
-if os.path.exists(default_temp):
-    os.remove(default_temp)
-subprocess.run(["cp", base_inp, default_temp], check=True)
+# Prepare temp file (fresh copy), parsed once and kept in memory
+deck = Deck(base_inp)
+deck.flush(default_temp)
 
 # Helpers
 def find_indices():
-    idxs, counts = [], []
-    lines = open(default_temp).readlines()
-    for i, L in enumerate(lines):
-        if L.lower().startswith("cell") and i+1 < len(lines) and lines[i+1].lower().startswith("trwave"):
-            c = 0
-            for j in range(i+1, len(lines)):
-                if lines[j].lower().startswith("trwave"): c += 1
-                else: break
-            idxs.append(i)
-            counts.append(c)
-    return idxs, counts
-
-
-def cngele(newphase, sect=0):
+    return deck.rf_sections()
+
+
+def cngele(newphase, sect=0, flush=True):
+    global varied_line
     idxs, counts = find_indices()
     i, n = idxs[sect], counts[sect]
-    lines = open(default_temp).read().splitlines()
-    parts = lines[i].split(); parts[4] = str(newphase + 90); lines[i] = " ".join(parts)
+    varied_line = i
+    deck.set(i, 4, newphase + 90)
     for k in range(n):
-        parts = lines[i+1+k].split(); parts[4] = str(newphase); lines[i+1+k] = " ".join(parts)
-    open(default_temp, 'w').write("\n".join(lines) + "\n")
+        deck.set(i+1+k, 4, newphase)
+    if flush:
+        deck.flush()
+
+
+def parse_delE(row):
+    return row["Del-Erms"]  # energy spread of the final row
+
+
+def run_parmela(full=False):
+    # returns the final row of the TBL, from the cache if this deck ran before.
+    # Otherwise the run restarts from the last checkpoint upstream of the varied cavity;
+    # full=True always tracks the whole deck so every output file is complete.
+    key = None
+    if not full and cache is not None:
+        key = cache.key(default_temp)
+        hit = cache.get(key)
+        if hit is not None:
+            return hit["final"]
+    run_file, restarted_from = default_temp, None
+    if not full and checkpoints is not None and varied_line is not None:
+        text, restarted_from = checkpoints.prepare(deck, varied_line)
+        if restarted_from is not None:
+            run_file = default_restart
+            with open(run_file, 'w', encoding='latin-1') as f:
+                f.write(text)
+    run_in_dir('.', run_file)
+    row = final_row(default_tbl)
+    if checkpoints is not None:
+        checkpoints.record(deck, '.', default_tbl, restarted_from=restarted_from)
+    if key is not None:
+        cache.put(key, {"final": row})
+    return row
+
+def section_lines(sect):
+    idxs, counts = find_indices()
+    return list(range(idxs[sect], idxs[sect] + counts[sect] + 1))
+
+
+def apply(config):
+    # sets the (sect, phase) pairs of config; returns the replaced phase fields
+    saved = [(i, deck.fields(i)[4]) for sect, _ in config for i in section_lines(sect)]
+    for sect, p in config:
+        cngele(p, sect, flush=False)
+    return saved
+
+
+def restore(saved):
+    for i, value in saved:
+        deck.set(i, 4, value)
+
+
+def launch(config, key, owner):
+    # stages config in its own work directory and starts parmela on it
+    src_dir = os.path.dirname(os.path.abspath(default_temp))
+    saved = apply(config)
+    workdir = make_workdir(src_dir)
+    name, text, restarted_from = default_temp, None, None
+    if checkpoints is not None:
+        first = min(sect for sect, _ in config)
+        text, restarted_from = checkpoints.prepare(deck, find_indices()[0][first], workdir)
+        if restarted_from is not None:
+            name = default_restart
+    name = os.path.basename(name)
+    write_deck(workdir, name, text if text is not None else deck.render())
+    restore(saved)
+    stats.setdefault(owner, {"evals": 0, "runs": 0})["runs"] += 1
+    with tags(section=owner):
+        future = pool.submit(contextvars.copy_context().run, run_deck, workdir, name)
+    return future, config, key, workdir, restarted_from, owner
+
+
+def finish(job):
+    # ΔE of a launched run; a run that fails or writes no table raises and is not cached.
+    # The work directory is removed either way.
+    future, config, key, workdir, restarted_from, _ = job
+    try:
+        r = future.result()
+        if r is None:
+            raise RuntimeError(f"Parmela wrote no {default_tbl} in {workdir}")
+        if checkpoints is not None:
+            saved = apply(config)
+            checkpoints.record(deck, workdir, os.path.join(workdir, default_tbl), restarted_from=restarted_from)
+            restore(saved)
+        if key is not None:
+            cache.put(key, {"final": r})
+        return parse_delE(r)
+    finally:
+        remove_workdir(workdir)
+
+
+def deck_key(config):
+    src_dir = os.path.dirname(os.path.abspath(default_temp))
+    saved = apply(config)
+    text = deck.render()
+    restore(saved)
+    return cache.key_text(text, src_dir) if cache is not None else None
+
+
+def evaluate_configs(configs, owner):
+    # ΔE for each config, a list of (sect, phase) pairs set on top of the current deck.
+    # Cached decks are reused and speculative runs already in flight are waited for;
+    # the others run at the same time, each in its own work directory, restarting from
+    # a checkpoint where possible. The deck is left as it was.
+    results = [None] * len(configs)
+    jobs = []
+    for k, config in enumerate(configs):
+        stats.setdefault(owner, {"evals": 0, "runs": 0})["evals"] += 1
+        key = deck_key(config)
+        hit = cache.get(key) if key is not None else None
+        if hit is not None and hit.get("final") is not None:
+            results[k] = parse_delE(hit["final"])
+        elif key in inflight:
+            jobs.append((k, inflight.pop(key)))
+        else:
+            jobs.append((k, launch(config, key, owner)))
+    # every job is finished (and its work directory removed) before a failure is raised
+    error = None
+    for k, job in jobs:
+        try:
+            results[k] = finish(job)
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+    return results
+
+
+def evaluate(phases, sect):
+    # ΔE for each phase of one section, see evaluate_configs
+    return evaluate_configs([[(sect, p)] for p in phases], sect)
 
 
-def parse_delE():
-    lines = open(default_tbl).read().splitlines()
-    cols = lines[-3].split()
-    return float(cols[12])  # 13th column (0-based)
+def speculate(configs, owner):
+    # starts runs whose results may be asked for later; they are not waited for
+    if cache is None:
+        return
+    for config in configs:
+        key = deck_key(config)
+        if key not in inflight and not cache.contains(key):
+            inflight[key] = launch(config, key, owner)
 
 
-def run_parmela():
-    subprocess.run(["parmela", default_temp], check=True)
+def drop_speculation():
+    # cancels speculative runs that have not started; the running ones are finished
+    for key, job in list(inflight.items()):
+        if job[0].cancel():
+            remove_workdir(job[3])
+            stats[job[5]]["runs"] -= 1
+            del inflight[key]
+
+
+def drain_speculation():
+    error = None
+    for key in list(inflight):
+        try:
+            finish(inflight.pop(key))
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
 
 # Gradient Descent Optimizer w/ adaptive step
 def optimize_g(init_step, sect, max_it, lr):
     diff_step = init_step
     idxs, _ = find_indices()
-    phase = float(open(default_temp).read().splitlines()[idxs[sect]].split()[4]) - 90.0
+    phase = deck.get(idxs[sect], 4) - 90.0
     vel = 0.0
     prevE = None
 
     for it in range(1, max_it + 1):
-        # finite-difference gradient
-        cngele(phase + diff_step, sect); run_parmela(); Ep = parse_delE()
-        cngele(phase - diff_step, sect); run_parmela(); Em = parse_delE()
-        grad = (Ep - Em) / (2 * diff_step)
-        vel = momentum * vel - lr * grad
-        phase += vel
-        cngele(phase, sect); run_parmela(); E = parse_delE()
+        with tags(section=sect, iteration=it):
+            # finite-difference gradient, both probes at once
+            Ep, Em = evaluate([phase + diff_step, phase - diff_step], sect)
+            grad = (Ep - Em) / (2 * diff_step)
+            vel = momentum * vel - lr * grad
+            phase += vel
+            cngele(phase, sect); E = parse_delE(run_parmela())
         print(f"Gradient it {it}: phase={phase}, ΔE={E}, grad={grad}, vel={vel}, step={diff_step}")
         # adjust step size
         if prevE is not None:
@@ -103,13 +274,12 @@ def optimize_g(init_step, sect, max_it, lr):
 # Parabola Fitting Optimizer w/ convergence check
 def optimize_p(dp, sect, its):
     idxs, _ = find_indices()
-    orig = float(open(default_temp).read().splitlines()[idxs[sect]].split()[4]) - 90.0
-    # initial points
+    orig = deck.get(idxs[sect], 4) - 90.0
+    # initial points, all three at once
     pts = [orig, orig + dp, orig - dp]
     res = []
     prevEv = None
-    for p in pts:
-        cngele(p, sect); run_parmela(); Ev = parse_delE()
+    for p, Ev in zip(pts, evaluate(pts, sect)):
         res.append((p, Ev))
         print(f"Initial point: phase={p}, ΔE={Ev}")
         if prevEv is not None and abs(prevEv - Ev) < tol:
@@ -121,7 +291,8 @@ def optimize_p(dp, sect, its):
         xs = np.array([x for x, _ in res]); ys = np.array([y for _, y in res])
         a, b, _ = np.polyfit(xs, ys, 2)
         vert = -b / (2 * a)
-        cngele(vert, sect); run_parmela(); Ev = parse_delE()
+        with tags(section=sect, iteration=i):
+            cngele(vert, sect); Ev = parse_delE(run_parmela())
         res.append((vert, Ev))
         print(f"Parabola it {i}: phase={vert}, ΔE={Ev}")
         if abs(prevEv - Ev) < tol:
@@ -131,6 +302,89 @@ def optimize_p(dp, sect, its):
         res = sorted(res, key=lambda t: t[1])[:3]
     return min(res, key=lambda t: t[1])
 
+# Batched Quadratic Fitting: k phases per iteration, run at once
+def optimize_b(dp, sect, its, k):
+    if k < 3:
+        print("Batched fitting needs at least 3 points per iteration")
+        sys.exit(1)
+    idxs, _ = find_indices()
+    center = deck.get(idxs[sect], 4) - 90.0
+    spread = dp
+    res = []
+    best = None
+    for i in range(0, its + 1):
+        pts = list(center + spread * np.linspace(-1, 1, k))
+        with tags(iteration=i):
+            res += list(zip(pts, evaluate(pts, sect)))
+        cur = min(res, key=lambda t: t[1])
+        print(f"Batch it {i}: {k} phases around {center}, best phase={cur[0]}, ΔE={cur[1]}")
+        if best is not None and abs(best[1] - cur[1]) < tol:
+            print(f"Converged at batch it {i}, ΔE change < {tol}")
+            return cur
+        best = cur
+        # quadratic fit through the k best points so far; shrink the window around the vertex
+        near = sorted(res, key=lambda t: t[1])[:k]
+        xs = np.array([x for x, _ in near]); ys = np.array([y for _, y in near])
+        a, b, _ = np.polyfit(xs, ys, 2)
+        center = -b / (2 * a) if a > 0 else cur[0]
+        spread *= 0.5
+    return min(res, key=lambda t: t[1])
+
+# Whole linac: every section in beam order, speculating on the next one
+def phase_section(dp, sect, its, nxt):
+    # parabola fit of one section. While each vertex runs, the other initial points of
+    # section nxt are started too, with this section at that vertex: if the vertex converges they
+    # are already running (or done) when section nxt begins.
+    orig = deck.get(find_indices()[0][sect], 4) - 90.0
+    pts = [orig, orig + dp, orig - dp]
+    res = list(zip(pts, evaluate(pts, sect)))
+    prevEv = res[0][1]
+    best = min(res, key=lambda t: t[1])
+    for i in range(1, its + 1):
+        xs = np.array([x for x, _ in res]); ys = np.array([y for _, y in res])
+        a, b, _ = np.polyfit(xs, ys, 2)
+        vert = -b / (2 * a) if a > 0 else best[0]
+        if nxt is not None:
+            # the first of them, section nxt at its nominal phase, is the vertex run itself
+            q = deck.get(find_indices()[0][nxt], 4) - 90.0
+            speculate([[(sect, vert), (nxt, p)] for p in (q + dp, q - dp)], nxt)
+        with tags(iteration=i):
+            Ev = evaluate([vert], sect)[0]
+        res.append((vert, Ev))
+        print(f"Section {sect} it {i}: phase={vert}, ΔE={Ev}")
+        if abs(prevEv - Ev) < tol:
+            best = (vert, Ev)
+            break
+        drop_speculation()
+        prevEv = Ev
+        res = sorted(res, key=lambda t: t[1])[:3]
+        best = res[0]
+    return best
+
+
+def optimize_all(dp, its, first=0):
+    idxs, _ = find_indices()
+    report = []
+    for sect in range(first, len(idxs)):
+        nominal = deck.get(idxs[sect], 4) - 90.0
+        nxt = sect + 1 if sect + 1 < len(idxs) else None
+        phase, E = phase_section(dp, sect, its, nxt)
+        cngele(phase, sect, flush=False)
+        s = stats.get(sect, {"evals": 0, "runs": 0})
+        report.append((sect, idxs[sect] + 1, nominal, phase, E, s["evals"], s["runs"]))
+        print(f"Section {sect} done: phase={phase}, ΔE={E}, runs={s['runs']}")
+    drop_speculation()
+    drain_speculation()
+    return report
+
+
+def write_report(report, path):
+    with open(path, 'w') as f:
+        f.write("# sect  line  nominal(deg)  phase(deg)  dE  evaluations  runs\n")
+        for sect, line, nominal, phase, E, evals, runs in report:
+            f.write(f"{sect:4d} {line:6d} {nominal:12.4f} {phase:12.4f} {E:14.6e} {evals:6d} {runs:6d}\n")
+        f.write(f"# total runs: {sum(r[6] for r in report)}\n")
+
 # Dispatch and final run
 if mode == 'g':
     init_step = float(sys.argv[3]); sect = int(sys.argv[4]); mit = int(sys.argv[5]); lr = float(sys.argv[6])
@@ -138,12 +392,26 @@ if mode == 'g':
 elif mode == 'p':
     dp = float(sys.argv[3]); sect = int(sys.argv[4]); its = int(sys.argv[5])
     best_phase, best_de = optimize_p(dp, sect, its)
+elif mode == 'b':
+    dp = float(sys.argv[3]); sect = int(sys.argv[4]); its = int(sys.argv[5])
+    k = int(sys.argv[6]) if len(sys.argv) > 6 else 5
+    best_phase, best_de = optimize_b(dp, sect, its, k)
+elif mode == 'all':
+    dp = float(sys.argv[3])
+    its = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+    first = int(sys.argv[5]) if len(sys.argv) > 5 else 0
+    report = optimize_all(dp, its, first)
+    deck.flush()
+    run_parmela(full=True)
+    write_report(report, default_report)
+    print(f"Phased {len(report)} sections, report in {default_report}")
+    sys.exit(0)
 else:
     print_usage_and_exit()
 
-# Apply optimal phase one more time and run
+# Apply optimal phase one more time and run (always for real, to leave the output files)
 cngele(best_phase, sect)
-run_parmela()
+run_parmela(full=True)
 
 print(f"Optimal result: phase={best_phase}, ΔE={best_de}")
 sys.exit(0)
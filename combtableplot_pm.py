@@ -8,6 +8,7 @@ combine multiple colume into sigle TIMESTEP file. choose the coleum and phase st
 import numpy as np
 from numpy import genfromtxt, dtype, loadtxt
 import string
+from parmela_table import read_schema, read_table
 
 
 
@@ -22,22 +23,12 @@ def linepick(pick):
     sumdata=[]
     datanum=[]
     for intr in listrange[1:]:
-        with open("../" + fold + "/" + term + str(intr) + suf) as f:
-            l = [line.split() for line in f]
-        f.close()
-        usefuldata = l[dataline:]
-
-        # content=genfromtxt("../"+fold+"/"+term+"90"+suf,delimiter='/t',names=True,dtype=None)
-        headname = [elem for elem in usefuldata[0]][1:]
-        usefuldata[0]=headname
-        col_usefuldata={usefuldata[0][i]:[line[i] for line in usefuldata] for i in range(len(usefuldata[0]))}
-        for i in range(len(headname)):
-            col_usefuldata[headname[i]][0]=headname[i]+str(intr)
-            
+        path = "../" + fold + "/" + term + str(intr) + suf
+        headname = read_schema(path).names
+        table = read_table(path, [headname[elem] for elem in pick])
         for elem in pick:
-            sumdata.append(col_usefuldata[headname[elem]])
-        #print(col_usefuldata[headname[0]])
-        datanum.append(len(usefuldata))
+            sumdata.append([headname[elem] + str(intr)] + ["%.6E" % v for v in table[headname[elem]]])
+        datanum.append(len(sumdata[-1]))
     minnum=min(datanum)
     with open("../" + fold + "/" + term + str(listrange[0]) + suf) as f0:
         l0=f0.readlines()
@@ -10,7 +10,8 @@ import shutil
 import yaml
 import glob
 import uuid
-import subprocess
+from parmela_stage import stage_inputs
+from parmela_runner import run_parmela
 from concurrent.futures import ProcessPoolExecutor
 
 # 1. Find element indices and main frequency
@@ -139,21 +140,14 @@ def apply_perturbations(input_path, params, folder):
 # 5. Run a single case
 def run_case(args):
     folder, pert_file = args
-    cwd = os.getcwd()
-    os.chdir(folder)
-    try:
-        subprocess.run(["parmela", os.path.basename(pert_file)], check=True)
-        # Find all files ending with .T2 or .T3
-        files_to_delete = glob.glob('*.T2') + glob.glob('*.T3')
-        # Loop through the list and delete each file
-        for f in files_to_delete:
+    result = run_parmela(folder, os.path.basename(pert_file))
+    # delete the particle dumps (*.T2, *.T3) the run wrote
+    for f in result.outputs:
+        if f.endswith(('.T2', '.T3')):
             try:
                 os.remove(f)
             except OSError as e:
                 print(f"Error deleting file {f}: {e}")
-        # -------------------------------------------
-    finally:
-        os.chdir(cwd)
     # return path to output TBL
     return os.path.join(folder, "TIMESTEPEMITTANCE.TBL")
 
@@ -205,9 +199,8 @@ if __name__ == "__main__":
     for i in range(1, runs+1):
         folder = f"{base}_{i}"
         os.makedirs(folder, exist_ok=True)
-        # copy all .inp and .T7 files
-        for ext in ['*.inp','*.T7']:
-            for f in glob.glob(ext): shutil.copy(f, folder)
+        # link the field maps from the shared pool; the deck is written below
+        stage_inputs(folder, copy=())
         # apply perturbation
         pert = apply_perturbations(input_filename, params, folder)
         args.append((folder, pert))
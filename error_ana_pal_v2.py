@@ -8,12 +8,22 @@ import os
 import sys
 import shutil
 import yaml
-import glob
 import uuid
-import subprocess
-from concurrent.futures import ProcessPoolExecutor
+import warnings
+from parmela_stage import stage_inputs
+from parmela_deck import Deck
+import numpy as np
 import pandas as pd
+from scipy.stats import truncnorm
+import matplotlib
+matplotlib.use('Agg')  # a batch study: figures are only saved
 import matplotlib.pyplot as plt
+from parmela_table import final_row
+from parmela_store import ResultStore, OrbitEnvelope, read_orbit, thin_orbit, ORBIT_POINTS
+from parmela_queue import WorkQueue, Ledger, WORKERS
+from parmela_async import AsyncQueue
+from parmela_runner import run_parmela
+from orbitplot import plot_orbits
 
 
 # 1. Find element indices and main frequency
@@ -41,94 +51,161 @@ def find_ele_ind(lines):
                 elements["cell"].append(i)
     return elements, mainfreq
 
-# 2. Truncated normal helper
-def truncated_normal(mean, sigma, bound, size):
-    from scipy.stats import truncnorm
-    import numpy as np
-    if sigma == 0:
-        return np.full(size, mean)
-    a, b = (-bound - mean) / sigma, (bound - mean) / sigma
-    return truncnorm.rvs(a, b, loc=mean, scale=sigma, size=size)
+# 2. Error columns: one per perturbed quantity, with the yaml prefix of its distribution
+def error_columns(elements):
+    columns = []
+    for kind in ("trwave", "cell"):
+        for n in range(len(elements[kind])):
+            columns += [(f"{kind}{n}_phase", f"{kind}_rf_phase"), (f"{kind}{n}_amp", f"{kind}_rf_amp")]
+    # quadrupole, solenoid and steerer use power supply amp
+    for kind in ("solenoid", "quad", "steerer"):
+        columns += [(f"{kind}{n}_amp", "ps_amp") for n in range(len(elements[kind]))]
+    columns += [(f"bend{n}_amp", "bend_amp") for n in range(len(elements["bend"]))]
+    return columns
 
 # 3. Generate distributions
-def randseed(elements, params):
-    dist = {}
-    # quadrupole ,solenoid and steerer use power supply amp
-    dist["quad"] = truncated_normal(params["ps_amp_mean"], params["ps_amp_sig"], params["ps_amp_bound"], len(elements["quad"]))
-    dist["solenoid"] = truncated_normal(params["ps_amp_mean"], params["ps_amp_sig"], params["ps_amp_bound"], len(elements["solenoid"]))
-    dist["steerer"] = truncated_normal(params["ps_amp_mean"], params["ps_amp_sig"], params["ps_amp_bound"], len(elements["solenoid"]))
-
-    # cell
-    phase_cell = truncated_normal(params["cell_rf_phase_mean"], params["cell_rf_phase_sig"], params["cell_rf_phase_bound"], len(elements["cell"]))
-    amp_cell = truncated_normal(params["cell_rf_amp_mean"], params["cell_rf_amp_sig"], params["cell_rf_amp_bound"], len(elements["cell"]))
-    dist["cell"] = list(zip(phase_cell, amp_cell))
-
-    # trwave
-    phase_trwave = truncated_normal(params["trwave_rf_phase_mean"], params["trwave_rf_phase_sig"], params["trwave_rf_phase_bound"], len(elements["trwave"]))
-    amp_trwave = truncated_normal(params["trwave_rf_amp_mean"], params["trwave_rf_amp_sig"], params["trwave_rf_amp_bound"], len(elements["trwave"]))
-    dist["trwave"] = list(zip(phase_trwave, amp_trwave))
-    
-    
-    #bend
-    dist["bend"]= truncated_normal(params["bend_amp_mean"], params["bend_amp_sig"], params["bend_amp_bound"], len(elements["bend"]))
-
-    return dist
+SAMPLINGS = ("mc", "sobol", "halton", "lhs")
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def mix64(x):
+    # SplitMix64 finalizer; uint64 arithmetic wraps around
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def uniform_design(sampling, runs, dim, seed):
+    """
+    Points in the unit cube, one row per case.
+
+    mc gives every case its own substream: the uniforms of case k are a
+    counter-based hash (SplitMix64) of (key, k, dimension), with the key drawn
+    from SeedSequence(seed). Row k depends only on the seed and k, and all
+    rows come from one vectorized call (10k cases x 40 errors in a few ms). sobol
+    and halton are scrambled low-discrepancy sequences and lhs a Latin
+    hypercube (scipy.stats.qmc), seeded by seed: they cover the cube more
+    evenly, so means and percentiles converge in fewer runs. Sobol and
+    Halton are sequences, case k is the same point for any number of runs;
+    a Latin hypercube is built for exactly `runs` points.
+
+    Returns:
+        numpy.ndarray: (runs, dim) uniforms in (0, 1).
+    """
+    if sampling == "mc":
+        key = np.random.SeedSequence(seed).generate_state(2, np.uint64)
+        case = np.arange(1, runs + 1, dtype=np.uint64)[:, None]
+        column = np.arange(dim, dtype=np.uint64)[None, :]
+        bits = mix64(mix64(key[0] + case * GOLDEN) ^ (key[1] + column * GOLDEN))
+        # 53 random bits, centred in their interval: strictly inside (0, 1)
+        return ((bits >> np.uint64(11)).astype(np.float64) + 0.5) * 2.0 ** -53
+    if dim == 0:
+        return np.empty((runs, 0))
+    from scipy.stats import qmc
+    rng = np.random.default_rng(seed)
+    if sampling == "sobol":
+        if runs & (runs - 1):
+            print(f"Note: Sobol points are balanced for powers of 2 runs; {runs} runs given.")
+        # the first point of an unscrambled Sobol sequence is 0, which the inverse CDF maps to -bound
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)  # scipy's version of the note above
+            u = qmc.Sobol(dim, scramble=True, seed=rng).random(runs)
+    elif sampling == "halton":
+        u = qmc.Halton(dim, scramble=True, seed=rng).random(runs)
+    elif sampling == "lhs":
+        u = qmc.LatinHypercube(dim, seed=rng).random(runs)
+    else:
+        raise ValueError(f"sampling must be one of {', '.join(SAMPLINGS)}, not {sampling!r}")
+    return u
+
+
+def perturbation_matrix(columns, params, runs, seed, sampling="mc"):
+    """
+    Draws the errors of all runs at once from truncated normals: the points
+    of uniform_design() go through the truncated-normal inverse CDF in one
+    vectorized call. Errors with sigma 0 are set to their mean and take no
+    dimension of the design.
+
+    Returns:
+        numpy.ndarray: (runs, len(columns)) errors, column order as columns.
+    """
+    mean = np.array([params[f"{p}_mean"] for _, p in columns], dtype=float)
+    sig = np.array([params[f"{p}_sig"] for _, p in columns], dtype=float)
+    bound = np.array([params[f"{p}_bound"] for _, p in columns], dtype=float)
+    values = np.tile(mean, (runs, 1))
+    on = sig != 0
+    u = uniform_design(sampling, runs, int(on.sum()), seed)
+    if on.any():
+        a, b = (-bound[on] - mean[on]) / sig[on], (bound[on] - mean[on]) / sig[on]
+        values[:, on] = truncnorm.ppf(u, a, b, loc=mean[on], scale=sig[on])
+    return values
 
 # 4. Apply element perturbations
-def apply_perturbations(input_path, params, folder):
+def card_fields(line):
+    # the fields of a card and its trailing '!' or ';' comment, which float() must not see
+    cut = min((k for k in (line.find('!'), line.find(';')) if k >= 0), default=len(line))
+    return line[:cut].split(), line[cut:].rstrip('\r\n')
+
+def apply_perturbations(input_path, folder, pert):
+    # pert: error name -> value, one row of perturbation_matrix() by error_columns() name
     # read lines
     with open(input_path, 'r') as f:
         lines = f.readlines()
     elements, mainfreq = find_ele_ind(lines)
-    dist = randseed(elements, params)
 
     # modify trwave
-    for idx, (p, a) in zip(elements["trwave"], dist["trwave"]):
+    for n, idx in enumerate(elements["trwave"]):
+        p, a = pert[f"trwave{n}_phase"], pert[f"trwave{n}_amp"]
         for j in range(idx, idx + 86):
             if j >= len(lines): break
-            parts = lines[j].split()
+            parts, comment = card_fields(lines[j])
             if len(parts) >= 6:
                 if p != 0:
                     parts[4] = str(float(parts[4]) + p)
                 if a != 0:
                     parts[5] = str(float(parts[5]) * (1 + a))
-                lines[j] = ' '.join(parts) + '\n'
+                lines[j] = ' '.join(parts + [comment]).rstrip() + '\n'
     # modify cell
-    for idx, (p, a) in zip(elements["cell"], dist["cell"]):
-        parts = lines[idx].split()
+    for n, idx in enumerate(elements["cell"]):
+        p, a = pert[f"cell{n}_phase"], pert[f"cell{n}_amp"]
+        parts, comment = card_fields(lines[idx])
         if len(parts) >= 6:
             if p != 0:
                 parts[4] = str(float(parts[4]) + p)
             if a != 0:
                 parts[5] = str(float(parts[5]) * (1 + a))
-            lines[idx] = ' '.join(parts) + '\n'
+            lines[idx] = ' '.join(parts + [comment]).rstrip() + '\n'
     # solenoid
-    for idx, a in zip(elements["solenoid"], dist["solenoid"]):
-        parts = lines[idx].split()
+    for n, idx in enumerate(elements["solenoid"]):
+        a = pert[f"solenoid{n}_amp"]
+        parts, comment = card_fields(lines[idx])
         if len(parts) >= 5 and a != 0:
             parts[4] = str(float(parts[4]) * (1 + a))
-            lines[idx] = ' '.join(parts) + '\n'
+            lines[idx] = ' '.join(parts + [comment]).rstrip() + '\n'
     # quad
-    for idx, a in zip(elements["quad"], dist["quad"]):
-        parts = lines[idx].split()
+    for n, idx in enumerate(elements["quad"]):
+        a = pert[f"quad{n}_amp"]
+        parts, comment = card_fields(lines[idx])
         if len(parts) >= 5 and a != 0:
             parts[4] = str(float(parts[4]) * (1 + a))
-            lines[idx] = ' '.join(parts) + '\n'
+            lines[idx] = ' '.join(parts + [comment]).rstrip() + '\n'
  
     # steerer
-    for idx, a in zip(elements["steerer"], dist["steerer"]):
-        parts = lines[idx].split()
+    for n, idx in enumerate(elements["steerer"]):
+        a = pert[f"steerer{n}_amp"]
+        parts, comment = card_fields(lines[idx])
         if len(parts) >= 6 and a != 0:
             parts[4] = str(float(parts[4]) * (1 + a))
             parts[5] = str(float(parts[5]) * (1 + a))
-            lines[idx] = ' '.join(parts) + '\n'
+            lines[idx] = ' '.join(parts + [comment]).rstrip() + '\n'
  
      # bend
-    for idx, a in zip(elements["bend"], dist["bend"]):
-        parts = lines[idx].split()
+    for n, idx in enumerate(elements["bend"]):
+        a = pert[f"bend{n}_amp"]
+        parts, comment = card_fields(lines[idx])
         if len(parts) >= 5 and a != 0:
             parts[4] = str(float(parts[4]) * (1 + a))
-            lines[idx] = ' '.join(parts) + '\n'
+            lines[idx] = ' '.join(parts + [comment]).rstrip() + '\n'
 
     # write modified file
     pert_file = os.path.join(folder, os.path.basename(input_path).replace('.inp', '_erranaly.inp'))
@@ -137,203 +214,453 @@ def apply_perturbations(input_path, params, folder):
     return pert_file
 
 # 5. Run a single case
-def run_case(args):
+def run_case(args, timeout=None):
+    # a run still going after timeout seconds is killed (subprocess.TimeoutExpired)
     folder, pert_file = args
-    cwd = os.getcwd()
-    os.chdir(folder)
-    try:
-        subprocess.run(["parmela", os.path.basename(pert_file)], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        # Find all files ending with .T2 or .T3
-        files_to_delete = glob.glob('*.T2') + glob.glob('*.T3')
-        # Loop through the list and delete each file
-        for f in files_to_delete:
+    return case_table(run_parmela(folder, os.path.basename(pert_file), timeout=timeout))
+
+
+def case_table(result):
+    # delete the particle dumps (*.T2, *.T3) the run wrote
+    for f in result.outputs:
+        if f.endswith(('.T2', '.T3')):
             try:
                 os.remove(f)
             except OSError as e:
                 print(f"Error deleting file {f}: {e}")
-        # -------------------------------------------
-    finally:
-        os.chdir(cwd)
     # return path to output TBL
-    tbl_files = glob.glob(os.path.join(folder, 'TIMESTEPEMITTANCE.TBL'))
-    if not tbl_files:
-        tbl_files = glob.glob(os.path.join(folder, '*.tbl'))
+    tbl = result.path('TIMESTEPEMITTANCE.TBL')
+    if tbl is None:
+        tbl_files = [f for f in result.outputs if f.endswith('.tbl')]
         if tbl_files:
-            print(f"Warning: TIMESTEPEMITTANCE.TBL not found. Using {os.path.basename(tbl_files[0])} instead.")
-
-    if tbl_files:
-        return tbl_files[0]
-    return None
+            tbl = tbl_files[0]
+            print(f"Warning: TIMESTEPEMITTANCE.TBL not found. Using {os.path.basename(tbl)} instead.")
+    return tbl
 
 
 # 6. Aggregate results
-def aggregate_results(tbl_paths, params, run_id):
-    # prepare header in main analysis file
-    main_file = "error_analysis_dat.txt"
+def aggregate_results(store, run_id):
+    # final row of every case, from the results store
     header = "T(deg) Z(cm) Xun(mm-mrad) Yun(mm-mrad) Zun(mm-mrad) Xn(mm-mrad) Yn(mm-mrad) Zn(mm-mrad) Xrms(mm) Yrms(mm) Zrmz(mm) <kE>(MeV) Del-Erms <X>(mm) <Xpn>(mrad) <Y>(mm) <Ypn>(mrad) <Z>(cm) <Zpn>(rad) EZref(MV/m)"
-    with open(main_file, 'w') as out:
+    finals = store.finals().sort_index()
+    with open(f"error_analysis_dat_{run_id}.txt", 'w') as out:
         out.write(header + '\n')
-    # append each -3 line
-    for tbl in tbl_paths:
-        if tbl is None: continue
-        with open(tbl, 'r') as f:
-            lines = f.readlines()
-            if len(lines) >= 3:
-                line = lines[-3].strip()
-                with open(main_file, 'a') as out:
-                    out.write(line + '\n')
-    # rename
-    shutil.move(main_file, f"error_analysis_dat_{run_id}.txt")
-
-
-# 7. Orbit Figure Plotting
-def orbit_figure(base_name, runs, run_id):
+        for row in finals.to_numpy():
+            out.write(" ".join(f"{v:.6E}" for v in row) + '\n')
+
+
+# 7. Convergence report and adaptive stopping
+STATISTICS = {
+    'mean': lambda x: np.mean(x, axis=-1),
+    'std': lambda x: np.std(x, axis=-1, ddof=1),
+    'p95': lambda x: np.percentile(x, 95, axis=-1),
+}
+
+
+def bootstrap_ci(x, statistic='std', confidence=0.95, resamples=1000, seed=None):
     """
-    Generates orbit error plots from multiple simulation runs.
+    Bootstrap percentile confidence interval of a statistic of the cases.
+
+    Args:
+        x (numpy.ndarray): One value per case.
+        statistic (str): 'mean', 'std' or 'p95'.
+        confidence (float): Coverage of the interval.
+        resamples (int): Bootstrap resamples, drawn in one (resamples, N) index array.
+        seed: Seed of the resampling.
+
+    Returns:
+        tuple: (estimate, low, high).
     """
-    print("Generating orbit error plots...")
-    output_txt_file = f"orbit_error_{run_id}.txt"
-    
-    all_data = pd.DataFrame()
-
-    for i in range(1, runs + 1):
-        folder = f"{base_name}_{i}"
-        tbl_files = glob.glob(os.path.join(folder, 'TIMESTEPEMITTANCE.TBL'))
-        if not tbl_files:
-            print(f"Warning: No TIMESTEPEMITTANCE.TBL file found in {folder}")
-            continue
-        
-        tbl_path = tbl_files[0]
-
-        with open(tbl_path, 'r') as f:
-            lines = f.readlines()
-        
-        line_ini = -1
-        for idx, line in enumerate(lines):
-            if "DATA" in line:
-                line_ini = idx
-                break
+    stat = STATISTICS[statistic]
+    rng = np.random.default_rng(seed)
+    boot = stat(x[rng.integers(0, len(x), size=(resamples, len(x)))])
+    tail = 50 * (1 - confidence)
+    low, high = np.percentile(boot, [tail, 100 - tail])
+    return float(stat(x)), float(low), float(high)
 
-        if line_ini == -1:
-            print(f"Warning: 'DATA' keyword not found in {tbl_path}")
-            continue
-            
-        df = pd.read_csv(tbl_path, skiprows=line_ini + 2, sep='\s+', header=None, engine='python')
-        
-        # Read header from the line after "DATA" and remove leading semicolon
-        header = lines[line_ini + 1].strip().lstrip(';').split()
-
-        if len(df.columns) != len(header):
-            print(f"Error: Column count mismatch in file {tbl_path}.")
-            print(f"Data columns: {len(df.columns)}, Header columns: {len(header)}")
-            continue
-
-        df.columns = header
-
-        if i == 1:
-            # Only copy Z(cm), <X>(mm), <Y>(mm) for the first file
-            if all(col in df.columns for col in ['Z(cm)', '<X>(mm)', '<Y>(mm)']):
-                all_data = df[['Z(cm)', '<X>(mm)', '<Y>(mm)']].copy()
-                # Rename the columns for the first file
-                all_data.columns = [f"Z(cm)_1", f"<X>(mm)_1", f"<Y>(mm)_1"]
-            else:
-                print(f"Warning: Key columns 'Z(cm)', '<X>(mm)', or '<Y>(mm)' not found in {tbl_path}. Skipping.")
-                continue
-        else:
-            # For subsequent files, only take <X>(mm) and <Y>(mm)
-            if '<X>(mm)' in df.columns and '<Y>(mm)' in df.columns:
-                df_subset = df[['<X>(mm)', '<Y>(mm)']].copy()
-                df_subset.columns = [f"<X>(mm)_{i}", f"<Y>(mm)_{i}"]
-                all_data = pd.concat([all_data, df_subset], axis=1)
-
-    # Save the combined data to a file
-    all_data.to_csv(output_txt_file, sep='\t', index=False)
-    print(f"Combined orbit data saved to {output_txt_file}")
-
-    # Plotting
-    z_col = f'Z(cm)_1'
-    if z_col not in all_data.columns:
-        print("Error: 'Z(cm)_1' column not found for plotting.")
+
+def precision_reached(store, settings, seed=None):
+    """
+    Checks the adaptive stopping rule after a wave: for every metric the
+    bootstrap interval half-width of the statistic, relative to the
+    statistic, must be at most settings['precision'], or the half-width
+    itself at most settings['tolerance'] (one value, or a dict by metric).
+    A statistic centred on zero (e.g. the mean of <X>) has no useful
+    relative width and needs a tolerance.
+
+    Returns:
+        bool: True if every metric is precise enough.
+    """
+    finals = store.finals()
+    if len(finals) < max(settings.get('min_runs', 2), 2):
+        return False
+    reached = True
+    tolerance = settings.get('tolerance')
+    print(f"  after {len(finals)} cases ({settings.get('statistic', 'std')}, "
+          f"{100 * settings.get('confidence', 0.95):.0f}% interval):")
+    for metric in settings.get('metrics', CONVERGENCE_COLUMNS):
+        est, low, high = bootstrap_ci(finals[metric].to_numpy(), settings.get('statistic', 'std'),
+                                      settings.get('confidence', 0.95), settings.get('resamples', 1000), seed)
+        half = (high - low) / 2
+        rel = half / abs(est) if est != 0 else np.inf
+        tol = tolerance.get(metric) if isinstance(tolerance, dict) else tolerance
+        reached = reached and (rel <= settings['precision'] or (tol is not None and half <= tol))
+        print(f"    {metric}: {est:.6g} [{low:.6g}, {high:.6g}]  relative half-width {rel:.3g}"
+              + (f", half-width {half:.3g} (tolerance {tol:.3g})" if tol is not None else ""))
+        if tol is None and low <= 0 <= high:
+            print(f"    {metric}: the interval contains 0, set adaptive tolerance for it or it never converges")
+    return reached
+
+
+CONVERGENCE_COLUMNS = ('Xn(mm-mrad)', 'Yn(mm-mrad)', 'Del-Erms', '<X>(mm)', '<Y>(mm)')
+PERCENTILES = (5, 50, 95)
+
+
+def convergence_report(store, run_id, sampling="mc", columns=CONVERGENCE_COLUMNS, points=200):
+    """
+    Running mean and percentiles of final-row quantities over the first N
+    cases (by case number), at up to `points` values of N. Flat curves
+    mean that more runs would not change the tolerances.
+    """
+    finals = store.finals().sort_index()
+    columns = [c for c in columns if c in finals.columns]
+    if len(finals) < 2 or not columns:
+        print("Not enough finished cases for a convergence report.")
         return
+    n = np.unique(np.geomspace(1, len(finals), min(points, len(finals))).round().astype(int))
+    out = [n]
+    names = ["N"]
+    for c in columns:
+        x = finals[c].to_numpy()
+        out.append((np.cumsum(x) / np.arange(1, len(x) + 1))[n - 1])
+        names.append(f"mean_{c}")
+        for q in PERCENTILES:
+            out.append(np.array([np.percentile(x[:k], q) for k in n]))
+            names.append(f"P{q}_{c}")
+    report = np.column_stack(out)
+    np.savetxt(f"convergence_{run_id}.txt", report, fmt='%.6e', delimiter='\t', header='\t'.join(names), comments='')
+
+    # mean and percentile band of each quantity against N
+    fig, axes = plt.subplots(len(columns), 1, figsize=(10, 2.5 * len(columns)), sharex=True, squeeze=False)
+    for ax, c in zip(axes[:, 0], columns):
+        k = names.index(f"mean_{c}")
+        ax.plot(n, report[:, k], label='mean')
+        for j, q in enumerate(PERCENTILES):
+            ax.plot(n, report[:, k + 1 + j], '--', label=f'P{q}')
+        ax.set_ylabel(c)
+        ax.grid(True)
+    axes[0, 0].legend(loc='upper right')
+    axes[-1, 0].set_xlabel('N (cases)')
+    fig.suptitle(f'Convergence - Run ID: {run_id} ({sampling})')
+    fig.savefig(f'convergence_{run_id}.png', dpi=150)
+    plt.close(fig)
+    print(f"Convergence report saved to convergence_{run_id}.txt")
+
+
+# 8. Linear sensitivity model
+def error_deltas(columns, params):
+    # step of each error in the sensitivity runs: its sigma, else its bound; 0 for errors that are never set
+    deltas = []
+    for _, p in columns:
+        deltas.append(float(params[f"{p}_sig"]) or float(params[f"{p}_bound"]))
+    return np.array(deltas)
+
+
+def sensitivity_plan(columns, params):
+    """
+    Errors of the sensitivity runs: case 1 is the nominal deck, cases
+    2k+2 and 2k+3 set the k-th error with a nonzero step to +step and -step.
 
-    # Plot X orbits
-    plt.figure(figsize=(10, 6))
-    for i in range(1, runs + 1):
-        x_col = f'<X>(mm)_{i}'
-        if x_col in all_data.columns:
-            plt.plot(all_data[z_col], all_data[x_col])
-    plt.xlabel('Z (cm)')
-    plt.ylabel('<X> (mm)')
-    plt.title(f'Orbit Error Analysis (X) - Run ID: {run_id}')
-    plt.grid(True)
-    plt.savefig(f'orbit_X_{run_id}.png', dpi=300)
-    plt.show()
-
-    # Plot Y orbits
-    plt.figure(figsize=(10, 6))
-    for i in range(1, runs + 1):
-        y_col = f'<Y>(mm)_{i}'
-        if y_col in all_data.columns:
-            plt.plot(all_data[z_col], all_data[y_col])
-    plt.xlabel('Z (cm)')
-    plt.ylabel('<Y> (mm)')
-    plt.title(f'Orbit Error Analysis (Y) - Run ID: {run_id}')
-    plt.grid(True)
-    plt.savefig(f'orbit_Y_{run_id}.png', dpi=300)
-    plt.show()
-
-
-# 8. Main entry
+    Returns:
+        numpy.ndarray: (1 + 2 * active errors, len(columns)) errors.
+    """
+    deltas = error_deltas(columns, params)
+    active = np.flatnonzero(deltas)
+    plan = np.zeros((1 + 2 * len(active), len(columns)))
+    for k, j in enumerate(active):
+        plan[1 + 2 * k, j] = deltas[j]
+        plan[2 + 2 * k, j] = -deltas[j]
+    return plan
+
+
+def linear_model(store):
+    """
+    Central-difference sensitivities of the final-row quantities from a
+    finished sensitivity study.
+
+    Returns:
+        tuple: (nominal final row as a pandas.Series, Jacobian as a DataFrame
+            with one row per varied error and one column per quantity).
+    """
+    plan, finals = store.plan(), store.finals()
+    missing = sorted(set(plan.index) - set(finals.index))
+    if missing:
+        raise ValueError(f"Sensitivity cases {missing} are not finished; resume the study first")
+    rows = {}
+    for k in range((len(plan) - 1) // 2):
+        plus, minus = plan.loc[2 + 2 * k], plan.loc[3 + 2 * k]
+        name = plus.idxmax()
+        rows[name] = (finals.loc[2 + 2 * k] - finals.loc[3 + 2 * k]) / (plus[name] - minus[name])
+    return finals.loc[1], pd.DataFrame(rows).T
+
+
+def propagate(nominal, jacobian, columns, params, samples=100000, seed=None):
+    """
+    Propagates the yaml error distributions through the linear model
+    nominal + J . errors, analytically and by Monte Carlo on the model
+    (no PARMELA runs).
+
+    Returns:
+        tuple: (summary DataFrame with mean, std and MC percentiles per
+            quantity, variance-share DataFrame with one row per error).
+    """
+    prefix = dict(columns)
+    names = [name for name in jacobian.index]
+    mean = np.array([params[f"{prefix[n]}_mean"] for n in names], dtype=float)
+    sig = np.array([params[f"{prefix[n]}_sig"] for n in names], dtype=float)
+    bound = np.array([params[f"{prefix[n]}_bound"] for n in names], dtype=float)
+    on = sig != 0
+    a = np.where(on, (-bound - mean) / np.where(on, sig, 1), 0)
+    b = np.where(on, (bound - mean) / np.where(on, sig, 1), 0)
+    e_mean, e_var = mean.copy(), np.zeros(len(names))
+    e_mean[on] = truncnorm.mean(a[on], b[on], loc=mean[on], scale=sig[on])
+    e_var[on] = truncnorm.var(a[on], b[on], loc=mean[on], scale=sig[on])
+    J = jacobian.to_numpy()
+    contrib = J ** 2 * e_var[:, None]
+    var = contrib.sum(axis=0)
+    # Monte Carlo on the linear model, all samples in one draw
+    rng = np.random.default_rng(seed)
+    errors = np.tile(mean, (samples, 1))
+    if on.any():
+        errors[:, on] = truncnorm.rvs(a[on], b[on], loc=mean[on], scale=sig[on],
+                                      size=(samples, int(on.sum())), random_state=rng)
+    y = nominal[jacobian.columns].to_numpy() + errors @ J
+    summary = pd.DataFrame({
+        'nominal': nominal[jacobian.columns].to_numpy(),
+        'mean': nominal[jacobian.columns].to_numpy() + e_mean @ J,
+        'std': np.sqrt(var),
+        'std_mc': y.std(axis=0),
+        'P5_mc': np.percentile(y, 5, axis=0),
+        'P50_mc': np.percentile(y, 50, axis=0),
+        'P95_mc': np.percentile(y, 95, axis=0),
+    }, index=jacobian.columns)
+    shares = pd.DataFrame(np.divide(contrib, var, out=np.zeros_like(contrib), where=var > 0),
+                          index=names, columns=jacobian.columns)
+    return summary, shares
+
+
+def sensitivity_report(store, columns, params, tag, metrics=CONVERGENCE_COLUMNS):
+    """
+    Writes the linear-model tolerance budget: sensitivity_<tag>.txt with the
+    propagated statistics and each element's share of the variance, and
+    sensitivity_<tag>.csv with the sensitivity and variance share of every error.
+    """
+    nominal, jacobian = linear_model(store)
+    jacobian = jacobian[[m for m in metrics if m in jacobian.columns]]
+    summary, shares = propagate(nominal, jacobian, columns, params, seed=params.get('seed'))
+    # phase and amplitude errors of one element add up to the element's share
+    elements = shares.groupby(lambda name: name.rsplit('_', 1)[0], sort=False).sum()
+    with open(f"sensitivity_{tag}.txt", 'w') as out:
+        out.write(f"# Linear sensitivity model (study {store.file.attrs.get('run_id', tag)}): "
+                  f"{len(jacobian)} errors, final values = nominal + J . errors\n")
+        out.write(summary.to_string(float_format=lambda v: f"{v:.6E}") + '\n')
+        for m in jacobian.columns:
+            out.write(f"\n# Variance share of {m} by element\n")
+            top = elements[m].sort_values(ascending=False)
+            for name, share in top[top > 0].items():
+                out.write(f"{name:20s} {100 * share:8.3f} %\n")
+    table = pd.concat([jacobian.add_prefix('d_'), shares.add_prefix('share_')], axis=1)
+    table.index.name = 'error'
+    table.to_csv(f"sensitivity_{tag}.csv", float_format='%.6E')
+    print(f"Sensitivity report saved to sensitivity_{tag}.txt")
+    print(summary.to_string(float_format=lambda v: f"{v:.6g}"))
+
+
+# 9. Orbit Figure Plotting
+def orbit_figure(orbits, run_id, mode='bands', density=False):
+    """
+    Saves the orbits of the study and generates orbit error plots.
+
+    Args:
+        orbits (parmela_store.OrbitEnvelope): The orbits, folded in as the cases finished.
+        run_id (str): The study; the files are orbit_<run_id>.npy (runs x Z x
+            (<X>, <Y>), float32, row k-1 is case k) and orbit_envelope_<run_id>.txt
+            (Z grid, count, mean, std, min, max per Z).
+        mode (str): 'bands' (min/5/50/95/max percentiles and RMS per Z) or
+            'lines' (every case), see orbitplot.plot_orbit().
+        density (bool): Draw the density of all orbits behind the bands.
+    """
+    print("Generating orbit error plots...")
+    if not len(orbits):
+        print("Error: No orbits of the study for plotting.")
+        return
+
+    orbits.save(f"orbit_{run_id}.npy", f"orbit_envelope_{run_id}.txt")
+    print(f"Orbits of {len(orbits)} cases saved to orbit_{run_id}.npy, envelope to orbit_envelope_{run_id}.txt")
+    data = orbits.data[orbits.filled]
+    plot_orbits(orbits.z, data[:, :, 0].T, data[:, :, 1].T, run_id, mode, density)
+    print(f"Orbit plots saved to orbit_X_{run_id}.png and orbit_Y_{run_id}.png")
+
+
+# 10. Main entry
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Usage: python error_ana_pal.py <input_filename.inp> <error_config.yaml>")
+        print("Usage: python error_ana_pal.py <input_filename.inp> <error_config.yaml> [--resume <run_id> [--case <k>]]")
+        print("       python error_ana_pal.py <input_filename.inp> <error_config.yaml> --what-if <sensitivity_run_id>")
         sys.exit(1)
 
     input_filename = sys.argv[1]
     yaml_filename = sys.argv[2]
+    base = os.path.splitext(input_filename)[0]
+
+    # --what-if: propagates the sigmas of this yaml through the linear model of a finished
+    # sensitivity study (mode: sensitivity), without running PARMELA
+    if "--what-if" in sys.argv:
+        source = sys.argv[sys.argv.index("--what-if") + 1]
+        with open(yaml_filename) as f:
+            params = yaml.safe_load(f)
+        with open(input_filename, 'r') as f:
+            elements, _ = find_ele_ind(f.readlines())
+        with ResultStore(f"error_{source}.h5", 'r') as store:
+            tag = f"{source}_{os.path.splitext(os.path.basename(yaml_filename))[0]}"
+            sensitivity_report(store, error_columns(elements), params, tag)
+        sys.exit(0)
+
+    # unique ID; a resumed study keeps its ID, its saved yaml, ledger and results store
+    if "--resume" in sys.argv:
+        run_id = sys.argv[sys.argv.index("--resume") + 1]
+        yaml_filename = f"error_{run_id}.yaml"
+    else:
+        run_id = uuid.uuid4().hex[:8]
+        shutil.copyfile(yaml_filename, f"error_{run_id}.yaml")
     with open(yaml_filename) as f:
         params = yaml.safe_load(f)
     runs = params.get('runs', 1)
-    base = os.path.splitext(input_filename)[0]
-    
-    
-    # ################### HIGHLIGHTED CHANGE ###################
-    # Clean up old directories before starting a new run
-    print("Cleaning up old simulation directories...")
-    old_folders = glob.glob(f"{base}_*")
-    for folder in old_folders:
-        if os.path.isdir(folder):
-            print(f"Removing: {folder}")
-            shutil.rmtree(folder)
-    # ################# END HIGHLIGHTED CHANGE #################
 
-    # unique ID
-    run_id = uuid.uuid4().hex[:8]
-    shutil.copyfile(yaml_filename, f"error_{run_id}.yaml")
-
-    # create folders and prepare cases
-    tbl_paths = []
-    args = []
-    for i in range(1, runs+1):
+    # The errors of all cases are drawn up front from one seed (case k from its own substream).
+    # A yaml without 'seed' gets a fresh one, written to the saved yaml so that --resume
+    # and --case <k> (reruns case k alone in <deck>_k, kept) draw exactly the same errors.
+    if params.get('seed') is None:
+        params['seed'] = np.random.SeedSequence().entropy
+        with open(f"error_{run_id}.yaml", 'a') as f:
+            f.write(f"\nseed: {params['seed']}\n")
+    with open(input_filename, 'r') as f:
+        elements, _ = find_ele_ind(f.readlines())
+    columns = error_columns(elements)
+    names = [name for name, _ in columns]
+    # sampling: mc (default), or sobol / halton / lhs designs for faster converging statistics
+    sampling = params.get('sampling', 'mc')
+    # mode: sensitivity runs the nominal deck and each error at +-sigma instead (runs is ignored)
+    sensitivity = params.get('mode') == 'sensitivity'
+    if sensitivity:
+        plan = sensitivity_plan(columns, params)
+        runs = len(plan)
+    else:
+        plan = perturbation_matrix(columns, params, runs, params['seed'], sampling)
+
+    # Scheduler settings: workers (default: PARMELA_WORKERS or the CPU count), timeout in seconds
+    # per run (killed and retried, default none), retries per case (default 1).
+    # dispatch: async overlaps writing the next decks and reading finished tables with the runs
+    # (parmela_async); the default 'process' runs each case in a worker process (parmela_queue).
+    # Every finished case goes into the results store and its folder is removed
+    # (keep_folders: true in the yaml keeps them). orbit_decimate: every n-th orbit row is stored, 0 for none.
+    # The full orbit of each case is folded onto a common grid of orbit_points Z points as it finishes;
+    # the grid spans orbit_z: [first, last] (cm), by default 0 to the beamline length of the deck.
+    # orbit_plot: bands (percentile bands, default) or lines (every case); orbit_density: true adds
+    # the density of all orbits behind the bands.
+    store_file = f"error_{run_id}.h5"
+    keep_folders = params.get('keep_folders', False)
+    decimate = params.get('orbit_decimate', 10)
+    z_range = params.get('orbit_z') or (0.0, Deck(input_filename).beamline_length())
+    orbits = OrbitEnvelope(runs, z_range, params.get('orbit_points', ORBIT_POINTS))
+    dispatch = params.get('dispatch', 'process')
+    queue = (AsyncQueue if dispatch == 'async' else WorkQueue)(
+        Ledger(f"error_{run_id}.ledger"), workers=params.get('workers', WORKERS),
+        timeout=params.get('timeout'), retries=params.get('retries', 1))
+
+    def case_errors(i):
+        return dict(zip(names, plan[i - 1]))
+
+    def prepare(i):
+        # the case folder is created only when the case is dispatched; a leftover one is replaced
         folder = f"{base}_{i}"
-        os.makedirs(folder, exist_ok=True)
-        # copy all .inp and .T7 files
-        for ext in ['*.inp','*.T7','SAVECO*']:
-            for f in glob.glob(ext): shutil.copy(f, folder)
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        # link the field maps from the shared pool, copy the save files; the deck is written below
+        stage_inputs(folder)
         # apply perturbation
-        pert = apply_perturbations(input_filename, params, folder)
-        args.append((folder, pert))
-
-    # run in parallel
-    print(f"Starting {runs} PARMELA runs in parallel...")
-    with ProcessPoolExecutor() as executor:
-        results = list(executor.map(run_case, args))
-    
-    print("All PARMELA runs completed.")
-    
-    # collect
-    aggregate_results(results, params, run_id)
-    
-    # Plotting
-    orbit_figure(base, runs, run_id)
+        pert = apply_perturbations(input_filename, folder, case_errors(i))
+        return folder, os.path.basename(pert)
+
+    def read_case(i, args, tbl):
+        row = final_row(tbl) if tbl else None
+        if row is None:
+            raise RuntimeError(f"case {i} left no output table in {args[0]}")
+        return row, read_orbit(tbl)
+
+    def store_case(i, args, value):
+        row, orbit = value
+        store.append(i, case_errors(i), row, thin_orbit(orbit, decimate) if decimate else None)
+        orbits.add(i, orbit)
+        if not keep_folders:
+            shutil.rmtree(args[0], ignore_errors=True)
+
+    # a study that already has a results store keeps the errors it was started with
+    if os.path.exists(store_file):
+        with ResultStore(store_file, 'r') as stored:
+            drawn = stored.plan()
+        if list(drawn.columns) == names and len(drawn) == len(plan):
+            plan = drawn.to_numpy()
+
+    if "--case" in sys.argv:
+        k = int(sys.argv[sys.argv.index("--case") + 1])
+        args = prepare(k)
+        row, _ = read_case(k, args, run_case(args))
+        print(f"Case {k} (study {run_id}) rerun in {args[0]}:")
+        for name, value in row.items():
+            print(f"  {name}: {value}")
+        sys.exit(0)
+
+    with ResultStore(store_file, attrs={'run_id': run_id, 'input': input_filename, 'params': params}) as store:
+        store.put_plan(names, plan, params['seed'])
+        # a resumed study starts from the (decimated) orbits of the cases already stored
+        for i, orbit in store.orbits():
+            orbits.add(int(i), orbit)
+        print(f"Starting {runs} PARMELA runs in parallel (study {run_id})...")
+
+        def run_cases(cases):
+            if dispatch == 'async':
+                # tables are read in a worker thread while the other cases keep running
+                return queue.run(cases, prepare, lambda i, args, result: read_case(i, args, case_table(result)),
+                                 store_case, skip=store.runs().tolist())
+            return queue.run(cases, prepare, run_case,
+                             lambda i, args, tbl: store_case(i, args, read_case(i, args, tbl)),
+                             skip=store.runs().tolist())
+
+        # adaptive: cases go out in waves of adaptive['wave']; after each wave the study stops
+        # once the bootstrap intervals of the metrics are within adaptive['precision']
+        # (runs is then the budget)
+        adaptive = None if sensitivity else params.get('adaptive')
+        wave = adaptive.get('wave', 16) if adaptive else runs
+        failed = []
+        for start in range(1, runs + 1, wave):
+            failed += run_cases(range(start, min(start + wave, runs + 1)))[1]
+            if adaptive and start + wave <= runs and precision_reached(store, adaptive, params['seed']):
+                print(f"Target precision {adaptive['precision']} reached, stopping after {len(store)} cases.")
+                break
+        print("All PARMELA runs completed.")
+        if failed:
+            print(f"Failed cases: {failed}; rerun with --resume {run_id} to retry them.")
+        print(f"Results of {len(store)} cases stored in {store_file}")
+
+        # collect
+        aggregate_results(store, run_id)
+        if sensitivity:
+            if not failed:
+                sensitivity_report(store, columns, params, run_id)
+        else:
+            convergence_report(store, run_id, sampling)
 
+        # Plotting
+        orbit_figure(orbits, run_id, params.get('orbit_plot', 'bands'), params.get('orbit_density', False))
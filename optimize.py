@@ -1,113 +1,50 @@
 '''parmela tool, used to optimize the beamline.
 scan the value to get min emittance at different bunch length
 Created by W.Liu @ Apr, 2019
+results of every evaluated deck are cached in .parmela_cache; run with --no-cache to disable
+every parmela run is recorded in parmela_trace.jsonl, with the bo round as its iteration
+(python parmela_trace.py summary)
+
+python optimize.py                      nested scan of bunch length and solenoid field
+python optimize.py bo [budget] [batch]  Bayesian optimization of all active !@var 1 variables
+                                        (default 40 runs, 4 at a time)
 '''
 import os
-import pandas as pd
+import sys
+import contextvars
 import numpy as np
+from parmela_deck import load_deck
+from parmela_table import read_table
+from parmela_cache import ResultCache, pop_no_cache_flag
+from parmela_runner import run_parmela, make_workdir, remove_workdir, write_deck, WORKERS
+from parmela_gp import BatchOptimizer
+from parmela_trace import tags
+from concurrent.futures import ThreadPoolExecutor
 
 parmela='C:/LANL/parmela.exe '
 # parmela = 'wine ~/.wine/drive_c/LANL/parmela.exe '
+# Data rows near the cathode are left out (they were file lines 85-399 and 85-99)
+emit_first_row = 315
+size_first_row = 15
 last_element = 41
 
 
 def getvar(filename):
-    file = open(filename, 'rU')
-    lines = file.readlines()
-    file.close()
-    mark = []
-    tempmark = []
-    step = []
-    tempstep = []
-    left_range = []
-    templeft_range = []
-    right_range = []
-    tempright_range = []
-    pos = []
-    for line in lines:
-        line = line.strip()
-        var = line.split()
-        ln = len(var)
-# when open file with 'rU' doesn't work (ASCII decode doesn't work)
-# change 'rU' to 'rb' and use following loop to see which word can't decode
-#        for i in range(ln):
-#            print(var[i])
-#            var[i] = var[i].decode('ASCII')
-        if var != []:
-            if (var[0] == '!@var' and var[1] == '1'):
-                tempmark.append(var[2])
-                tempstep.append(var[3])
-                templeft_range.append(var[4])
-                tempright_range.append(var[5])
-            if (var[0] == '!@subs'):
-                if(ln >= 4 and var[3] in tempmark):
-                    mark.append(var[3])
-                    if(ln >= 6 and var[-2] == 'element'):
-                        pos.append(int(var[-1]))
-                if(ln >= 6 and var[5] in tempmark):
-                    mark.append(var[5])
-                    if(ln >= 8 and var[-2] == 'element'):
-                        pos.append(int(var[-1]))
-    ln1 = len(mark)
-    ln2 = len(tempmark)
-    for i in range(ln1):
-        for j in range(ln2):
-            if tempmark[j] == mark[i]:
-                step.append(tempstep[j])
-                left_range.append(templeft_range[j])
-                right_range.append(tempright_range[j])
-    return mark, step, left_range, right_range, pos
+    # the deck is parsed once and kept in memory, see parmela_deck.Deck
+    return load_deck(filename).active_vars()
 
 
 def rewriteFile(filename, mark, value):
-    file = open(filename, 'rU')
-    lines = file.readlines()
-    file.close()
-    k = 0
-    for line in lines:
-        line = line.strip()
-        subs = line.split()
-        if subs != []:
-            if (subs[0] == '!@subs'):
-                ln = len(subs)
-                if(ln >= 4 and subs[3] == mark):
-                    for i in range(int(subs[1])):
-                        new_line = lines[k + i + 1]
-                        new_line = new_line.split()
-                        new_line[int(subs[2])] = value
-                        new_line = ' '.join(new_line) + '\n'
-                        lines[k + i + 1] = new_line
-                if(ln >= 6 and subs[5] == mark):
-                    for i in range(int(subs[1])):
-                        new_line = lines[k + i + 1]
-                        new_line = new_line.split()
-                        new_line[int(subs[4])] = value
-                        new_line = ' '.join(new_line) + '\n'
-                        lines[k + i + 1] = new_line
-                if(ln >= 4 and subs[3] == ('-' + mark)):
-                    new_line = lines[k + i + 1]
-                    new_line = new_line.split()
-                    value = str(-1 * float(value))
-                    new_line[int(subs[2])] = value
-                    new_line = ' '.join(new_line) + '\n'
-                    lines[k + i + 1] = new_line
-                if(ln >= 6 and subs[5] == ('-' + mark)):
-                    new_line = lines[k + i + 1]
-                    new_line = new_line.split()
-                    value = str(-1 * float(value))
-                    new_line[int(subs[4])] = value
-                    new_line = ' '.join(new_line) + '\n'
-                    lines[k + i + 1] = new_line
-        k += 1
-    file = open(filename, 'w')
-    file.writelines(lines)
-    file.close()
+    # only the lines bound to mark by '!@subs' are re-rendered on flush
+    deck = load_deck(filename)
+    deck.rewrite_var(mark, value)
+    deck.flush()
 
 
 def judge_result(filename):
     IsOk = 0
     goodpos = 0
-    file = open(filename, 'rU')
+    file = open(filename, 'r')
     lines = file.readlines()
     file.close()
     element = []
@@ -130,37 +67,141 @@ def judge_result(filename):
     return IsOk, goodpos
 
 
-def get_min_emittance():
-    with open('EMITTANCE.TBL') as raw:
-        rawdata = [line.split() for line in raw]
-    raw.close()
-    data = pd.DataFrame(rawdata[400:], columns=rawdata[84][1:])
-    data = data.apply(pd.to_numeric)
-    emit = data['Xn(mm-mrad)'].values
+def get_min_emittance(filename='EMITTANCE.TBL'):
+    emit = read_table(filename, ['Xn(mm-mrad)'])['Xn(mm-mrad)'][emit_first_row:]
     min_emit = min(emit)
     return min_emit
 
 
 def get_beam_size(filename):
-    with open(filename) as raw:
-        rawdata = [line.split() for line in raw]
-    raw.close()
-    data = pd.DataFrame(rawdata[400:], columns=rawdata[84][1:])
-    data = data.apply(pd.to_numeric)
-    emit = data['Xn(mm-mrad)'].values
-    pos = emit.tolist().index(min(emit)) + 300
-
-    data = pd.DataFrame(rawdata[100:pos], columns=rawdata[84][1:])
-    data = data.apply(pd.to_numeric)
-    size = data['Xrms(mm)'].values
+    table = read_table(filename, ['Xn(mm-mrad)', 'Xrms(mm)'])
+    emit = table['Xn(mm-mrad)'][emit_first_row:]
+    # the beam size is taken up to 100 rows before the emittance minimum
+    pos = int(np.argmin(emit)) + emit_first_row - 100
+    size = table['Xrms(mm)'][size_first_row:pos]
     return max(size), size[-1]
 
 
+def run_point(inputfilename, outfilename, cache=None):
+    # run parmela for the current deck, or reuse the result (and EMITTANCE.TBL) of an identical deck
+    key = None
+    if cache is not None:
+        key = cache.key(inputfilename)
+        hit = cache.get(key)
+        if hit is not None:
+            return hit['IsOk'], hit['goodpos'], hit['emit']
+    run_parmela('.', inputfilename, command=parmela, check=False)
+    IsOk, goodpos = judge_result(outfilename)
+    emit = get_min_emittance() if IsOk == 1 else None
+    if key is not None:
+        files = ['EMITTANCE.TBL'] if IsOk == 1 else []
+        cache.put(key, {'IsOk': IsOk, 'goodpos': goodpos, 'emit': emit}, files=files)
+    return IsOk, goodpos, emit
+
+
+def run_probe(text, name, outfilename, cache=None):
+    # run_point for deck text in a fresh work directory, so that several probes can run at once
+    workdir = make_workdir()
+    try:
+        write_deck(workdir, name, text)
+        key = None
+        if cache is not None:
+            key = cache.key_text(text, workdir)
+            hit = cache.get(key, workdir=workdir)
+            if hit is not None:
+                return hit['IsOk'], hit['goodpos'], hit['emit']
+        run_parmela(workdir, name, command=parmela, check=False)
+        IsOk, goodpos = judge_result(os.path.join(workdir, outfilename))
+        emit = get_min_emittance(os.path.join(workdir, 'EMITTANCE.TBL')) if IsOk == 1 else None
+        if key is not None:
+            files = ['EMITTANCE.TBL'] if IsOk == 1 else []
+            cache.put(key, {'IsOk': IsOk, 'goodpos': goodpos, 'emit': emit}, files=files, workdir=workdir)
+        return IsOk, goodpos, emit
+    finally:
+        remove_workdir(workdir)
+
+
+def optimize_bo(inputfilename, outfilename, budget=40, batch=4, cache=None, seed=None):
+    """
+    Minimizes the emittance over all active `!@var 1` variables within their
+    ranges. A Gaussian process is fitted to the results so far and proposes
+    `batch` decks at a time (see parmela_gp), which run in parallel; decks
+    whose beam does not pass (judge_result) are kept out of the emittance
+    model and steer the search away through a pass/fail model.
+
+    Returns:
+        tuple: (best values by mark, best emittance), or (None, None) if no
+            deck passed.
+    """
+    deck = load_deck(inputfilename)
+    mark, step, left_range, right_range, pos = deck.active_vars()
+    # a variable bound by several !@subs lines is one dimension
+    dims = {}
+    for m, lo, hi in zip(mark, left_range, right_range):
+        dims.setdefault(m, (float(lo), float(hi)))
+    marks = list(dims)
+    lo = np.array([dims[m][0] for m in marks])
+    hi = np.array([dims[m][1] for m in marks])
+    opt = BatchOptimizer(len(marks), seed=seed)
+    name = os.path.basename(inputfilename)
+    history = open('bo_history.txt', 'w')
+    history.write(' '.join(marks) + ' IsOk goodpos emittance\n')
+    x_batch = opt.initial(max(2 * len(marks) + 1, batch))
+    runs = 0
+    rounds = 0
+    with ThreadPoolExecutor(max_workers=min(batch, WORKERS)) as executor:
+        while runs < budget:
+            rounds += 1
+            x_batch = x_batch[:budget - runs]
+            values = lo + x_batch * (hi - lo)
+            texts = []
+            for v in values:
+                for m, value in zip(marks, v):
+                    deck.rewrite_var(m, '{0:.8f}'.format(value))
+                texts.append(deck.render())
+            with tags(iteration=rounds):
+                futures = [executor.submit(contextvars.copy_context().run, run_probe, text, name, outfilename, cache)
+                           for text in texts]
+            results = [future.result() for future in futures]
+            ok = np.array([r[0] == 1 for r in results])
+            emit = np.array([r[2] if r[0] == 1 else np.nan for r in results], dtype=float)
+            opt.tell(x_batch, emit, ok)
+            for v, (IsOk, goodpos, e) in zip(values, results):
+                runs += 1
+                history.write(' '.join('{0:.8f}'.format(value) for value in v) + f' {IsOk} {goodpos} {e}\n')
+                print('run', runs, {m: round(float(value), 6) for m, value in zip(marks, v)}, 'emittance:' if IsOk == 1 else 'beam lost at', e if IsOk == 1 else goodpos)
+            history.flush()
+            x_best, best = opt.best()
+            if best is not None:
+                print('best emittance so far:', best)
+            if runs < budget:
+                x_batch = opt.ask(min(batch, budget - runs))
+    history.close()
+    x_best, best = opt.best()
+    if x_best is None:
+        return None, None
+    values = lo + x_best * (hi - lo)
+    for m, value in zip(marks, values):
+        deck.rewrite_var(m, '{0:.8f}'.format(value))
+    deck.flush()
+    return {m: float(value) for m, value in zip(marks, values)}, best
+
+
 def main():
+    cache = None if pop_no_cache_flag(sys.argv) else ResultCache()
     inputfilename = 'sp2.acc'
     outfilename = 'OUTPAR.TXT'
     foldername = 'scan_results'
     wfilename = 'resultfile.txt'
+    if len(sys.argv) > 1 and sys.argv[1] == 'bo':
+        budget = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+        batch = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+        best_values, best = optimize_bo(inputfilename, outfilename, budget, batch, cache)
+        if best is None:
+            print('No deck passed the beamline, please check the ranges')
+        else:
+            print('min emittance:', best, 'at', best_values, '(written to', inputfilename + ')')
+        return
     mark, step, left_range, right_range, pos = getvar(inputfilename)
     emittance = []
     if mark == []:
@@ -186,10 +227,8 @@ def main():
             while (abs(new_step) > 0.2) and (value <= float(right_range[2])) :
                 i += 1
                 rewriteFile(inputfilename, '3', str(value))  # write the solenoid field
-                os.system(parmela + inputfilename)
-                IsOk, goodpos = judge_result(outfilename)
+                IsOk, goodpos, emit = run_point(inputfilename, outfilename, cache)
                 if IsOk == 1:
-                    emit = get_min_emittance()
                     min_emit.append(emit)
                     field.append(value)
                     os.system('mv EMITTANCE.TBL EMITTANCE_' + str(value) + '.T')
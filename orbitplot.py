@@ -1,60 +1,148 @@
+import os
 import sys
+import warnings
+import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # plots go to files only, nothing blocks on a window
 import matplotlib.pyplot as plt
+from parmela_store import load_orbits
 
-def plot_from_file(file_path):
+# Usage:
+#   python orbitplot.py <orbit_<run_id>.npy | orbit_error_<run_id>.txt> [--lines] [--density]
+# Writes orbit_X_<run_id>.png and orbit_Y_<run_id>.png. By default every Z gets the band of
+# the runs (min-max, 5-95 %), the median and +-RMS, so the plot takes the same time for 10 or
+# 10000 seeds; --density adds the density of all orbits as a rasterized background and
+# --lines draws every run as its own line instead (slow past a few hundred runs).
+
+PERCENTILES = (0, 5, 50, 95, 100)
+
+def read_orbits(file_path):
     """
-    Reads orbit data from a text file and generates plots.
+    Reads the orbits of an error study: orbit_<run_id>.npy with
+    orbit_envelope_<run_id>.txt next to it, or the orbit_error_<run_id>.txt
+    table of older studies.
+
+    Returns:
+        tuple: (run_id, z, x, y), x and y as (points, runs) arrays.
     """
+    name = os.path.basename(file_path)
+    if name.endswith('.npy'):
+        run_id = name[len('orbit_'):-len('.npy')] if name.startswith('orbit_') else "unknown"
+        envelope_path = os.path.join(os.path.dirname(file_path), f"orbit_envelope_{run_id}.txt")
+        z, data, _ = load_orbits(file_path, envelope_path)
+        # rows of cases that did not finish are all NaN
+        data = data[~np.isnan(data).all(axis=(1, 2))]
+        return run_id, z, data[:, :, 0].T, data[:, :, 1].T
+
     try:
         # Extract run_id from the filename
         run_id = file_path.split('orbit_error_')[-1].split('.txt')[0]
     except IndexError:
         run_id = "unknown"
-
-    try:
-        data = pd.read_csv(file_path, sep='\t')
-    except FileNotFoundError:
-        print(f"Error: The file {file_path} was not found.")
-        return
-
+    data = pd.read_csv(file_path, sep='\t')
     z_col = 'Z(cm)_1'
     if z_col not in data.columns:
-        print(f"Error: Base Z column '{z_col}' not found in {file_path}.")
-        return
+        raise ValueError(f"Base Z column '{z_col}' not found in {file_path}.")
 
     # Find all X and Y columns dynamically
     x_cols = [col for col in data.columns if col.startswith('<X>(mm)_')]
     y_cols = [col for col in data.columns if col.startswith('<Y>(mm)_')]
+    return run_id, data[z_col].to_numpy(), data[x_cols].to_numpy(), data[y_cols].to_numpy()
+
+def orbit_bands(values):
+    """
+    Percentiles and RMS of the runs at every Z, ignoring NaN (runs that did
+    not reach that Z).
+
+    Args:
+        values (numpy.ndarray): (points, runs) orbit values.
+
+    Returns:
+        dict: 'min', 'p5', 'median', 'p95', 'max' and 'rms', each (points,).
+    """
+    values = np.asarray(values, dtype=float)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # Z points no run reached
+        q = np.nanpercentile(values, PERCENTILES, axis=1)
+        rms = np.sqrt(np.nanmean(values ** 2, axis=1))
+    return dict(zip(('min', 'p5', 'median', 'p95', 'max'), q), rms=rms)
 
-    # Plot X orbits
-    plt.figure(figsize=(10, 6))
-    for x_col in x_cols:
-        plt.plot(data[z_col], data[x_col])
-    plt.xlabel('Z (cm)')
-    plt.ylabel('<X> (mm)')
-    plt.title(f'Orbit Error Analysis (X) - Run ID: {run_id}')
-    plt.grid(True)
-    plt.savefig(f'orbit_X_{run_id}.png', dpi=300)
-    print(f"Saved high-resolution plot to orbit_X_{run_id}.png")
-    plt.show()
-
-    # Plot Y orbits
-    plt.figure(figsize=(10, 6))
-    for y_col in y_cols:
-        plt.plot(data[z_col], data[y_col])
-    plt.xlabel('Z (cm)')
-    plt.ylabel('<Y> (mm)')
-    plt.title(f'Orbit Error Analysis (Y) - Run ID: {run_id}')
-    plt.grid(True)
-    plt.savefig(f'orbit_Y_{run_id}.png', dpi=300)
-    print(f"Saved high-resolution plot to orbit_Y_{run_id}.png")
-    plt.show()
+def density_background(ax, z, values, bins=(400, 200)):
+    """Draws the density of all orbit points behind the bands, as one raster image."""
+    zz = np.broadcast_to(np.asarray(z, dtype=float)[:, None], values.shape)
+    ok = np.isfinite(values)
+    if not ok.any():
+        return
+    counts, z_edges, v_edges = np.histogram2d(zz[ok], values[ok], bins=bins)
+    counts = np.ma.masked_equal(counts.T, 0)
+    ax.imshow(np.log1p(counts), origin='lower', aspect='auto', cmap='Greys', alpha=0.6,
+              extent=(z_edges[0], z_edges[-1], v_edges[0], v_edges[-1]), interpolation='nearest',
+              rasterized=True, zorder=0)
+
+def plot_orbit(z, values, label, title, path, mode='bands', density=False):
+    """
+    Plots the orbits of all runs in one plane and saves the figure.
+
+    Args:
+        z (numpy.ndarray): (points,) Z in cm.
+        values (numpy.ndarray): (points, runs) orbit in mm.
+        label (str): The y axis label, e.g. '<X> (mm)'.
+        mode (str): 'bands' (percentile bands, median and +-RMS) or 'lines'
+            (one line per run).
+        density (bool): Draw the density of all orbits behind the bands.
+    """
+    fig, ax = plt.subplots(figsize=(10, 6))
+    if density:
+        density_background(ax, z, values)
+    if mode == 'lines':
+        ax.plot(z, values)
+    else:
+        b = orbit_bands(values)
+        ax.fill_between(z, b['min'], b['max'], color='tab:blue', alpha=0.15, lw=0, label='min - max')
+        ax.fill_between(z, b['p5'], b['p95'], color='tab:blue', alpha=0.35, lw=0, label='5 - 95 %')
+        ax.plot(z, b['median'], color='tab:blue', lw=1.2, label='median')
+        ax.plot(z, b['rms'], color='tab:red', lw=1, ls='--', label='± RMS')
+        ax.plot(z, -b['rms'], color='tab:red', lw=1, ls='--')
+        ax.legend(loc='best', fontsize=9)
+    ax.set_xlabel('Z (cm)')
+    ax.set_ylabel(label)
+    ax.set_title(f"{title} ({values.shape[1]} runs)")
+    ax.grid(True)
+    fig.savefig(path, dpi=300)
+    plt.close(fig)
+
+def plot_orbits(z, x, y, run_id, mode='bands', density=False):
+    """Writes orbit_X_<run_id>.png and orbit_Y_<run_id>.png, see plot_orbit()."""
+    paths = []
+    for values, plane in ((x, 'X'), (y, 'Y')):
+        path = f'orbit_{plane}_{run_id}.png'
+        plot_orbit(z, values, f'<{plane}> (mm)', f'Orbit Error Analysis ({plane}) - Run ID: {run_id}',
+                   path, mode, density)
+        paths.append(path)
+    return paths
+
+def plot_from_file(file_path, mode='bands', density=False):
+    """
+    Reads orbit data from a file (see read_orbits) and generates plots.
+    """
+    try:
+        run_id, z, x, y = read_orbits(file_path)
+    except FileNotFoundError as e:
+        print(f"Error: The file {e.filename} was not found.")
+        return
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
+    for path in plot_orbits(z, x, y, run_id, mode, density):
+        print(f"Saved high-resolution plot to {path}")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python orbitplot.py <path_to_orbit_error_file.txt>")
+    args = [a for a in sys.argv[1:] if a not in ('--lines', '--density')]
+    if len(args) != 1:
+        print("Usage: python orbitplot.py <orbit_<run_id>.npy | orbit_error_<run_id>.txt> [--lines] [--density]")
         sys.exit(1)
-    
-    input_file = sys.argv[1]
-    plot_from_file(input_file)
+
+    input_file = args[0]
+    plot_from_file(input_file, 'lines' if '--lines' in sys.argv else 'bands', '--density' in sys.argv)
@@ -1,85 +1,79 @@
-#!/usr/bin/env python
+'''parmela tool, buncher coil phase scan.
 
-import os, sys, string, pdb
+Field 4 of the coil lines 202-215 of rr3.inp is stepped from inival in
+nsteps steps of delval (a ramp of diff over the lines), and the line two
+above the first coil is set to the value + 90. Each point runs in its own
+work directory, in parallel (parmela_scan); the final row of
+TIMESTEPEMITTANCE.TBL of every run goes into one table, 'buncher/scan.txt',
+and the TIMESTEPEMITTANCE<val>.TBL / OUTPAR<val>.TXT of the runs are
+collected in 'buncher' as before.
 
-#
-# Note: python's index start from 0
-# On Windows, this script has to be run under Cygwin
-# The Cygwin can downloaded from: http://cygwin.com/install.html
-#---------------------
-# 
+Usage:
+    python parcoil.py [<deck>] [options]
+    python parmela_scan.py coil [<deck>] [options]
+    options: --workers n --command 'wine ~/.wine/drive_c/LANL/parmela.exe' --timeout s
+             --at 'Z(cm)=498' | --row k | --line n   (row to read, default: the last)
+             --out buncher/scan.txt --keep
+'''
 #Author: Erdong
 #Description: Energy/bunch length/...based on parmela timestep scan of driven phase (output file engout, col. 5 vs. 1).
-#           
-
-#new_row is the line number -1 of that phase variable in the ImpactT.in file.
-#new_col is the location of phase variable in that line - 1. 
+import os
+import sys
+import shutil
 import numpy as np
-input_start=202
-input_end=215
+from parmela_scan import zipped, run_options, run_scan, save_table
+
+deck = 'rr3.inp'
+# coil start at 24, end on 270. 24~26: cathode; 27~34: gun; 35~44 trans
+# 45~270 focusing channel
+input_start = 202
+input_end = 215
+new_col = 4  # 5th column, 4 is inital phase, 5 is gradient;;;2 is the scale coil;;;; 2 is scale gun magnet
+num_row = input_end - input_start + 1
+
+# the following lines define the range of the scan
+nsteps = 13
+inival = 50  # ;;460
+diff = 0  # ;;25
+delval = 10
+newfold = 'buncher'
+keep_files = ('TIMESTEPEMITTANCE.TBL', 'OUTPAR.TXT')
+
+scan_field = f'L{input_start}:{new_col}'
+
+
+def coil_fields(point):
+    # the ramp over the other coil lines, and the line two above the first coil at val + 90
+    val = point[scan_field]
+    fields = {f'L{input_start + k}:{new_col}': val + k * diff / num_row for k in range(1, num_row)}
+    fields[f'L{input_start - 2}:{new_col}'] = val + 90
+    return fields
+
 
-start_row = input_start-1#74 #
-num_row=input_end-start_row#350 end
-new_col = 4 #5th column, 4 is inital phase ,5 is gradient ;;;2 is the scale coil;;;; 2 is scale gun magnet
-row_array=[]
-for n in range(num_row):
-    row_array.append(start_row)
-    start_row+=1
-#the following 3 lines define the range of phase in the scan.
-    #coil start at 24, end on 270. 24~26: cathode; 27~34: gun; 35~44 trans
-    #45~270 focusing channel
-nsteps= 13 #from 0.1 to 10; 2.62 is 133G
-inival =50 #;;460
-diff=0#;;25
-delval=10
-endval=inival+diff
-filename='rr3.inp'
-val = inival
-newValueIndex = 0
-while newValueIndex < nsteps:
-    test5file = open(filename,'r')
-    lines = test5file.readlines()
-    test5file.close()
-    test5file2=open(filename,'w')
-    # modifiy line 44, number 8
-    k=0
-    for line in row_array:        
-        new_line = string.split(lines[line])
-        new_line[new_col] = str(val+k*diff/num_row)
-        new_line = string.join(new_line) + '\n'
-        lines[line] = new_line
-        k+=1
-	print(row_array[0])
-	stline=string.split(lines[row_array[0]-2])
-	print(stline[new_col])
-	stline[new_col]=str(val+90)
-	stline=string.join(stline)+'\n'
-	lines[row_array[0]-2]=stline
-	
-    test5file2.writelines(lines)
-    test5file2.close()
-       
-    os.system('parmela '+filename)
-	#os.system('echo '+str(val)+' >> tmpeng')
-    #os.system('sed -n $,+0p TIMESTEPEMITTANCE.TBL >> tmpeng')
-    #os.system('sed -n \'8000,+0p\' TIMESTEPEMITTANCE.TBL')
-    os.system('mv TIMESTEPEMITTANCE.TBL TIMESTEPEMITTANCE'+str(val)+'.TBL')
-    os.system('mv OUTPAR.TXT OUTPAR'+str(val)+'.TXT')
-    #os.system('~/RTX/qplot')
-    #os.system('mv emit4d.agr emit4d'+str(val)+'.agr')
-    #os.system('mv emitn.agr emitn'+str(val)+'.agr')
-    newValueIndex = newValueIndex+1
-    val = val + delval
-    print 'index: ',val
-newfold='buncher'
-os.system('mkdir '+newfold)
-os.system('mv TIMES*.TBL '+newfold)
-os.system('mv OUTPAR*.TXT '+newfold)
-#os.system('mv emit4d*.agr '+newfold)
-#os.system('mv emitn*.agr '+newfold)
-os.system('cp '+filename+' '+newfold)
+def main(argv):
+    argv = list(argv)
+    options = run_options(argv, os.path.join(newfold, 'scan.txt'))
+    deck_path = argv[0] if argv else deck
+    points = zipped({scan_field: inival + np.arange(nsteps) * delval})
+    out = options.pop('out')
+    keep = options.pop('keep')
+    os.makedirs(newfold, exist_ok=True)
+    table = run_scan(deck_path, points, derive=coil_fields, keep=True, **options)
+    for val, workdir in zip(table[scan_field], table['workdir']):
+        for name in keep_files:
+            src = os.path.join(workdir, name)
+            if os.path.exists(src):
+                stem, ext = os.path.splitext(name)
+                shutil.copyfile(src, os.path.join(newfold, f'{stem}{val:g}{ext}'))
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if not keep:
+        table = table.drop(columns='workdir')
+    save_table(table, out)
+    shutil.copyfile(deck_path, os.path.join(newfold, os.path.basename(deck_path)))
+    print(f"{int(table['ok'].sum())} of {len(table)} points ok, table written to {out}")
+    return table
 
 
-#os.system('paste tmpphase tmpeng > engout')
-#os.system('rm tmpeng tmpphase')
-#os.system('mv engout '+newfold)
+if __name__ == '__main__':
+    main(sys.argv[1:])
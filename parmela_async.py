@@ -0,0 +1,203 @@
+'''parmela tool, asyncio runner that keeps PARMELA busy during a batch.
+
+With a blocking runner the driver does nothing else while parmela runs, and
+nothing runs while the driver writes the next perturbed deck or parses a
+finished table. Here one event loop drives three stages at the same time:
+
+    prepare   writes the deck of the next case (thread pool), up to `workers`
+              cases ahead of the runs
+    run       asyncio.create_subprocess_exec, at most `workers` at a time
+              (semaphore-bounded); a slot is freed as soon as parmela exits
+    parse     reads the finished case's outputs (thread pool) while the
+              other cases keep running; finish() then gets the parsed value
+              in the event loop thread, one case at a time
+
+States are written to the same ledger as parmela_queue.WorkQueue, so a study
+started with one queue can be resumed with the other.
+
+Usage:
+    queue = AsyncQueue(Ledger('error_1a2b3c4d.ledger'), workers=8, timeout=3600)
+    done, failed = queue.run(range(1, 501), prepare, parse, finish)
+'''
+import time
+import asyncio
+import subprocess
+from parmela_queue import WORKERS
+from parmela_runner import parmela_command, log_paths, file_stamps, collect_result
+from parmela_trace import tags, record_run, maxrss_mb
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def children_usage():
+    # (CPU seconds, peak RSS in MB) of the children reaped so far, or (None, None)
+    if resource is None:
+        return None, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime, maxrss_mb(usage)
+
+
+async def run_parmela_async(workdir, deck_name, command=None, timeout=None, check=True):
+    """
+    Runs parmela on deck_name with workdir as its working directory, without
+    blocking the event loop. Same arguments and result as
+    parmela_runner.run_parmela(); on a timeout the run is killed and
+    subprocess.TimeoutExpired is raised.
+
+    The event loop reaps the child, so its trace record has the CPU time of
+    all children that exited during the run (see parmela_trace).
+    """
+    args = parmela_command(command) + [deck_name]
+    stdout, stderr = log_paths(workdir, deck_name)
+    before = file_stamps(workdir)
+    cpu0, _ = children_usage()
+    start, t0 = time.time(), time.perf_counter()
+    with open(stdout, 'wb') as out, open(stderr, 'wb') as err:
+        proc = await asyncio.create_subprocess_exec(*args, cwd=workdir, stdout=out, stderr=err)
+        try:
+            await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            result = collect_result(workdir, deck_name, proc.returncode, time.perf_counter() - t0, before)
+            record_run(result, start, status="timeout")
+            raise subprocess.TimeoutExpired(args, timeout)
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+    result = collect_result(workdir, deck_name, proc.returncode, time.perf_counter() - t0, before)
+    cpu, rss = children_usage()
+    record_run(result, start, cpu=None if cpu is None else cpu - cpu0, rss=rss)
+    if check and not result.ok:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+    return result
+
+
+class AsyncQueue:
+    """
+    Runs a batch of cases with prepare/run/parse overlapped.
+
+    Args:
+        ledger (parmela_queue.Ledger): Where job states are recorded.
+        workers (int): parmela runs at the same time.
+        timeout (float): Wall-clock seconds a run may take, None for no limit.
+        retries (int): How often a failed or timed-out job is started again.
+        command (str or list): The parmela command, see parmela_runner.parmela_command().
+    """
+
+    def __init__(self, ledger, workers=WORKERS, timeout=None, retries=1, command=None):
+        self.ledger = ledger
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self.retries = retries
+        self.command = command
+
+    def run(self, jobs, prepare, parse, finish, skip=()):
+        """
+        Runs every job not finished in the ledger.
+
+        Args:
+            jobs (iterable): Job ids (JSON-serializable).
+            prepare (callable): prepare(job) -> (workdir, deck_name), called in a
+                worker thread; writes the deck of the job.
+            parse (callable): parse(job, args, result) -> value, called in a
+                worker thread with the RunResult of a successful run.
+            finish (callable): finish(job, args, value), called in the event
+                loop thread, one job at a time (e.g. appends to a results store).
+            skip (iterable): More job ids to treat as finished.
+
+        Returns:
+            tuple: (done, failed) lists of job ids handled in this call.
+        """
+        jobs = list(jobs)
+        finished = self.ledger.done() | set(skip)
+        todo = [job for job in jobs if job not in finished]
+        if len(todo) < len(jobs):
+            print(f"Resuming: {len(jobs) - len(todo)} jobs already finished, {len(todo)} to run")
+        return asyncio.run(self._run(todo, prepare, parse, finish))
+
+    async def _run(self, todo, prepare, parse, finish):
+        loop = asyncio.get_running_loop()
+        waiting = asyncio.Queue()  # job ids to prepare, retries go to the back
+        ready = asyncio.Queue(maxsize=self.workers)  # prepared (job, args), one slot each ahead of the runs
+        slots = asyncio.Semaphore(self.workers)
+        attempts, running = {}, {}
+        done, failed = [], []
+        remaining = len(todo)
+        all_done = asyncio.Event()
+        for job in todo:
+            waiting.put_nowait(job)
+        if not todo:
+            return done, failed
+
+        def settle(job, error=None, wall=None):
+            nonlocal remaining
+            if error is None:
+                self.ledger.record(job, "done", attempt=attempts[job], wall=wall)
+                done.append(job)
+            else:
+                state = "timeout" if isinstance(error, subprocess.TimeoutExpired) else "failed"
+                self.ledger.record(job, state, attempt=attempts[job], error=str(error))
+                if attempts[job] <= self.retries:
+                    print(f"Job {job} {state} ({error}), retrying")
+                    waiting.put_nowait(job)
+                    return
+                print(f"Job {job} {state} after {attempts[job]} attempts: {error}")
+                failed.append(job)
+            remaining -= 1
+            if remaining == 0:
+                all_done.set()
+
+        async def preparer():
+            while True:
+                job = await waiting.get()
+                attempts[job] = attempts.get(job, 0) + 1
+                try:
+                    args = await loop.run_in_executor(None, prepare, job)
+                except Exception as e:
+                    settle(job, e)
+                    continue
+                await ready.put((job, args))
+
+        async def case(job, args):
+            # holds the run slot taken by the dispatcher until parmela exits
+            try:
+                self.ledger.record(job, "running", attempt=attempts[job])
+                running[job] = args
+                try:
+                    with tags(job=job, attempt=attempts[job]):
+                        result = await run_parmela_async(args[0], args[1], self.command, self.timeout)
+                finally:
+                    del running[job]
+                    slots.release()
+                value = await loop.run_in_executor(None, parse, job, args, result)
+                finish(job, args, value)
+            except Exception as e:
+                settle(job, e)
+                return
+            settle(job, wall=result.wall)
+
+        async def dispatcher():
+            while True:
+                job, args = await ready.get()
+                await slots.acquire()
+                task = asyncio.create_task(case(job, args))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        tasks = set()
+        stages = [asyncio.create_task(preparer()), asyncio.create_task(dispatcher())]
+        try:
+            await all_done.wait()
+        except asyncio.CancelledError:
+            for job in list(running):
+                self.ledger.record(job, "interrupted", attempt=attempts[job])
+            raise
+        finally:
+            for task in stages + list(tasks):
+                task.cancel()
+            await asyncio.gather(*stages, *tasks, return_exceptions=True)
+        return done, failed
@@ -0,0 +1,354 @@
+'''parmela tool, benchmarks of the Python overhead around PARMELA runs.
+
+Times every stage a study spends outside PARMELA on fixed fixtures: the
+rr6.inp deck, the error.yaml settings and synthetic TIMESTEPEMITTANCE tables
+of 1k, 10k and 100k rows (written in the parmela_sim layout). Stages:
+
+    deck.*     parsing, section phase changes (autophase), perturbed decks (error_ana_pal_v2)
+    stage.*    work directory staging from the pool, against plain copies of the maps
+    tbl.*      full table reads, final rows and decimated orbits
+    store.*    results store appends, orbit figure (error_ana_pal_v2)
+    lattice.*  deck and beam-table parsing of parmela_lattice
+    e2e.*      a small error study through the runner, with parmela_sim as
+               the parmela: prepare / parse / cleanup time per run
+
+The end-to-end stage also reports runs/hour and the overhead per run (the
+part of a case that is not PARMELA). PARMELA_SIM_TIME sets the runtime of the
+stand-in. The runs of the benchmark are not written to the run trace.
+
+The median of --repeat timings is compared to a stored baseline
+(bench_baseline.json); a stage more than --tolerance slower than its baseline
+is reported as a regression and the exit code is 1.
+
+Usage:
+    python parmela_bench.py                    # run and compare to the baseline
+    python parmela_bench.py --save             # run and store as the new baseline
+    python parmela_bench.py --only tbl,deck --repeat 5
+    python parmela_bench.py --runs 16 --workers 4
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import contextlib
+import tempfile
+import numpy as np
+import yaml
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from parmela_deck import Deck
+from parmela_table import read_table, final_row
+from parmela_runner import WORKERS, make_workdir, remove_workdir, run_parmela
+from parmela_store import ResultStore, OrbitEnvelope, decimate_orbit
+from parmela_sim import SimDeck, NAMES, write_table
+import parmela_lattice
+import parmela_trace
+import error_ana_pal_v2 as study
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DECK = os.path.join(HERE, "rr6.inp")
+SETTINGS = os.path.join(HERE, "error.yaml")
+SIMULATOR = [sys.executable, os.path.join(HERE, "parmela_sim.py")]
+BASELINE = "bench_baseline.json"
+ROWS = (1000, 10000, 100000)
+MAP_SIZE = 4 * 2 ** 20  # bytes of each synthetic field map
+STORE_CASES = 100
+NOT_COMPARED = ("e2e.parmela", "runs_per_hour")  # the stand-in's own runtime, not our overhead
+
+
+class Fixtures:
+    """
+    The inputs of the stages, written once into a scratch folder.
+
+    Args:
+        root (str): The scratch folder.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.deck = os.path.join(root, "rr6.inp")
+        shutil.copyfile(DECK, self.deck)
+        with open(SETTINGS) as f:
+            self.params = yaml.safe_load(f)
+        with open(self.deck, 'r') as f:
+            elements, _ = study.find_ele_ind(f.readlines())
+        self.columns = study.error_columns(elements)
+        self.plan = study.perturbation_matrix(self.columns, self.params, 8, 1)
+        rng = np.random.default_rng(1)
+        for name in ("BENCH1.T7", "BENCH2.T7", "BENCH3.T7"):
+            with open(os.path.join(root, name), 'wb') as f:
+                f.write(rng.bytes(MAP_SIZE))
+        sim = SimDeck(self.deck)
+        self.tables = {}
+        for n in ROWS:
+            rows = rng.normal(size=(n, len(NAMES)))
+            rows[:, 0] = np.linspace(0, 70000, n)
+            rows[:, 1] = np.linspace(0, 2500, n)
+            path = os.path.join(root, f"TIMESTEPEMITTANCE_{n}.TBL")
+            write_table(path, sim, f"synthetic, {n} rows", rows)
+            self.tables[n] = path
+
+    def pert(self, k):
+        return dict(zip([name for name, _ in self.columns], self.plan[k % len(self.plan)]))
+
+
+def median_time(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times))
+
+
+# --- Stages: each returns the callable that is timed ---
+
+def deck_parse(fx):
+    return lambda: Deck(fx.deck)
+
+
+def deck_phase(fx):
+    # autophase.cngele: one section's phase fields changed, the deck rendered
+    deck = Deck(fx.deck)
+    idxs, counts = deck.rf_sections()
+    sect = int(np.argmax(counts))
+    lines = range(idxs[sect], idxs[sect] + counts[sect] + 1)
+    state = {"phase": 0.0}
+
+    def run():
+        state["phase"] += 1.0
+        for i in lines:
+            deck.set(i, 4, state["phase"])
+        deck.render()
+    return run
+
+
+def deck_perturb(fx):
+    folder = os.path.join(fx.root, "perturb")
+    os.makedirs(folder, exist_ok=True)
+    return lambda: study.apply_perturbations(fx.deck, folder, fx.pert(0))
+
+
+def error_plan(fx):
+    return lambda: study.perturbation_matrix(fx.columns, fx.params, 1000, 1)
+
+
+def stage_link(fx):
+    return lambda: remove_workdir(make_workdir(fx.root))
+
+
+def stage_copy(fx):
+    # what the drivers did before parmela_stage: copy every map into the case folder
+    def run():
+        folder = tempfile.mkdtemp(dir=fx.root)
+        for name in ("BENCH1.T7", "BENCH2.T7", "BENCH3.T7"):
+            shutil.copyfile(os.path.join(fx.root, name), os.path.join(folder, name))
+        shutil.rmtree(folder)
+    return run
+
+
+def tbl_read(n):
+    return lambda fx: (lambda: read_table(fx.tables[n]))
+
+
+def tbl_final(n):
+    return lambda fx: (lambda: final_row(fx.tables[n]))
+
+
+def tbl_orbit(n):
+    return lambda fx: (lambda: decimate_orbit(fx.tables[n], 10))
+
+
+def store_append(fx):
+    final = final_row(fx.tables[10000])
+    orbit = decimate_orbit(fx.tables[10000], 10)
+    path = os.path.join(fx.root, "bench_append.h5")
+
+    def run():
+        if os.path.exists(path):
+            os.remove(path)
+        with ResultStore(path) as store:
+            for k in range(1, STORE_CASES + 1):
+                store.append(k, fx.pert(k), final, orbit)
+    return run
+
+
+def store_figure(fx):
+    final = final_row(fx.tables[10000])
+    orbit = decimate_orbit(fx.tables[10000], 10)
+    path = os.path.join(fx.root, "bench_figure.h5")
+    with ResultStore(path) as store:
+        for k in range(1, STORE_CASES + 1):
+            store.append(k, fx.pert(k), final, orbit)
+    z_range = (orbit[0, 0], orbit[-1, 0])
+
+    def run():
+        cwd = os.getcwd()
+        os.chdir(fx.root)
+        try:
+            with ResultStore(path, 'r') as store, contextlib.redirect_stdout(open(os.devnull, 'w')):
+                orbits = OrbitEnvelope(STORE_CASES, z_range)
+                for k, orbit in store.orbits():
+                    orbits.add(int(k), orbit)
+                study.orbit_figure(orbits, "bench")
+        finally:
+            plt.close('all')
+            os.chdir(cwd)
+    return run
+
+
+def lattice_deck(fx):
+    return lambda: parmela_lattice.process_parmela_file(fx.deck)
+
+
+def lattice_beam(fx):
+    return lambda: parmela_lattice.process_beam_file(fx.tables[10000])
+
+
+STAGES = [
+    ("deck.parse", deck_parse),
+    ("deck.phase", deck_phase),
+    ("deck.perturb", deck_perturb),
+    ("deck.plan1000", error_plan),
+    ("stage.link", stage_link),
+    ("stage.copy", stage_copy),
+] + [(f"tbl.read.{n // 1000}k", tbl_read(n)) for n in ROWS] \
+  + [(f"tbl.final.{n // 1000}k", tbl_final(n)) for n in ROWS] \
+  + [(f"tbl.orbit.{n // 1000}k", tbl_orbit(n)) for n in ROWS] + [
+    (f"store.append{STORE_CASES}", store_append),
+    (f"store.figure{STORE_CASES}", store_figure),
+    ("lattice.deck", lattice_deck),
+    ("lattice.beam.10k", lattice_beam),
+]
+
+
+# --- End to end ---
+
+def end_to_end(fx, runs, workers):
+    """
+    A small error study: perturbed deck, parmela_sim run, final row and orbit
+    into a results store, folder removed.
+
+    Returns:
+        dict: Per-run seconds of the stages ('e2e.prepare', 'e2e.parmela',
+            'e2e.parse', 'e2e.cleanup', 'e2e.overhead') and 'runs_per_hour'.
+    """
+    store_path = os.path.join(fx.root, "bench_e2e.h5")
+    if os.path.exists(store_path):
+        os.remove(store_path)
+
+    def case(k):
+        t0 = time.perf_counter()
+        folder = make_workdir(fx.root)
+        pert = fx.pert(k)
+        deck_file = study.apply_perturbations(fx.deck, folder, pert)
+        t1 = time.perf_counter()
+        result = run_parmela(folder, os.path.basename(deck_file), command=SIMULATOR)
+        t2 = time.perf_counter()
+        tbl = study.case_table(result)
+        value = (pert, final_row(tbl), decimate_orbit(tbl, 10))
+        t3 = time.perf_counter()
+        remove_workdir(folder)
+        t4 = time.perf_counter()
+        return value, (t1 - t0, result.wall, t3 - t2, t4 - t3)
+
+    t0 = time.perf_counter()
+    times = []
+    with ResultStore(store_path) as store, ThreadPoolExecutor(max_workers=workers) as executor:
+        for k, ((pert, final, orbit), t) in enumerate(executor.map(case, range(1, runs + 1)), 1):
+            t_store = time.perf_counter()
+            store.append(k, pert, final, orbit)
+            times.append(t + (time.perf_counter() - t_store,))
+    wall = time.perf_counter() - t0
+    prepare, parmela, parse, cleanup, store_time = np.mean(times, axis=0)
+    return {"e2e.prepare": prepare, "e2e.parmela": parmela, "e2e.parse": parse + store_time,
+            "e2e.cleanup": cleanup, "e2e.overhead": prepare + parse + store_time + cleanup,
+            "runs_per_hour": runs / wall * 3600}
+
+
+# --- Report ---
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)["stages"]
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump({"stages": results, "python": platform.python_version(), "host": platform.node(),
+                   "numpy": np.__version__, "time": time.strftime("%Y-%m-%d %H:%M:%S")}, f, indent=1)
+
+
+def report(results, baseline, tolerance):
+    """Prints the timings against the baseline; returns the regressed stages."""
+    regressed = []
+    print(f"{'stage':<22}{'time (ms)':>12}{'baseline':>12}{'ratio':>8}")
+    for name, t in results.items():
+        if name == "runs_per_hour":
+            continue
+        base = baseline.get(name)
+        if base:
+            ratio = t / base
+            flag = "  SLOWER" if ratio > 1 + tolerance and name not in NOT_COMPARED else ""
+            if flag:
+                regressed.append(name)
+            print(f"{name:<22}{t * 1e3:12.2f}{base * 1e3:12.2f}{ratio:8.2f}{flag}")
+        else:
+            print(f"{name:<22}{t * 1e3:12.2f}{'-':>12}{'-':>8}")
+    if "runs_per_hour" in results:
+        print(f"\nruns/hour: {results['runs_per_hour']:.0f}, overhead per run: "
+              f"{results['e2e.overhead'] * 1e3:.1f} ms besides {results['e2e.parmela'] * 1e3:.1f} ms of parmela")
+    return regressed
+
+
+def main(argv):
+    argv = list(argv)
+
+    def option(flag, default, convert):
+        if flag not in argv:
+            return default
+        k = argv.index(flag)
+        value = argv[k + 1]
+        del argv[k:k + 2]
+        return convert(value)
+
+    save = '--save' in argv
+    repeat = option('--repeat', 3, int)
+    runs = option('--runs', 8, int)
+    workers = option('--workers', min(WORKERS, 8), int)
+    tolerance = option('--tolerance', 0.25, float)
+    baseline_path = option('--baseline', BASELINE, str)
+    only = option('--only', None, lambda s: tuple(s.split(',')))
+    parmela_trace.TRACE_FILE = None  # the benchmark's runs are not part of any study
+    root = tempfile.mkdtemp(prefix="parmela_bench_")
+    try:
+        print("Writing fixtures...")
+        fx = Fixtures(root)
+        results = {}
+        for name, stage in STAGES:
+            if only is None or name.startswith(only):
+                fn = stage(fx)
+                fn()  # warm-up: imports, page cache, schema memo
+                results[name] = median_time(fn, repeat)
+        if only is None or any("e2e".startswith(o) or o.startswith("e2e") for o in only):
+            results.update(end_to_end(fx, runs, workers))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    regressed = report(results, load_baseline(baseline_path), tolerance)
+    if save:
+        save_baseline(baseline_path, results)
+        print(f"Baseline saved to {baseline_path}")
+    elif regressed:
+        print(f"{len(regressed)} stages slower than the baseline by more than {tolerance:.0%}: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
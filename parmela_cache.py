@@ -0,0 +1,209 @@
+'''parmela tool, persistent content-addressed cache of PARMELA results.
+
+The optimizers often evaluate the same deck twice: the initial points of a
+fit, retries, or a finished correction run again with the same settings. A
+result is keyed by a hash of the normalized deck text plus the field maps
+(*.T7) and save files (SAVECO*) it depends on, so any change to the physics
+gives a new key while comment or whitespace edits do not.
+
+Each entry keeps the extracted summary (a small JSON dict, e.g. the final row
+of TIMESTEPEMITTANCE.TBL) and, optionally, copies of output files a driver
+needs afterwards. Entries are evicted least-recently-used once the cache
+grows beyond max_bytes.
+
+Usage:
+    cache = ResultCache()
+    key = cache.key('rr6_temp.inp')
+    result = cache.get(key)
+    if result is None:
+        ...run parmela...
+        cache.put(key, {'final': final_row('TIMESTEPEMITTANCE.TBL')})
+'''
+import os
+import re
+import glob
+import json
+import shutil
+import hashlib
+
+CACHE_DIR = os.environ.get("PARMELA_CACHE_DIR", ".parmela_cache")
+DEFAULT_MAX_BYTES = 1 << 30  # 1 GB
+CACHE_VERSION = 2  # bump when the normalization or the stored payload changes
+NO_CACHE_FLAG = "--no-cache"
+
+_field_file = re.compile(r'\.t7$', re.IGNORECASE)
+_file_hashes = {}
+
+
+def pop_no_cache_flag(argv):
+    """Removes '--no-cache' from argv in place; returns True if it was there."""
+    if NO_CACHE_FLAG in argv:
+        argv.remove(NO_CACHE_FLAG)
+        return True
+    return False
+
+
+def normalize_deck(text):
+    """
+    Reduces a deck to the part PARMELA actually reads: comment lines and
+    trailing '!'/';' comments are dropped and whitespace is collapsed.
+    """
+    out = []
+    for line in text.splitlines():
+        line = line.split('!', 1)[0].split(';', 1)[0]
+        words = line.split()
+        if words:
+            out.append(" ".join(words))
+    return "\n".join(out)
+
+
+def file_digest(path):
+    """sha256 of a file, memoized on (path, mtime, size) for large field maps."""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    digest = _file_hashes.get(memo_key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        _file_hashes[memo_key] = digest
+    return digest
+
+
+def field_files(normalized):
+    """Names of the field maps (*.T7) a normalized deck refers to."""
+    return sorted({word for line in normalized.splitlines() for word in line.split()
+                   if _field_file.search(word)})
+
+
+def referenced_files(normalized, workdir):
+    """
+    Field maps named in the deck, plus the SAVECO* files in workdir if the
+    deck restarts from a save instead of starting at the cathode. A deck that
+    starts fresh only writes its save files, so they are not inputs.
+    """
+    names = set(field_files(normalized))
+    first_run = None
+    for line in normalized.splitlines():
+        word = line.split()[0].lower()
+        if word in ("start", "restart"):
+            first_run = word
+            break
+    if first_run == "restart":
+        names.update(os.path.basename(p) for p in glob.glob(os.path.join(workdir, "SAVECO*")))
+    return sorted(names)
+
+
+class ResultCache:
+    """
+    Persistent, size-bounded cache of PARMELA results.
+
+    Args:
+        root (str): Cache directory; created on first put().
+        max_bytes (int): Total size above which least-recently-used entries
+            are evicted.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._total = None
+
+    def key(self, deck_path, workdir=None):
+        """
+        Content key of a deck as it would run in workdir (default: the
+        directory of the deck).
+        """
+        if workdir is None:
+            workdir = os.path.dirname(os.path.abspath(deck_path))
+        with open(deck_path, 'r', encoding='latin-1') as f:
+            return self.key_text(f.read(), workdir)
+
+    def key_text(self, text, workdir='.'):
+        """Content key of deck text as it would run in workdir."""
+        normalized = normalize_deck(text)
+        h = hashlib.sha256()
+        h.update(f"v{CACHE_VERSION}\n".encode())
+        h.update(normalized.encode('latin-1'))
+        for name in referenced_files(normalized, workdir):
+            path = os.path.join(workdir, name)
+            digest = file_digest(path) if os.path.exists(path) else "missing"
+            h.update(f"\n{name} {digest}".encode('latin-1'))
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def contains(self, key):
+        """True if an entry exists for key (does not count as a hit)."""
+        return os.path.exists(os.path.join(self._entry(key), "result.json"))
+
+    def get(self, key, workdir='.'):
+        """
+        Returns the stored result dict, or None on a miss. Files stored with
+        the entry are copied back into workdir.
+        """
+        entry = self._entry(key)
+        meta = os.path.join(entry, "result.json")
+        try:
+            with open(meta, 'r') as f:
+                stored = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        for name in stored.get("files", []):
+            shutil.copyfile(os.path.join(entry, name), os.path.join(workdir, name))
+        os.utime(meta)  # mark as recently used
+        self.hits += 1
+        return stored["result"]
+
+    def put(self, key, result, files=(), workdir='.'):
+        """
+        Stores a result dict and optional output files (names relative to
+        workdir), then evicts old entries if the cache is over its limit.
+        """
+        entry = self._entry(key)
+        os.makedirs(entry, exist_ok=True)
+        size = 0
+        for name in files:
+            dst = os.path.join(entry, os.path.basename(name))
+            shutil.copyfile(os.path.join(workdir, name), dst)
+            size += os.path.getsize(dst)
+        meta = os.path.join(entry, "result.json")
+        tmp = meta + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"result": result, "files": [os.path.basename(n) for n in files]}, f)
+        os.replace(tmp, meta)
+        size += os.path.getsize(meta)
+        if self._total is None:
+            self._total = sum(s for _, s, _ in self._entries())
+        else:
+            self._total += size
+        if self._total > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        for meta in glob.glob(os.path.join(self.root, "??", "*", "result.json")):
+            entry = os.path.dirname(meta)
+            size = sum(os.path.getsize(os.path.join(entry, n)) for n in os.listdir(entry))
+            yield os.path.getmtime(meta), size, entry
+
+    def evict(self):
+        """Removes least-recently-used entries until the cache fits max_bytes."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        self._total = total
+
+    def clear(self):
+        """Removes every entry."""
+        shutil.rmtree(self.root, ignore_errors=True)
+        self._total = 0
@@ -0,0 +1,372 @@
+'''parmela tool, restart-from-checkpoint execution for sectioned decks.
+
+Long decks are split into SCHEFF/START|restart/save sections; `save N` writes
+the particles to a SAVECO file and the next section's `restart ... N` reads
+them back. When an optimizer varies one element, everything upstream of the
+last save before that element is identical from trial to trial, so the
+trial can restart from that save instead of tracking from the cathode.
+
+A checkpoint is stored under a hash of everything that can influence the
+particles at `save N`: the header cards, the control cards up to `save N`,
+the upstream elements and the field maps they read. Changing any of these
+gives a new hash, so a stale checkpoint is never restored.
+
+A section is upstream of an element either because its `save` card comes
+before the element in the deck (elements interleaved with the sections), or,
+for decks that list all elements before the control cards, because the
+reference particle had not reached the element (less a safety margin for the
+bunch length) at the phase of `save N`. That Z is read from the
+TIMESTEPEMITTANCE.TBL of an earlier run.
+
+The SAVECO files are assumed to be one file per save index, as PARMELA writes
+them. After a run, all of them are snapshotted once into a content-addressed
+blob pool and every checkpoint produced by the run refers to those blobs.
+
+Usage:
+    store = CheckpointStore()
+    text, n = store.prepare(deck, varied_line, '.')
+    ...write text, run parmela...
+    store.record(deck, '.', 'TIMESTEPEMITTANCE.TBL', restarted_from=n)
+'''
+import os
+import glob
+import json
+import shutil
+import hashlib
+import numpy as np
+from parmela_cache import normalize_deck, field_files, file_digest
+
+CHECKPOINT_DIR = os.environ.get("PARMELA_CHECKPOINT_DIR", ".parmela_checkpoints")
+DEFAULT_MARGIN = 10.0  # cm of clearance between the saved reference particle and the varied element
+NO_CHECKPOINT_FLAG = "--no-checkpoint"
+CONTROL_KEYWORDS = ("scheff", "start", "restart", "save")
+
+
+def pop_no_checkpoint_flag(argv):
+    """Removes '--no-checkpoint' from argv in place; returns True if it was there."""
+    if NO_CHECKPOINT_FLAG in argv:
+        argv.remove(NO_CHECKPOINT_FLAG)
+        return True
+    return False
+
+
+def _words(text):
+    # card fields without the trailing '!' or ';' comment
+    return text.split('!', 1)[0].split(';', 1)[0].split()
+
+
+class Section:
+    """
+    One `START|restart ... / save N` section of a deck.
+
+    Attributes:
+        n (int): The save index.
+        first (int): First line index of the section (after the previous save).
+        run_line (int): Line index of the START or restart card.
+        save_line (int): Line index of the `save N` card.
+        phase (float): Phase T(deg) of the reference particle at `save N`.
+        reads (int or None): Save index the restart card reads, None for START.
+    """
+
+    def __init__(self, n, first, run_line, save_line, phase, reads):
+        self.n = n
+        self.first = first
+        self.run_line = run_line
+        self.save_line = save_line
+        self.phase = phase
+        self.reads = reads
+
+    def __repr__(self):
+        return f"Section(n={self.n}, save_line={self.save_line}, reads={self.reads})"
+
+
+def sections(deck):
+    """
+    Parses the active START/restart/save cards of a deck in file order.
+
+    Returns:
+        list: Section objects, one per `save` card that follows a run card.
+    """
+    out = []
+    phase = 0.0
+    first = 0
+    run_line = reads = None
+    for i, raw in enumerate(deck.lines):
+        words = _words(deck.line(i))
+        if not words:
+            continue
+        key = words[0].lower()
+        try:
+            if key == "start":
+                # START Phi_0 Delta_Phi NumberOfSteps ...
+                phase = float(words[1]) + float(words[2]) * float(words[3])
+                run_line, reads = i, None
+            elif key == "restart":
+                # restart Delta_Phi NumberOfSteps SpaceChargeSteps OutputSteps ? N
+                phase += float(words[1]) * float(words[2])
+                run_line = i
+                reads = int(words[6]) if len(words) > 6 else None
+            elif key == "save" and run_line is not None:
+                out.append(Section(int(words[1]), first, run_line, i, phase, reads))
+                first = i + 1
+                run_line = None
+        except (IndexError, ValueError):
+            continue
+    return out
+
+
+def element_positions(deck):
+    """
+    Start position Z (cm) of every element, from the cumulative element
+    lengths. Negative lengths (fields that extend upstream, e.g. poisson) do
+    not advance Z.
+
+    Returns:
+        dict: element line index -> Z start (cm).
+    """
+    z = 0.0
+    pos = {}
+    for e in deck.elements:
+        pos[e.line] = z
+        try:
+            length = float(deck.fields(e.line)[1])
+        except (IndexError, ValueError):
+            length = 0.0
+        if length > 0:
+            z += length
+    return pos
+
+
+def _element_groups(deck):
+    # (first, last) line range of each element card and its continuation cards
+    starts = [e.line for e in deck.elements]
+    groups = {}
+    for k, first in enumerate(starts):
+        last = starts[k + 1] - 1 if k + 1 < len(starts) else len(deck.lines) - 1
+        groups[first] = last
+    return groups
+
+
+def phase_z(tbl_path):
+    """
+    Reads the T(deg) and Z(cm) columns (the first two) of a TIMESTEPEMITTANCE
+    table.
+
+    Returns:
+        tuple: (phase, z) arrays, or (None, None) if the table has no rows.
+    """
+    phase, z = [], []
+    with open(tbl_path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 2:
+                continue
+            try:
+                t, zz = float(parts[0]), float(parts[1])
+            except ValueError:
+                continue
+            phase.append(t)
+            z.append(zz)
+    if not phase:
+        return None, None
+    return np.array(phase), np.array(z)
+
+
+class CheckpointStore:
+    """
+    Content-addressed store of SAVECO snapshots.
+
+    Args:
+        root (str): Store directory.
+        margin (float): Clearance (cm) required between the reference
+            particle at `save N` and the start of the varied element.
+    """
+
+    def __init__(self, root=CHECKPOINT_DIR, margin=DEFAULT_MARGIN):
+        self.root = root
+        self.margin = margin
+        self.restarts = 0
+
+    # --- Keys ---
+
+    def geometry_key(self, deck):
+        """Hash of the element lengths and run cards, which fix save-phase Z."""
+        h = hashlib.sha256()
+        for e in deck.elements:
+            h.update((" ".join(_words(deck.line(e.line))[:2]) + "\n").encode('latin-1'))
+        for s in sections(deck):
+            h.update((" ".join(_words(deck.line(s.run_line))) + "\n").encode('latin-1'))
+        return h.hexdigest()
+
+    def _zmap_path(self, deck):
+        return os.path.join(self.root, "zmap", self.geometry_key(deck) + ".json")
+
+    def save_positions(self, deck):
+        """Returns {N: Z (cm) of the reference particle at save N} known so far."""
+        try:
+            with open(self._zmap_path(deck), 'r') as f:
+                return {int(k): v for k, v in json.load(f).items()}
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _upstream_lines(self, deck, sect, zsave, positions, groups):
+        skip = set()
+        if zsave is not None:
+            for e in deck.elements:
+                if e.line < sect.save_line and positions[e.line] > zsave + self.margin:
+                    skip.update(range(e.line, groups[e.line] + 1))
+        return [deck.line(i) for i in range(sect.save_line + 1) if i not in skip]
+
+    def upstream_key(self, deck, sect, zsave=None, positions=None, groups=None):
+        """
+        Hash of everything upstream of `save N`. For decks with all elements
+        before the control cards, elements starting beyond zsave + margin are
+        left out, so varying them keeps the checkpoint valid.
+        """
+        if positions is None:
+            positions = element_positions(deck)
+        if groups is None:
+            groups = _element_groups(deck)
+        normalized = normalize_deck("\n".join(self._upstream_lines(deck, sect, zsave, positions, groups)))
+        h = hashlib.sha256()
+        h.update(f"save {sect.n}\n".encode())
+        h.update(normalized.encode('latin-1'))
+        workdir = os.path.dirname(os.path.abspath(deck.path))
+        for name in field_files(normalized):
+            path = os.path.join(workdir, name)
+            digest = file_digest(path) if os.path.exists(path) else "missing"
+            h.update(f"\n{name} {digest}".encode('latin-1'))
+        return h.hexdigest()
+
+    def _manifest(self, key):
+        return os.path.join(self.root, key[:2], key + ".json")
+
+    # --- Planning ---
+
+    def find(self, deck, line):
+        """
+        Finds the last stored checkpoint upstream of the element at line.
+
+        Returns:
+            Section or None: The section whose save can be restarted from.
+        """
+        secs = sections(deck)
+        zsaves = self.save_positions(deck)
+        positions = element_positions(deck)
+        groups = _element_groups(deck)
+        zline = positions.get(line)
+        for k in range(len(secs) - 1, -1, -1):
+            sect = secs[k]
+            # the next section must restart from this save
+            if k + 1 >= len(secs) or secs[k + 1].reads != sect.n:
+                continue
+            if deck.end_at is not None and secs[k + 1].run_line >= deck.end_at:
+                continue
+            zsave = zsaves.get(sect.n)
+            if sect.save_line < line:
+                zsave = None
+            elif zsave is None or zline is None or zsave + self.margin >= zline:
+                continue
+            key = self.upstream_key(deck, sect, zsave, positions, groups)
+            if os.path.exists(self._manifest(key)):
+                return sect
+        return None
+
+    def restart_text(self, deck, sect):
+        """Deck text that restarts from `save N`: earlier control cards are commented out."""
+        skip = []
+        for i in range(sect.save_line + 1):
+            words = _words(deck.lines[i])
+            if words and words[0].lower() in CONTROL_KEYWORDS:
+                skip.append(i)
+        return deck.render(comment=skip)
+
+    def prepare(self, deck, line, workdir='.'):
+        """
+        Chooses how to run a trial that varies the element at line.
+
+        Returns:
+            tuple: (deck text to run, save index restarted from or None).
+        """
+        sect = self.find(deck, line)
+        if sect is None:
+            return deck.render(), None
+        self.restore(deck, sect, line, workdir)
+        self.restarts += 1
+        return self.restart_text(deck, sect), sect.n
+
+    def restore(self, deck, sect, line, workdir):
+        """Copies the SAVECO files of the checkpoint found for line into workdir."""
+        zsave = None if sect.save_line < line else self.save_positions(deck).get(sect.n)
+        key = self.upstream_key(deck, sect, zsave)
+        with open(self._manifest(key), 'r') as f:
+            manifest = json.load(f)
+        for name, digest in manifest["files"].items():
+            dst = os.path.join(workdir, name)
+            if os.path.exists(dst):
+                os.remove(dst)
+            shutil.copyfile(os.path.join(self.root, "blobs", digest), dst)
+        os.utime(self._manifest(key))
+
+    # --- Recording ---
+
+    def record(self, deck, workdir, tbl_path, restarted_from=None):
+        """
+        Snapshots the SAVECO files of a finished run and registers every
+        checkpoint the run produced.
+
+        Args:
+            deck (Deck): The deck as it was run (before restart commenting).
+            workdir (str): The run directory.
+            tbl_path (str): Its TIMESTEPEMITTANCE.TBL, used to place the saves in Z.
+            restarted_from (int or None): The save the run restarted from.
+        """
+        names = sorted(os.path.basename(p) for p in glob.glob(os.path.join(workdir, "SAVECO*")))
+        if not names:
+            return
+        secs = sections(deck)
+        produced = []
+        passed = restarted_from is None
+        for sect in secs:
+            if deck.end_at is not None and sect.save_line >= deck.end_at:
+                break
+            if passed:
+                produced.append(sect)
+            elif sect.n == restarted_from:
+                passed = True
+        if not produced:
+            return
+
+        zsaves = self.save_positions(deck)
+        if os.path.exists(tbl_path):
+            phase, z = phase_z(tbl_path)
+            if phase is not None:
+                for sect in produced:
+                    if phase[0] <= sect.phase <= phase[-1]:
+                        zsaves[sect.n] = float(np.interp(sect.phase, phase, z))
+                path = self._zmap_path(deck)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    json.dump(zsaves, f)
+
+        blobs = os.path.join(self.root, "blobs")
+        os.makedirs(blobs, exist_ok=True)
+        files = {}
+        for name in names:
+            src = os.path.join(workdir, name)
+            digest = file_digest(src)
+            if not os.path.exists(os.path.join(blobs, digest)):
+                shutil.copyfile(src, os.path.join(blobs, digest))
+            files[name] = digest
+
+        positions = element_positions(deck)
+        groups = _element_groups(deck)
+        for sect in produced:
+            # registered both by Z and by deck position: find() uses the latter
+            # when the varied element comes after the save card
+            for z in {zsaves.get(sect.n), None}:
+                key = self.upstream_key(deck, sect, z, positions, groups)
+                path = self._manifest(key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    json.dump({"n": sect.n, "files": files}, f)
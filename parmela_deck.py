@@ -0,0 +1,366 @@
+'''parmela tool, parsed in-memory model of a PARMELA input deck.
+
+The optimizers (autophase, autocorrection, optimize, scan) change a handful of
+fields per objective evaluation. Rereading and rescanning the whole deck for
+every change is the dominant Python cost of a session, so the deck is parsed
+once here: element records, line offsets, `!@var`/`!@subs` bindings and
+`!cor` markers. Fields are changed in memory and only the touched lines are
+re-rendered when the deck is flushed back to disk.
+
+Usage:
+    deck = Deck('rr6.inp')
+    idxs, counts = deck.rf_sections()
+    deck.set(idxs[0], 4, 120.0)
+    deck.flush('rr6_temp.inp')
+'''
+import os
+
+# Keywords of the deck cards that are beamline elements. The first field after
+# the keyword is the element length in cm.
+ELEMENT_KEYWORDS = ("drift", "solenoid", "cell", "trwave", "quad", "steerer",
+                    "bend", "poisson", "cathode")
+
+# Decks are plain ASCII in principle, but hand-edited ones carry stray bytes
+# (see the 'rU' note in optimize.getvar). latin-1 round-trips any byte.
+ENCODING = "latin-1"
+
+
+class Element:
+    """One beamline element card of the deck."""
+
+    def __init__(self, kind, line):
+        self.kind = kind
+        self.line = line
+
+    def __repr__(self):
+        return f"Element({self.kind!r}, line={self.line})"
+
+
+class Subs:
+    """
+    One `!@subs <count> <col> <mark> [<col> <mark>] [element <n>]` binding.
+
+    Attributes:
+        line (int): Line index of the `!@subs` comment itself.
+        count (int): Number of following lines the binding applies to.
+        pairs (list): (column, mark) tuples. A mark of '-name' writes the
+            negated value of variable 'name'.
+        element (int or None): Element number given after 'element', if any.
+    """
+
+    def __init__(self, line, count, pairs, element=None):
+        self.line = line
+        self.count = count
+        self.pairs = pairs
+        self.element = element
+
+    def __repr__(self):
+        return f"Subs(line={self.line}, count={self.count}, pairs={self.pairs})"
+
+
+class Deck:
+    """
+    A PARMELA input deck parsed once and edited in memory.
+
+    Args:
+        path (str): The deck to read. flush() writes back to it unless told
+            otherwise.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'r', encoding=ENCODING) as f:
+            self.lines = f.read().splitlines()
+        self._tokens = {}
+        self._dirty = set()
+        self._commented = set()
+        self.end_at = None
+        self._synced = True
+        self._parse()
+
+    # --- Parsing ---
+
+    def _parse(self):
+        self.elements = []
+        self.var_lines = []
+        self.subs = []
+        self.cor = []
+        self.mainfreq = None
+        for i, raw in enumerate(self.lines):
+            words = raw.split()
+            if not words:
+                continue
+            key = words[0].lower()
+            if key in ELEMENT_KEYWORDS:
+                self.elements.append(Element(key, i))
+            elif key == "run" and len(words) > 3:
+                try:
+                    self.mainfreq = float(words[3])
+                except ValueError:
+                    pass
+            elif key == "!@var":
+                self.var_lines.append(i)
+            elif key == "!@subs":
+                self.subs.append(self._parse_subs(i, words))
+            elif key.startswith("!cor"):
+                self.cor.append(i)
+
+    @staticmethod
+    def _parse_subs(i, words):
+        rest = words[2:]
+        element = None
+        if "element" in rest:
+            k = rest.index("element")
+            if k + 1 < len(rest):
+                element = int(rest[k + 1])
+            rest = rest[:k]
+        pairs = [(int(rest[j]), rest[j + 1]) for j in range(0, len(rest) - 1, 2)]
+        return Subs(i, int(words[1]), pairs, element)
+
+    # --- Queries ---
+
+    def find(self, kind):
+        """Returns the line indices of all elements of the given kind."""
+        kind = kind.lower()
+        return [e.line for e in self.elements if e.kind == kind]
+
+    def beamline_length(self):
+        """
+        Returns the summed length (cm) of the elements before the first `end`
+        card (the poisson gun card has no length).
+        """
+        end = len(self.lines) if self.end_at is None else self.end_at
+        for i, raw in enumerate(self.lines[:end]):
+            words = raw.split()
+            if words and words[0].lower() == "end":
+                end = i
+                break
+        total = 0.0
+        for e in self.elements:
+            if e.line >= end:
+                break
+            if e.kind == "poisson" or e.line in self._commented:
+                continue
+            try:
+                total += float(self.fields(e.line)[1])
+            except (IndexError, ValueError):
+                pass
+        return total
+
+    def rf_sections(self):
+        """
+        Finds every accelerating section: a 'cell' card directly followed by
+        one or more 'trwave' cards.
+
+        Returns:
+            tuple: (list of cell line indices, list of trwave counts).
+        """
+        idxs, counts = [], []
+        n = len(self.lines)
+        for e in self.elements:
+            i = e.line
+            if e.kind != "cell" or i + 1 >= n or not self._startswith(i + 1, "trwave"):
+                continue
+            c = 0
+            for j in range(i + 1, n):
+                if self._startswith(j, "trwave"):
+                    c += 1
+                else:
+                    break
+            idxs.append(i)
+            counts.append(c)
+        return idxs, counts
+
+    def _startswith(self, i, keyword):
+        return self.lines[i].lower().startswith(keyword)
+
+    def variables(self):
+        """
+        Returns all `!@var` definitions in file order as a list of dicts with
+        keys 'active', 'mark', 'step', 'left', 'right' (raw strings).
+        """
+        out = []
+        for i in self.var_lines:
+            var = self.lines[i].split()
+            if len(var) >= 6:
+                out.append({"active": var[1] == '1', "mark": var[2], "step": var[3],
+                            "left": var[4], "right": var[5]})
+        return out
+
+    def active_vars(self):
+        """
+        The `!@var 1` variables that are bound by at least one `!@subs` line.
+
+        Returns:
+            tuple: (mark, step, left_range, right_range, pos), the same lists
+                optimize.getvar has always returned.
+        """
+        active = {v["mark"]: v for v in self.variables() if v["active"]}
+        mark, pos = [], []
+        for s in self.subs:
+            for _, m in s.pairs:
+                if m in active:
+                    mark.append(m)
+                    if s.element is not None:
+                        pos.append(s.element)
+        step = [active[m]["step"] for m in mark]
+        left_range = [active[m]["left"] for m in mark]
+        right_range = [active[m]["right"] for m in mark]
+        return mark, step, left_range, right_range, pos
+
+    # --- Field access ---
+
+    def fields(self, i):
+        """Returns the whitespace-split fields of line i (do not mutate)."""
+        tokens = self._tokens.get(i)
+        if tokens is None:
+            tokens = self.lines[i].split()
+        return tokens
+
+    def get(self, i, col):
+        """Returns field col of line i as a float."""
+        return float(self.fields(i)[col])
+
+    def set(self, i, col, value):
+        """
+        Sets field col of line i. The line is re-rendered on the next flush.
+
+        Args:
+            i (int): Line index.
+            col (int): Field index (0 is the keyword).
+            value: New value; written with str().
+        """
+        tokens = self._tokens.get(i)
+        if tokens is None:
+            tokens = self.lines[i].split()
+            self._tokens[i] = tokens
+        value = str(value)
+        if tokens[col] != value:
+            tokens[col] = value
+            self._dirty.add(i)
+
+    def rewrite_var(self, mark, value):
+        """
+        Writes value into every field bound to `mark` by a `!@subs` line, and
+        the negated value into fields bound to '-mark'.
+        """
+        neg = '-' + mark
+        for s in self.subs:
+            for col, m in s.pairs:
+                if m == mark:
+                    v = value
+                elif m == neg:
+                    v = str(-1 * float(value))
+                else:
+                    continue
+                for k in range(s.line + 1, min(s.line + 1 + s.count, len(self.lines))):
+                    self.set(k, col, v)
+
+    # --- Structural edits (rendered as overlays, line indices never shift) ---
+
+    def comment_out(self, i):
+        """Prefixes line i with '!' unless it is blank or already a comment."""
+        stripped = self.lines[i].strip()
+        if stripped and not stripped.startswith('!') and i not in self._commented:
+            self._commented.add(i)
+            self._synced = False
+
+    def uncomment(self, i):
+        """Removes a '!' added by comment_out()."""
+        if i in self._commented:
+            self._commented.discard(i)
+            self._synced = False
+
+    def commented(self):
+        """Returns the sorted line indices commented out by comment_out()."""
+        return sorted(self._commented)
+
+    def set_end(self, i):
+        """Emits an 'end' card before line i on flush (None removes it)."""
+        if i != self.end_at:
+            self.end_at = i
+            self._synced = False
+
+    # --- Output ---
+
+    def line(self, i):
+        """Returns the current text of line i, without the newline."""
+        if i in self._dirty:
+            self.lines[i] = " ".join(self._tokens[i])
+            self._dirty.discard(i)
+            self._synced = False
+        text = self.lines[i]
+        if i in self._commented:
+            stripped = text.lstrip()
+            text = text[:len(text) - len(stripped)] + '!' + stripped
+        return text
+
+    def render(self, comment=()):
+        """
+        Returns the full deck text as it would be flushed.
+
+        Args:
+            comment (iterable): Extra line indices to comment out in this
+                rendering only (e.g. the sections skipped by a restart).
+        """
+        for i in list(self._dirty):
+            self.line(i)
+        comment = set(comment)
+        out = []
+        for i in range(len(self.lines)):
+            if i == self.end_at:
+                out.append("end")
+            text = self.line(i) if i in self._commented else self.lines[i]
+            if i in comment and i not in self._commented:
+                stripped = text.lstrip()
+                if stripped and not stripped.startswith('!'):
+                    text = text[:len(text) - len(stripped)] + '!' + stripped
+            out.append(text)
+        if self.end_at is not None and self.end_at >= len(self.lines):
+            out.append("end")
+        return "\n".join(out) + "\n"
+
+    def flush(self, path=None):
+        """
+        Writes the deck if anything changed since the last flush, or if a new
+        path is given.
+
+        Returns:
+            bool: True if the file was written.
+        """
+        if path is not None and path != self.path:
+            self.path = path
+            self._synced = False
+        if self._synced and not self._dirty:
+            return False
+        text = self.render()
+        with open(self.path, 'w', encoding=ENCODING) as f:
+            f.write(text)
+        self._synced = True
+        _cache[os.path.abspath(self.path)] = (_stamp(self.path), self)
+        return True
+
+
+# --- Shared deck cache ---
+
+_cache = {}
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def load_deck(path):
+    """
+    Returns the Deck for path, parsing it only if the file changed on disk
+    since it was last parsed or flushed.
+    """
+    key = os.path.abspath(path)
+    stamp = _stamp(path)
+    hit = _cache.get(key)
+    if hit is not None and hit[0] == stamp:
+        return hit[1]
+    deck = Deck(path)
+    _cache[key] = (stamp, deck)
+    return deck
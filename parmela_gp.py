@@ -0,0 +1,169 @@
+'''parmela tool, Gaussian-process surrogate for batched Bayesian optimization.
+
+A PARMELA run costs minutes, so the optimizer should spend its effort on
+choosing the next decks. A Gaussian process (squared-exponential kernel with
+one length scale per variable) is fitted to all results so far; new points
+maximize the expected improvement of the objective times the probability
+that the beam gets through (a second GP on the pass/fail outcome). A batch of
+q points is chosen by the kriging believer heuristic: after each pick the GP
+is told that the point came out at its predicted mean, which pushes the next
+pick elsewhere, so the q runs can go in parallel.
+
+Everything works in the unit cube; the caller scales the variables.
+
+Usage:
+    opt = BatchOptimizer(dim=3, seed=1)
+    x = opt.initial(8)                      # Latin hypercube
+    ...run, then opt.tell(x, y, ok)...
+    x = opt.ask(4)                          # next batch
+'''
+import numpy as np
+from scipy.optimize import minimize
+from scipy.stats import norm, qmc
+
+
+class GaussianProcess:
+    """
+    GP regression with a squared-exponential ARD kernel. The targets are
+    standardized; length scales, signal and noise variance are fitted by
+    maximizing the log marginal likelihood.
+    """
+
+    def __init__(self, noise=1e-6):
+        self.min_noise = noise
+        self.theta = None
+
+    def _kernel(self, A, B, ls, sf2):
+        d = (A[:, None, :] - B[None, :, :]) / ls
+        return sf2 * np.exp(-0.5 * np.sum(d * d, axis=-1))
+
+    def _nll(self, theta, X, y):
+        ls, sf2, sn2 = np.exp(theta[:-2]), np.exp(theta[-2]), np.exp(theta[-1]) + self.min_noise
+        K = self._kernel(X, X, ls, sf2) + sn2 * np.eye(len(X))
+        try:
+            L = np.linalg.cholesky(K)
+        except np.linalg.LinAlgError:
+            return 1e25
+        alpha = np.linalg.solve(L.T, np.linalg.solve(L, y))
+        return 0.5 * y @ alpha + np.log(np.diag(L)).sum()
+
+    def fit(self, X, y, optimize=True, restarts=3, rng=None):
+        """
+        Fits the GP to points X (n, d) with values y (n,). With optimize=False
+        the hyperparameters of the last fit are kept (used for the believer
+        updates within a batch).
+        """
+        X, y = np.asarray(X, dtype=float), np.asarray(y, dtype=float)
+        self.X = X
+        self.mu, self.sd = y.mean(), y.std() or 1.0
+        self.y = (y - self.mu) / self.sd
+        d = X.shape[1]
+        if optimize or self.theta is None:
+            rng = rng if rng is not None else np.random.default_rng()
+            bounds = [(np.log(1e-2), np.log(10.0))] * d + [(np.log(1e-2), np.log(1e2)), (np.log(1e-8), np.log(1.0))]
+            starts = [np.r_[np.log(np.full(d, 0.3)), 0.0, np.log(1e-4)]]
+            starts += [np.array([rng.uniform(lo, hi) for lo, hi in bounds]) for _ in range(restarts)]
+            best = None
+            for start in starts:
+                res = minimize(self._nll, start, args=(X, self.y), method='L-BFGS-B', bounds=bounds)
+                if best is None or res.fun < best.fun:
+                    best = res
+            self.theta = best.x
+        ls, sf2, sn2 = np.exp(self.theta[:-2]), np.exp(self.theta[-2]), np.exp(self.theta[-1]) + self.min_noise
+        self.ls, self.sf2 = ls, sf2
+        K = self._kernel(X, X, ls, sf2) + sn2 * np.eye(len(X))
+        self.L = np.linalg.cholesky(K)
+        self.alpha = np.linalg.solve(self.L.T, np.linalg.solve(self.L, self.y))
+        return self
+
+    def predict(self, Xs):
+        """Returns the posterior mean and standard deviation at Xs (m, d)."""
+        Ks = self._kernel(np.asarray(Xs, dtype=float), self.X, self.ls, self.sf2)
+        mean = Ks @ self.alpha
+        v = np.linalg.solve(self.L, Ks.T)
+        var = np.maximum(self.sf2 - np.sum(v * v, axis=0), 1e-12)
+        return mean * self.sd + self.mu, np.sqrt(var) * self.sd
+
+
+def expected_improvement(mean, std, best):
+    """Expected improvement below best (minimization)."""
+    z = (best - mean) / std
+    return (best - mean) * norm.cdf(z) + std * norm.pdf(z)
+
+
+class BatchOptimizer:
+    """
+    Minimizes a black-box objective over the unit cube with a failure
+    constraint, q points at a time.
+
+    Args:
+        dim (int): Number of variables.
+        seed: Seed of the initial design and the candidate sampling.
+        candidates (int): Random candidates scored per pick, besides the ones
+            around the best point.
+    """
+
+    def __init__(self, dim, seed=None, candidates=4096):
+        self.dim = dim
+        self.rng = np.random.default_rng(seed)
+        self.candidates = candidates
+        self.X = np.empty((0, dim))
+        self.y = np.empty(0)
+        self.ok = np.empty(0, dtype=bool)
+
+    def initial(self, n):
+        """A Latin-hypercube design of n points."""
+        return qmc.LatinHypercube(self.dim, seed=self.rng).random(n)
+
+    def tell(self, X, y, ok):
+        """
+        Adds results. y is the objective (ignored where ok is False), ok tells
+        whether the run satisfied the constraint.
+        """
+        self.X = np.vstack([self.X, np.atleast_2d(X)])
+        self.y = np.r_[self.y, np.where(ok, y, np.nan)]
+        self.ok = np.r_[self.ok, np.asarray(ok, dtype=bool)]
+
+    def best(self):
+        """(x, y) of the best feasible result, or (None, None)."""
+        if not self.ok.any():
+            return None, None
+        k = np.nanargmin(np.where(self.ok, self.y, np.nan))
+        return self.X[k], self.y[k]
+
+    def _candidates(self):
+        cand = self.rng.random((self.candidates, self.dim))
+        x_best, _ = self.best()
+        if x_best is not None:
+            local = x_best + self.rng.normal(scale=0.05, size=(self.candidates // 4, self.dim))
+            cand = np.vstack([cand, np.clip(local, 0, 1)])
+        return cand
+
+    def ask(self, q):
+        """
+        The next q points: expected improvement times the probability of
+        passing, with kriging-believer updates between the picks.
+        """
+        ok = self.ok
+        if ok.sum() < 2:
+            return self.initial(q)  # nothing to model yet
+        X, y = self.X[ok], self.y[ok]
+        gp = GaussianProcess().fit(X, y, rng=self.rng)
+        # pass/fail as +-1 targets; no feasibility model until both outcomes were seen
+        feas = GaussianProcess().fit(self.X, np.where(ok, 1.0, -1.0), rng=self.rng) if not ok.all() else None
+        cand = self._candidates()
+        picks = []
+        for _ in range(q):
+            mean, std = gp.predict(cand)
+            score = expected_improvement(mean, std, y.min())
+            if feas is not None:
+                fm, fs = feas.predict(cand)
+                score = score * norm.cdf(fm / fs)
+            k = int(np.argmax(score))
+            x = cand[k]
+            picks.append(x)
+            # kriging believer: pretend the pick returned its predicted mean
+            X, y = np.vstack([X, x]), np.r_[y, mean[k]]
+            gp.fit(X, y, optimize=False)
+            cand = np.delete(cand, k, axis=0)
+        return np.array(picks)
@@ -5,6 +5,7 @@ import numpy as np
 import os
 import re
 import math
+from parmela_table import read_frame
 
 # ==========================================
 # 1. Configuration
@@ -241,60 +242,16 @@ def process_parmela_file(filepath):
 
 def process_beam_file(filepath):
     """
-    Parses the TIMESTEPEMITTANCE.tbl file.
+    Parses the TIMESTEPEMITTANCE.tbl file. Columns are named after its TITLES block.
     """
     if not os.path.exists(filepath):
         print(f"Error: Beam file not found at {filepath}")
         return None
 
-    with open(filepath, 'r') as f:
-        lines = f.readlines()
-    
-    headers = []
-    data_start_idx = -1
-    
-    # 1. Find Headers (TITLES section)
-    in_titles = False
-    for i, line in enumerate(lines):
-        clean = line.strip()
-        if clean == "TITLES":
-            in_titles = True
-            continue
-        if clean == "ENDTITLES":
-            in_titles = False
-            continue
-        if in_titles:
-            headers.append(clean)
-        
-        # 2. Find Start of Data
-        if clean == "DATA":
-            data_start_idx = i + 1
-            break
-            
-    if data_start_idx == -1 or not headers:
-        print("Error: Could not find TITLES or DATA block in beam file.")
-        return None
-
-    # 3. Read Data
-    data_lines = lines[data_start_idx:]
-    # Filter out lines that don't look like data (e.g. comments or empty)
-    valid_data = []
-    for line in data_lines:
-        parts = line.strip().split()
-        # Basic check: if number of columns matches headers
-        if len(parts) == len(headers):
-             valid_data.append(parts)
-        elif len(parts) > 0 and parts[0].replace('.','',1).isdigit():
-             # Try to match if length mismatch is due to spacing, though strict matching is safer
-             # For now assume strict matching
-             if len(parts) == len(headers):
-                 valid_data.append(parts)
-
     try:
-        df = pd.DataFrame(valid_data, columns=headers, dtype=float)
-        return df
-    except Exception as e:
-        print(f"Error creating beam DataFrame: {e}")
+        return read_frame(filepath, titles=True)
+    except ValueError as e:
+        print(f"Error reading beam file: {e}")
         return None
 
 
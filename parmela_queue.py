@@ -0,0 +1,149 @@
+'''parmela tool, work queue with a persistent job ledger for batches of runs.
+
+An error study is a batch of independent PARMELA runs. The queue here keeps
+at most `workers` of them running, prepares each job (folder, perturbed deck)
+only right before it is dispatched, kills a run that exceeds its wall-clock
+timeout and retries it, and writes every state change to an append-only
+ledger. A study that was interrupted is resumed by running the same jobs
+against the same ledger: finished jobs are skipped.
+
+The ledger is one JSON object per line, {"job", "state", "attempt", "time",
+...}; the last line of a job is its state. Lines are flushed as they are
+written, so a crash loses at most the jobs that were running.
+
+Usage:
+    queue = WorkQueue(Ledger('error_1a2b3c4d.ledger'), workers=8, timeout=3600)
+    queue.run(range(1, 61), prepare, run_case, finish)
+'''
+import json
+import time
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from parmela_trace import call_with_tags
+from parmela_runner import WORKERS
+
+
+class Ledger:
+    """
+    Append-only record of job states.
+
+    Args:
+        path (str): The ledger file; created on the first record.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def states(self):
+        """Returns {job: last record} of every job in the ledger."""
+        out = {}
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut off by a crash
+                    out[rec["job"]] = rec
+        except FileNotFoundError:
+            pass
+        return out
+
+    def done(self):
+        """Returns the jobs whose last state is 'done'."""
+        return {job for job, rec in self.states().items() if rec["state"] == "done"}
+
+    def record(self, job, state, **info):
+        rec = {"job": job, "state": state, "time": time.time()}
+        rec.update(info)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(rec) + '\n')
+            f.flush()
+
+
+class WorkQueue:
+    """
+    Runs jobs with bounded concurrency, per-job timeouts and retries.
+
+    Args:
+        ledger (Ledger): Where job states are recorded.
+        workers (int): Jobs running at the same time. PARMELA is single
+            threaded but memory-heavy, so this may need to be below the CPU count.
+        timeout (float): Wall-clock seconds a run may take, None for no limit.
+            The work function receives it and must kill the run on expiry
+            (subprocess.run(timeout=...) does).
+        retries (int): How often a failed or timed-out job is started again.
+    """
+
+    def __init__(self, ledger, workers=WORKERS, timeout=None, retries=1):
+        self.ledger = ledger
+        self.workers = max(1, int(workers))
+        self.timeout = timeout
+        self.retries = retries
+
+    def run(self, jobs, prepare, work, finish, skip=()):
+        """
+        Runs every job not finished in the ledger.
+
+        Args:
+            jobs (iterable): Job ids (JSON-serializable).
+            prepare (callable): prepare(job) -> args, called in this process
+                right before the job is dispatched (e.g. creates its folder).
+            work (callable): work(args, timeout) -> result, run in a worker
+                process; must be a module-level function.
+            finish (callable): finish(job, args, result), called in this
+                process when the job succeeded.
+            skip (iterable): More job ids to treat as finished.
+
+        Returns:
+            tuple: (done, failed) lists of job ids handled in this call.
+        """
+        jobs = list(jobs)
+        finished = self.ledger.done() | set(skip)
+        todo = [job for job in jobs if job not in finished]
+        if len(todo) < len(jobs):
+            print(f"Resuming: {len(jobs) - len(todo)} jobs already finished, {len(todo)} to run")
+        attempts = {}
+        done, failed = [], []
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        running = {}
+
+        def start(job):
+            attempts[job] = attempts.get(job, 0) + 1
+            args = prepare(job)
+            self.ledger.record(job, "running", attempt=attempts[job])
+            # the job and attempt go with it into the run trace of the worker process
+            tagged = {"job": job, "attempt": attempts[job]}
+            running[executor.submit(call_with_tags, tagged, work, args, self.timeout)] = (job, args, time.time())
+
+        queue = list(todo)
+        try:
+            while queue or running:
+                while queue and len(running) < self.workers:
+                    start(queue.pop(0))
+                ready, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in ready:
+                    job, args, t0 = running.pop(future)
+                    try:
+                        result = future.result()
+                        finish(job, args, result)
+                    except Exception as e:
+                        state = "timeout" if isinstance(e, subprocess.TimeoutExpired) else "failed"
+                        self.ledger.record(job, state, attempt=attempts[job], error=str(e))
+                        if attempts[job] <= self.retries:
+                            print(f"Job {job} {state} ({e}), retrying")
+                            queue.append(job)
+                        else:
+                            print(f"Job {job} {state} after {attempts[job]} attempts: {e}")
+                            failed.append(job)
+                        continue
+                    self.ledger.record(job, "done", attempt=attempts[job], wall=time.time() - t0)
+                    done.append(job)
+        except KeyboardInterrupt:
+            # the running jobs are rerun on resume; do not wait for them here
+            for job, _, _ in running.values():
+                self.ledger.record(job, "interrupted", attempt=attempts[job])
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        return done, failed
@@ -0,0 +1,246 @@
+'''parmela tool, run PARMELA decks in isolated working directories.
+
+PARMELA writes its tables (TIMESTEPEMITTANCE.TBL, OUTPAR.TXT, ...) into the
+current directory, so two runs in the same directory overwrite each other.
+Every run here gets its own work directory with the input files staged next
+to the deck (parmela_stage), which lets several probes of an optimizer run at the same time.
+
+The runs are dispatched from a thread pool: the work is done by the parmela
+child processes, the threads only wait for them. Unlike a process pool this
+also works from the top-level driver scripts (autophase.py has no
+`if __name__ == "__main__"` guard that spawn-based workers would need).
+
+Nothing here changes the current directory: parmela is started with cwd=
+set to the run folder, so runs can be dispatched from threads, processes or
+asyncio alike. run_parmela() returns a RunResult with the exit code, the wall
+time, the files the run wrote and the files its stdout/stderr went to, and
+appends the record of the run to the trace (parmela_trace).
+
+Usage:
+    workdir = make_workdir()
+    write_deck(workdir, 'rr6_temp.inp', text)
+    row = run_many([(workdir, 'rr6_temp.inp')])[0]
+    remove_workdir(workdir)
+
+    result = run_parmela('rr6_1', 'rr6_erranaly.inp', timeout=3600)
+    if result.ok:
+        tbl = result.path('TIMESTEPEMITTANCE.TBL')
+'''
+import os
+import time
+import shlex
+import shutil
+import tempfile
+import subprocess
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from parmela_table import final_row
+from parmela_stage import stage_inputs
+from parmela_trace import record_run
+
+PARMELA = os.environ.get("PARMELA", "parmela")
+WORKERS = int(os.environ.get("PARMELA_WORKERS", "0")) or os.cpu_count() or 1
+WORK_DIR = ".parmela_work"
+DEFAULT_TBL = "TIMESTEPEMITTANCE.TBL"
+
+
+def make_workdir(src_dir='.'):
+    """
+    Creates a fresh work directory under src_dir/.parmela_work with the run
+    inputs staged into it: field maps are linked from the shared pool, save
+    files are copied (see parmela_stage).
+
+    Returns:
+        str: Path of the new directory.
+    """
+    parent = os.path.join(src_dir, WORK_DIR)
+    os.makedirs(parent, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="run_", dir=parent)
+    stage_inputs(workdir, src_dir)
+    return workdir
+
+
+def remove_workdir(workdir):
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def write_deck(workdir, name, text):
+    """Writes deck text into workdir; returns its path."""
+    path = os.path.join(workdir, name)
+    with open(path, 'w', encoding='latin-1') as f:
+        f.write(text)
+    return path
+
+
+class RunResult:
+    """
+    Outcome of one PARMELA run.
+
+    Attributes:
+        workdir (str): The folder the run was started in.
+        deck (str): The deck name, relative to workdir.
+        returncode (int): Exit code of parmela.
+        wall (float): Wall-clock seconds the run took.
+        outputs (list): Paths of the files the run created or rewrote.
+        stdout (str): File that holds the captured standard output.
+        stderr (str): File that holds the captured standard error.
+    """
+
+    def __init__(self, workdir, deck, returncode, wall, outputs, stdout, stderr):
+        self.workdir = workdir
+        self.deck = deck
+        self.returncode = returncode
+        self.wall = wall
+        self.outputs = outputs
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __repr__(self):
+        return (f"RunResult({self.deck!r} in {self.workdir!r}, returncode={self.returncode}, "
+                f"wall={self.wall:.1f}s, {len(self.outputs)} outputs)")
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def path(self, name):
+        """Path of output file name (e.g. 'TIMESTEPEMITTANCE.TBL'), or None if the run did not write it."""
+        path = os.path.join(self.workdir, name)
+        return path if path in self.outputs else None
+
+
+def file_stamps(workdir):
+    """(mtime, size) of every file in workdir, to tell afterwards which ones a run wrote."""
+    stamps = {}
+    for e in os.scandir(workdir):
+        if e.is_file():
+            st = e.stat()
+            stamps[e.name] = (st.st_mtime_ns, st.st_size)
+    return stamps
+
+
+def log_paths(workdir, deck_name):
+    """The files stdout and stderr of a run of deck_name are captured to."""
+    stem = os.path.splitext(deck_name)[0]
+    return os.path.join(workdir, stem + ".out"), os.path.join(workdir, stem + ".err")
+
+
+def collect_result(workdir, deck_name, returncode, wall, before):
+    """Builds the RunResult of a finished run; before is file_stamps() taken at its start."""
+    stdout, stderr = log_paths(workdir, deck_name)
+    logs = (os.path.basename(stdout), os.path.basename(stderr))
+    outputs = sorted(os.path.join(workdir, name) for name, stamp in file_stamps(workdir).items()
+                     if before.get(name) != stamp and name not in logs)
+    return RunResult(workdir, deck_name, returncode, wall, outputs, stdout, stderr)
+
+
+def parmela_command(command=None):
+    """
+    The parmela command line as a list; default PARMELA. A string is split
+    like a shell command line, e.g. 'wine ~/.wine/drive_c/LANL/parmela.exe'.
+    """
+    if command is None:
+        return [PARMELA]
+    if isinstance(command, str):
+        return [os.path.expanduser(word) for word in shlex.split(command)]
+    return list(command)
+
+
+def wait_child(proc, timeout=None):
+    """
+    Waits for proc to exit and returns its resource usage. os.wait4 gives the
+    CPU time and peak RSS of this one child, also while other runs go on in
+    other threads; where it does not exist (Windows) the usage is None.
+    On a timeout the child is killed and subprocess.TimeoutExpired is raised.
+    """
+    if not hasattr(os, 'wait4'):
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            raise
+        return None
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        pid, status, usage = os.wait4(proc.pid, 0 if deadline is None else os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return usage
+        if time.monotonic() >= deadline:
+            proc.kill()
+            _, status, _ = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(delay)
+        delay = min(2 * delay, 0.05)
+
+
+def run_parmela(workdir, deck_name, command=None, timeout=None, check=True):
+    """
+    Runs parmela on deck_name with workdir as its working directory.
+
+    Args:
+        workdir (str): The run folder; deck_name and its inputs must be in it.
+        deck_name (str): The deck file name inside workdir.
+        command (str or list): The parmela command, see parmela_command().
+        timeout (float): Seconds after which the run is killed and
+            subprocess.TimeoutExpired is raised; None for no limit.
+        check (bool): Raise subprocess.CalledProcessError on a non-zero exit code.
+
+    Returns:
+        RunResult: Exit code, wall time, output paths and the stdout/stderr
+            files (<deck>.out and <deck>.err in workdir).
+    """
+    stdout, stderr = log_paths(workdir, deck_name)
+    before = file_stamps(workdir)
+    start, t0 = time.time(), time.perf_counter()
+    with open(stdout, 'wb') as out, open(stderr, 'wb') as err:
+        proc = subprocess.Popen(parmela_command(command) + [deck_name], cwd=workdir, stdout=out, stderr=err)
+        try:
+            usage = wait_child(proc, timeout)
+        except subprocess.TimeoutExpired:
+            result = collect_result(workdir, deck_name, proc.returncode, time.perf_counter() - t0, before)
+            record_run(result, start, status="timeout")
+            raise
+    result = collect_result(workdir, deck_name, proc.returncode, time.perf_counter() - t0, before)
+    record_run(result, start, usage)
+    if check and not result.ok:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return result
+
+
+def run_deck(workdir, deck_name, tbl=DEFAULT_TBL):
+    """
+    Runs parmela on deck_name inside workdir.
+
+    Returns:
+        dict: The final row of workdir/tbl by column name, or None if it was
+            not written.
+    """
+    path = run_parmela(workdir, deck_name).path(tbl)
+    if path is None:
+        return None
+    try:
+        return final_row(path)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def run_many(jobs, max_workers=WORKERS, tbl=DEFAULT_TBL):
+    """
+    Runs several (workdir, deck_name) jobs at the same time. Each thread runs
+    in a copy of the caller's context, so the trace tags go with the jobs.
+
+    Returns:
+        list: run_deck() results in job order.
+    """
+    if not jobs:
+        return []
+    if len(jobs) == 1:
+        return [run_deck(jobs[0][0], jobs[0][1], tbl)]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run_deck, workdir, name, tbl)
+                   for workdir, name in jobs]
+        return [future.result() for future in futures]
@@ -0,0 +1,407 @@
+'''parmela tool, parameter scans over deck variables, run in parallel.
+
+A scan is a list of points, each a {name: value} dict, that are written into
+copies of one deck and run in their own work directories (parmela_runner),
+up to `workers` at a time. One row of an output table is read from every run
+in process, and all points end up in a single pandas table.
+
+Names are either the mark of a `!@var` line (the value goes into every field
+bound to it by `!@subs`, as in optimize.py), or a raw field of the deck given
+as L<line>:<field> / L<first>-<last>:<field>, with 1-based line numbers as an
+editor shows them and the field index counted from the keyword (0).
+
+Designs:
+    grid     every combination of the values of all variables (full factorial)
+    zip      the i-th values of all variables together (equal lengths)
+    random   `samples` uniform points in the given bounds (--lhs: Latin hypercube)
+
+Values are start:stop:num (inclusive), v1,v2,... or a single value. For grid
+and zip a bare `!@var` mark scans its left..right range in steps of its step;
+for random, lo:hi or a bare mark (its left..right range).
+
+Usage:
+    python parmela_scan.py grid sp2.acc 3=250:400:16 L44:4=-0.02,-0.019 --workers 8
+    python parmela_scan.py zip sp2.acc 0=0.1:1:10 1=3:30:10 --at 'Z(cm)=498'
+    python parmela_scan.py random rr6.inp 3 5=0.5:1.5 --samples 64 --seed 1 --out scan.csv
+
+    points = product(zipped({'0': v0, '1': v1}), grid({'3': v3}))
+    table = run_scan('sp2.acc', points, extract=row_at('Z(cm)', 498.0))
+'''
+import os
+import sys
+import itertools
+import importlib
+import subprocess
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+from concurrent.futures import ThreadPoolExecutor
+from parmela_deck import Deck
+from parmela_table import read_table, read_schema, final_row
+from parmela_runner import WORKERS, DEFAULT_TBL, make_workdir, remove_workdir, write_deck, run_parmela
+from parmela_trace import tags
+
+
+# --- Designs ---
+
+def grid(axes):
+    """Full factorial design of {name: values}; the last name varies fastest."""
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*(axes[n] for n in names))]
+
+
+def zipped(axes):
+    """The i-th values of all names together; all value lists must have the same length."""
+    lengths = {len(v) for v in axes.values()}
+    if len(lengths) > 1:
+        raise ValueError(f"zip needs value lists of equal length, got {sorted(lengths)}")
+    names = list(axes)
+    return [dict(zip(names, values)) for values in zip(*(axes[n] for n in names))]
+
+
+def random_design(bounds, samples, seed=None, lhs=False):
+    """
+    Uniform random points in {name: (lo, hi)}.
+
+    Args:
+        bounds (dict): Name -> (lo, hi).
+        samples (int): Number of points.
+        seed: Seed of the generator; the same seed gives the same points.
+        lhs (bool): Latin hypercube instead of independent draws.
+    """
+    names = list(bounds)
+    lo = np.array([bounds[n][0] for n in names], dtype=float)
+    hi = np.array([bounds[n][1] for n in names], dtype=float)
+    if lhs:
+        u = qmc.LatinHypercube(len(names), seed=seed).random(samples)
+    else:
+        u = np.random.default_rng(seed).random((samples, len(names)))
+    return [dict(zip(names, lo + row * (hi - lo))) for row in u]
+
+
+def product(*designs):
+    """Every point of the first design combined with every point of the next ones."""
+    return [dict(kv for point in points for kv in point.items()) for points in itertools.product(*designs)]
+
+
+# --- Variables ---
+
+def is_field(name):
+    return name[:1] in 'Ll' and ':' in name
+
+
+def field_lines(name):
+    """Line indices (0-based) and field of an L<line>[-<last>]:<field> name."""
+    rows, col = name[1:].split(':')
+    first, _, last = rows.partition('-')
+    first = int(first)
+    last = int(last) if last else first
+    return list(range(first - 1, last)), int(col)
+
+
+def check_names(deck, names):
+    """Raises ValueError for names that are neither a `!@var` mark nor a field of the deck."""
+    marks = {v["mark"] for v in deck.variables()}
+    for name in names:
+        if is_field(name):
+            lines, col = field_lines(name)
+            for i in lines:
+                if not 0 <= i < len(deck.lines) or len(deck.fields(i)) <= col:
+                    raise ValueError(f"{name}: line {i + 1} of {deck.path} has no field {col}")
+        elif name not in marks:
+            raise ValueError(f"{name}: no '!@var' with this mark in {deck.path}")
+
+
+def var_range(deck, mark):
+    """(left, right, step) of the `!@var` line with the given mark, as floats."""
+    for v in deck.variables():
+        if v["mark"] == mark:
+            return float(v["left"]), float(v["right"]), float(v["step"])
+    raise ValueError(f"{mark}: no '!@var' with this mark in {deck.path}")
+
+
+def format_value(value):
+    # short, exact enough for the deck (linspace gives 0.30000000000000004)
+    return str(float('{0:.10g}'.format(float(value))))
+
+
+def apply_point(deck, point):
+    """Writes the values of a point into the deck (in memory)."""
+    for name, value in point.items():
+        value = format_value(value)
+        if is_field(name):
+            lines, col = field_lines(name)
+            for i in lines:
+                deck.set(i, col, value)
+        else:
+            deck.rewrite_var(name, value)
+
+
+# --- Extraction ---
+
+def row_at(column, value, tbl=DEFAULT_TBL, columns=None):
+    """
+    Extractor for run_scan(): the row of tbl whose column is nearest to value,
+    e.g. row_at('Z(cm)', 498.0).
+    """
+    def extract(result):
+        path = result.path(tbl)
+        if path is None:
+            return None
+        table = read_table(path, None if columns is None else list(dict.fromkeys(list(columns) + [column])))
+        if len(table[column]) == 0:
+            return None
+        k = int(np.argmin(np.abs(table[column] - value)))
+        return {c: float(v[k]) for c, v in table.items()}
+    return extract
+
+
+def row_index(index, tbl=DEFAULT_TBL, columns=None):
+    """Extractor for run_scan(): data row index of tbl (negative counts from the end)."""
+    def extract(result):
+        path = result.path(tbl)
+        if path is None:
+            return None
+        table = read_table(path, columns, last=-index if index < 0 else None)
+        n = len(next(iter(table.values())))
+        if not -n <= index < n:
+            return None
+        return {c: float(v[index]) for c, v in table.items()}
+    return extract
+
+
+def file_line(line, tbl=DEFAULT_TBL, columns=None):
+    """
+    Extractor for run_scan(): the row on 1-based line `line` of the tbl file,
+    the row `sed -n '<line>,+0p' <tbl>` prints.
+    """
+    def extract(result):
+        path = result.path(tbl)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            header_lines = f.read(read_schema(path).data_offset).count(b'\n')
+        index = line - 1 - header_lines
+        return row_index(index, tbl, columns)(result) if index >= 0 else None
+    return extract
+
+
+def last_row(tbl=DEFAULT_TBL, columns=None):
+    """Extractor for run_scan(): the final row of tbl (the default)."""
+    def extract(result):
+        path = result.path(tbl)
+        return None if path is None else final_row(path, columns)
+    return extract
+
+
+# --- Running ---
+
+def run_scan(deck_path, points, extract=None, workers=WORKERS, command=None, timeout=None, keep=False,
+             derive=None):
+    """
+    Runs the deck once per point, in parallel work directories.
+
+    Args:
+        deck_path (str): The deck; its folder provides the field maps.
+        points (list): {name: value} dicts (see grid, zipped, random_design, product).
+        extract (callable): extract(RunResult) -> dict of values or None, called
+            in the worker thread when the run finished; default last_row().
+        workers (int): Runs at the same time.
+        command (str or list): The parmela command, see parmela_runner.parmela_command().
+        timeout (float): Seconds a run may take.
+        keep (bool): Keep the work directories (their paths are in the 'workdir'
+            column); otherwise they are removed once the row is extracted.
+        derive (callable): derive(point) -> {name: value} of more fields that
+            follow from the point (e.g. a coil ramp); written to the deck, not
+            to the table.
+
+    Returns:
+        pandas.DataFrame: One row per point, indexed 1..N: the point values,
+            'ok', 'wall' and the extracted values (NaN where a run failed).
+    """
+    extract = extract or last_row()
+    deck = Deck(deck_path)  # a private copy, the load_deck cache of deck_path is left alone
+    derive = derive or (lambda point: {})
+    names = list(dict.fromkeys(name for point in points for name in list(point) + list(derive(point))))
+    check_names(deck, names)
+    src_dir = os.path.dirname(deck_path) or '.'
+    deck_name = os.path.basename(deck_path)
+    texts = []
+    for point in points:
+        apply_point(deck, point)
+        apply_point(deck, derive(point))
+        texts.append(deck.render())
+
+    def work(k):
+        workdir = make_workdir(src_dir)
+        write_deck(workdir, deck_name, texts[k])
+        row = {"ok": False, "wall": np.nan}
+        try:
+            with tags(point=k + 1):
+                result = run_parmela(workdir, deck_name, command, timeout, check=False)
+            row["wall"] = result.wall
+            values = extract(result) if result.ok else None
+            if values is not None:
+                row.update(values)
+                row["ok"] = True
+        except (subprocess.TimeoutExpired, OSError, ValueError) as e:
+            print(f"Point {k + 1} failed: {e}")
+        if keep:
+            row["workdir"] = workdir
+        else:
+            remove_workdir(workdir)
+        print(f"Point {k + 1}/{len(points)}: " + ", ".join(f"{n}={points[k][n]:.6g}" for n in points[k])
+              + ("" if row["ok"] else "  (failed)"))
+        return row
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(points)))) as executor:
+        rows = list(executor.map(work, range(len(points))))
+    table = pd.concat([pd.DataFrame(points), pd.DataFrame(rows)], axis=1)
+    table.index = pd.RangeIndex(1, len(table) + 1, name='point')
+    return table
+
+
+def save_table(table, path):
+    """Writes the scan table as csv (.csv) or as an aligned text table."""
+    if path.lower().endswith('.csv'):
+        table.to_csv(path, float_format='%.6E')
+    else:
+        with open(path, 'w') as out:
+            out.write(table.to_string(float_format=lambda v: f"{v:.6E}") + '\n')
+
+
+# --- Command line ---
+
+def parse_values(spec):
+    """start:stop:num -> linspace, v1,v2,... -> list, lo:hi -> bounds, v -> [v]."""
+    if ':' in spec:
+        parts = [float(p) for p in spec.split(':')]
+        if len(parts) == 3:
+            return np.linspace(parts[0], parts[1], int(parts[2]))
+        return tuple(parts)
+    return [float(v) for v in spec.split(',')]
+
+
+def design_from_args(design, deck, specs, samples=None, seed=None, lhs=False):
+    """Builds the points of a design from name=values command line words."""
+    axes = {}
+    for spec in specs:
+        name, _, values = spec.partition('=')
+        if values:
+            axes[name] = parse_values(values)
+        else:
+            left, right, step = var_range(deck, name)
+            if design == 'random':
+                axes[name] = (left, right)
+            else:
+                axes[name] = np.arange(left, right + step / 2, step)
+    if design == 'random':
+        if samples is None:
+            raise ValueError("random needs --samples")
+        for name, bounds in axes.items():
+            if not isinstance(bounds, tuple):
+                raise ValueError(f"{name}: random needs lo:hi bounds")
+        return random_design(axes, samples, seed, lhs)
+    for name, values in axes.items():
+        if isinstance(values, tuple):
+            raise ValueError(f"{name}: {design} needs start:stop:num or a list of values")
+    return grid(axes) if design == 'grid' else zipped(axes)
+
+
+def pop_option(argv, flag, default=None, convert=str):
+    """Removes '<flag> <value>' from argv and returns the value."""
+    if flag not in argv:
+        return default
+    k = argv.index(flag)
+    value = argv[k + 1]
+    del argv[k:k + 2]
+    return convert(value)
+
+
+def extractor_from_args(argv, line=None):
+    """
+    Removes --tbl, --columns, --at, --row, --line from argv; returns the
+    extractor they ask for (default: the row on file line `line`, or the last row).
+    """
+    tbl = pop_option(argv, '--tbl', DEFAULT_TBL)
+    columns = pop_option(argv, '--columns', None, lambda s: s.split(','))
+    at = pop_option(argv, '--at')
+    row = pop_option(argv, '--row', None, int)
+    line = pop_option(argv, '--line', line, int)
+    if at is not None:
+        column, _, value = at.rpartition('=')
+        return row_at(column, float(value), tbl, columns)
+    if row is not None:
+        return row_index(row, tbl, columns)
+    if line is not None:
+        return file_line(line, tbl, columns)
+    return last_row(tbl, columns)
+
+
+def run_options(argv, out, line=None):
+    """
+    Removes the options every scan takes from argv.
+
+    Returns:
+        dict: extract, workers, command, timeout and keep for run_scan(), and 'out'.
+    """
+    keep = '--keep' in argv
+    if keep:
+        argv.remove('--keep')
+    return {"workers": pop_option(argv, '--workers', WORKERS, int),
+            "timeout": pop_option(argv, '--timeout', None, float),
+            "command": pop_option(argv, '--command'),
+            "out": pop_option(argv, '--out', out),
+            "extract": extractor_from_args(argv, line),
+            "keep": keep}
+
+
+# Scans of one kind with their own defaults: subcommand -> module with main(argv)
+SUBCOMMANDS = {"laserjit": "parscan", "coil": "parcoil"}
+
+USAGE = """Usage: python parmela_scan.py grid|zip|random <deck> <name>[=<values>] ... [options]
+       python parmela_scan.py laserjit|coil [<deck>] [options]   (see parscan.py, parcoil.py)
+  names:   a '!@var' mark, or L<line>[-<last>]:<field> (1-based line, field 0 is the keyword)
+  values:  start:stop:num | v1,v2,... | lo:hi (random); none: the '!@var' range
+  options: --samples n --seed s --lhs (random)
+           --at 'Z(cm)=498' | --row k | --line n   (row to extract, default: the last)
+           --tbl TIMESTEPEMITTANCE.TBL --columns 'Z(cm),Xn(mm-mrad)'
+           --workers n --timeout s --command 'wine ~/.wine/drive_c/LANL/parmela.exe'
+           --out scan.txt --keep"""
+
+
+def main(argv):
+    argv = list(argv)
+    if argv and argv[0] in SUBCOMMANDS:
+        return importlib.import_module(SUBCOMMANDS[argv[0]]).main(argv[1:])
+    lhs = '--lhs' in argv
+    if lhs:
+        argv.remove('--lhs')
+    samples = pop_option(argv, '--samples', None, int)
+    seed = pop_option(argv, '--seed', None, int)
+    options = run_options(argv, 'scan.txt')
+    if len(argv) < 3 or argv[0] not in ('grid', 'zip', 'random'):
+        print(USAGE)
+        sys.exit(1)
+    design, deck_path, specs = argv[0], argv[1], argv[2:]
+    try:
+        deck = Deck(deck_path)
+        points = design_from_args(design, deck, specs, samples, seed, lhs)
+        check_names(deck, list(points[0]))
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    return run_and_save(deck_path, points, **options)
+
+
+def run_and_save(deck_path, points, out, **options):
+    """run_scan() with progress messages; the table is written to out and returned."""
+    print(f"{len(points)} points, {min(options.get('workers', WORKERS), len(points))} at a time")
+    table = run_scan(deck_path, points, **options)
+    save_table(table, out)
+    print(f"{int(table['ok'].sum())} of {len(table)} points ok, table written to {out}")
+    return table
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
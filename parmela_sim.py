@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+'''parmela tool, stand-in for the parmela executable.
+
+Reads a PARMELA deck and writes TIMESTEPEMITTANCE.TBL, EMITTANCE.TBL and
+OUTPAR.TXT in the layouts the drivers read (84-line header with TITLES /
+ENDTITLES / DATA, the '; <names>' line, one row per time step or element), so
+autophase, autocorrection, error_ana_pal_v2, optimize, scan and the queues can
+be run, profiled and regression-tested without the real code or its licence.
+The physics is a fast linear model, not PARMELA:
+
+    a macro-particle ensemble (x, x', y, y', phase, dW) tracked element by element
+    cell/trwave   energy gain E0 * L * cos(phase), each particle at its own phase
+                  offset, with adiabatic damping of the angles. A cell (a coupler
+                  cell) starts a section: its phase and that of the trwaves after
+                  it (+90) count from crest at the RF clock of the first cell of
+                  the same frequency, so a section further down the line keeps
+                  its phase relative to the beam. A cell with a field map (field
+                  8 = -1, then a cfield card) gives every particle its E0 * L:
+                  the model does not read the map, so its phase has no effect
+    solenoid      thin lens, 1/f = (B / 2 Brho)^2 L in both planes
+    quad          thin lens, 1/f = G L / Brho, focusing in x
+    steerer       kicks B L / Brho from fields 4 and 5 (G)
+    bend          dispersion kick theta * dp/p
+    poisson       the gun: |field 2| x 350 keV
+    drift         with the velocity-dependent phase slip
+
+The lenses, kicks and damping act at the reference momentum, so the optics is
+linear; only the bends see dp/p. Particles are lost when they stop (dW below
+-W); the whole beam is lost when the reference particle stops or when the
+orbit (the median particle position) leaves an element aperture (field 2, cm).
+Particles are not cut at the apertures one by one: the thin-lens optics has
+no fringe fields, RF focusing or space charge, so its beam sizes are not the
+ones a deck is matched for. OUTPAR.TXT
+lists the particles left after every element, scaled to the INPUT count. The
+time steps come from the START / restart cards; `save N` writes SAVECO<N>
+and `restart ... N` continues from it, so the checkpoint logic can be
+exercised too. The same deck always gives the same tables.
+
+Usage:
+    python parmela_sim.py rr6.inp
+    PARMELA=$PWD/parmela_sim.py python error_ana_pal_v2.py rr6.inp error.yaml
+    ln -s $PWD/parmela_sim.py ~/bin/parmela      # for drivers that call 'parmela'
+
+Environment:
+    PARMELA_SIM_TIME       minimum wall seconds per run, to mimic real runtimes (default 0)
+    PARMELA_SIM_PARTICLES  macro particles (default 1000)
+    PARMELA_SIM_FAIL       probability that a run fails with exit code 1 (default 0)
+'''
+import os
+import sys
+import time
+import numpy as np
+from parmela_deck import Deck
+
+C = 299792458.0  # m/s
+ME = 0.51099895  # MeV
+GUN_ENERGY = 0.35  # MeV for a poisson amplitude of -1
+TRWAVE_PHASE = 90.0  # a trwave on crest has the phase of its coupler cell - 90
+HEADER_LINES = 84  # lines before the first data row, as in PARMELA's tables
+
+NAMES = ["T(deg)", "Z(cm)", "Xun(mm-mrad)", "Yun(mm-mrad)", "Zun(mm-mrad)", "Xn(mm-mrad)",
+         "Yn(mm-mrad)", "Zn(mm-mrad)", "Xrms(mm)", "Yrms(mm)", "Zrmz(mm)", "<kE>(MeV)", "Del-Erms",
+         "<X>(mm)", "<Xpn>(mrad)", "<Y>(mm)", "<Ypn>(mrad)", "<Z>(cm)", "<Zpn>(rad)", "EZref(MV/m)"]
+TITLES = ["T(deg)", "Z(cm)", "Xun", "Yun", "Zun", "Xn", "Yn", "Zn", "Xrms(mm)", "Yrms(mm)",
+          "Zrms(mm)", "kE(MeV)", "Del-kE(MeV)", "<X>(mm)", "<Xpn>(mrad)", "<Y>(mm)", "<Ypn>(mrad)",
+          "<Z>(cm)", "<Zpn>(mrad)", "Ezref(MV/m)"]
+TRACKED = ("drift", "solenoid", "cell", "trwave", "quad", "steerer", "bend")
+CONTROL = ("start", "restart", "save")
+
+SIM_TIME = float(os.environ.get("PARMELA_SIM_TIME", "0"))
+SIM_PARTICLES = int(os.environ.get("PARMELA_SIM_PARTICLES", "1000"))
+SIM_FAIL = float(os.environ.get("PARMELA_SIM_FAIL", "0"))
+
+
+def card_words(text):
+    # card fields without the trailing '!' or ';' comment
+    return text.split('!', 1)[0].split(';', 1)[0].split()
+
+
+def number(words, k, default=0.0):
+    try:
+        return float(words[k])
+    except (IndexError, ValueError):
+        return default
+
+
+# --- Deck ---
+
+class SimDeck:
+    """
+    The cards of a deck the model uses, in file order, up to an `end` card.
+
+    Attributes:
+        f0, w0 (float): RUN frequency (MHz) and initial energy (MeV).
+        particles (int): INPUT particle count (without the reference particle).
+        radius, half_phase (float): INPUT beam radius (cm) and half bunch length (deg).
+        elements (list): (kind, words) of the tracked elements and the poisson gun.
+        control (list): (kind, words) of the START / restart / save cards.
+        title (str): The line after TITLE.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.f0, self.w0 = 2856.0, 0.0
+        self.particles, self.radius, self.half_phase = 1000, 0.5, 10.0
+        self.elements, self.control = [], []
+        self.title = ""
+        lines = Deck(path).lines
+        for i, raw in enumerate(lines):
+            words = card_words(raw)
+            if not words:
+                continue
+            key = words[0].lower()
+            if key == "end":
+                break
+            if key == "run":
+                self.f0, self.w0 = number(words, 3, self.f0), number(words, 5, self.w0)
+            elif key == "input":
+                self.particles = int(number(words, 2, self.particles))
+                self.radius = number(words, 4, self.radius)
+                self.half_phase = number(words, 6, self.half_phase)
+            elif key == "title" and i + 1 < len(lines):
+                self.title = lines[i + 1].strip()
+            elif key in TRACKED or key == "poisson":
+                self.elements.append((key, words))
+            elif key in CONTROL:
+                self.control.append((key, words))
+
+    def schedule(self):
+        """
+        The time steps of the START / restart cards.
+
+        Returns:
+            tuple: (phi0 or None if the first run card is a restart, read save
+                index or None, [(dphi, nsteps, save index or None)]).
+        """
+        phi0 = reads = None
+        segments = []
+        first = True
+        for key, words in self.control:
+            if key == "start":
+                phi0 = number(words, 1)
+                segments.append([number(words, 2, 1.0), int(number(words, 3)), None])
+            elif key == "restart":
+                if first:
+                    reads = int(number(words, 6)) if len(words) > 6 else None
+                segments.append([number(words, 1, 1.0), int(number(words, 2)), None])
+            elif key == "save" and segments:
+                segments[-1][2] = int(number(words, 1))
+            first = False
+        if not segments:
+            phi0 = 0.0
+            segments.append([1.0, 10 ** 7, None])  # one step per degree to the end of the beamline
+        return phi0, reads, [tuple(s) for s in segments]
+
+
+# --- Beam ---
+
+def kinematics(w):
+    gamma = 1.0 + w / ME
+    bg = np.sqrt(np.maximum(gamma * gamma - 1.0, 1e-12))
+    return gamma, bg, bg / gamma
+
+
+class Beam:
+    """Macro-particle ensemble around a reference particle at phase t (deg of f0), z (cm), energy w (MeV)."""
+
+    def __init__(self, sim, n, seed=1):
+        rng = np.random.default_rng(seed)
+        r = sim.radius * 10.0 * np.sqrt(rng.random(n))  # uniform disk, mm
+        a = 2 * np.pi * rng.random(n)
+        self.x, self.y = r * np.cos(a), r * np.sin(a)
+        self.w = max(sim.w0, 1e-6)
+        _, bg, _ = kinematics(self.w)
+        self.xp = rng.normal(scale=0.5, size=n) / bg  # 0.5 mrad normalized thermal spread
+        self.yp = rng.normal(scale=0.5, size=n) / bg
+        self.ph = rng.uniform(-sim.half_phase, sim.half_phase, n)
+        self.dw = np.zeros(n)
+        self.t, self.z, self.f0 = 0.0, 0.0, sim.f0
+        self.n0 = n
+        self.clocks = np.zeros((0, 2))  # (frequency, RF clock) of the first cell at each frequency
+        self.rf_phase = 0.0  # phase of the current section's clock from its reference clock
+
+    def state(self):
+        return {k: getattr(self, k) for k in ("x", "xp", "y", "yp", "ph", "dw", "t", "z", "w", "n0",
+                                              "clocks", "rf_phase")}
+
+    def restore(self, state):
+        for k, v in state.items():
+            setattr(self, k, v if np.ndim(v) else v.item())
+
+    def keep(self, alive):
+        for k in ("x", "xp", "y", "yp", "ph", "dw"):
+            setattr(self, k, getattr(self, k)[alive])
+
+    def brho(self):
+        """Magnetic rigidity (T m) of the reference particle."""
+        _, bg, _ = kinematics(self.w)
+        return ME * bg / 299.792458
+
+    def start_section(self, freq):
+        """Sets rf_phase for a section at frequency freq (MHz) starting at the current phase."""
+        clock = self.t * freq / self.f0
+        first = self.clocks[self.clocks[:, 0] == freq]
+        if len(first):
+            self.rf_phase = (clock - first[0, 1]) % 360.0
+        else:
+            self.clocks = np.vstack([self.clocks, [freq, clock]])
+            self.rf_phase = 0.0
+
+    def drift(self, length):
+        _, _, beta = kinematics(self.w + self.dw)
+        _, _, beta_ref = kinematics(self.w)
+        self.x = self.x + self.xp * length * 1e-2
+        self.y = self.y + self.yp * length * 1e-2
+        k = 360.0 * self.f0 * 1e6 * length * 1e-2 / C
+        self.ph = self.ph + k * (1.0 / beta - 1.0 / beta_ref)
+        self.t += k / beta_ref
+        self.z += length
+
+    def lens(self, kx, ky):
+        """Thin lens, kx and ky in 1/m (positive focuses)."""
+        self.xp = self.xp - self.x * kx
+        self.yp = self.yp - self.y * ky
+
+    def accelerate(self, gain, phase, freq):
+        """
+        Energy gain, gain (MeV) at crest; phase (deg) is the reference particle's
+        phase from crest, the particles are off by their phase at frequency freq (MHz).
+        """
+        w_ref = self.w + gain * np.cos(np.radians(phase))
+        w = self.w + self.dw + gain * np.cos(np.radians(phase + self.ph * freq / self.f0))
+        self.set_energy(w_ref, w)
+
+    def set_energy(self, w_ref, w):
+        """New reference and particle energies; the angles shrink with the reference momentum."""
+        if w_ref <= 0:
+            self.keep(np.zeros(len(self.x), dtype=bool))  # the reference particle stopped
+            return
+        _, bg0, _ = kinematics(self.w)
+        _, bg1, _ = kinematics(w_ref)
+        self.xp = self.xp * bg0 / bg1
+        self.yp = self.yp * bg0 / bg1
+        self.w, self.dw = w_ref, w - w_ref
+        self.keep(w > 0)
+
+    def aperture(self, radius):
+        """Loses the beam if its orbit is outside radius (cm)."""
+        if radius > 0 and len(self.x) and np.hypot(np.median(self.x), np.median(self.y)) > radius * 10.0:
+            self.keep(np.zeros(len(self.x), dtype=bool))
+
+    def moments(self, ez=0.0):
+        """The columns of one table row (see NAMES)."""
+        _, bg, beta = kinematics(self.w)
+        p = ME * kinematics(self.w + self.dw)[1]
+        dz = -self.ph / 360.0 * beta * C / (self.f0 * 1e6) * 1e3  # mm
+        dp = (p - ME * bg) / (ME * bg) * 1e3  # mrad
+
+        def emit(u, v):
+            c = np.cov(u, v)
+            return float(np.sqrt(max(c[0, 0] * c[1, 1] - c[0, 1] ** 2, 0.0)))
+
+        ex, ey, ez_ = emit(self.x, self.xp), emit(self.y, self.yp), emit(dz, dp)
+        return [self.t, self.z, ex, ey, ez_, ex * bg, ey * bg, ez_ * bg,
+                self.x.std(), self.y.std(), dz.std(), self.w + self.dw.mean(), self.dw.std(),
+                self.x.mean(), self.xp.mean() * bg, self.y.mean(), self.yp.mean() * bg,
+                self.z + dz.mean() / 10.0, dp.mean() * 1e-3 * bg, ez]
+
+
+def track(beam, kind, words):
+    """Tracks beam through one element; returns Ez of an RF element (MV/m), else 0."""
+    length = number(words, 1)
+    radius = number(words, 2)
+    if kind == "poisson":
+        gun = abs(number(words, 2)) * GUN_ENERGY
+        beam.set_energy(beam.w + gun, beam.w + beam.dw + gun)
+        return 0.0
+    ez = 0.0
+    beam.drift(length / 2)
+    lm = length * 1e-2
+    if kind == "solenoid":
+        k = (number(words, 4) * 1e-4 / (2 * beam.brho())) ** 2 * lm
+        beam.lens(k, k)
+    elif kind == "quad":
+        k = number(words, 4) * 1e-2 / beam.brho() * lm
+        beam.lens(k, -k)
+    elif kind == "steerer":
+        beam.xp = beam.xp + number(words, 4) * 1e-4 * lm / beam.brho() * 1e3
+        beam.yp = beam.yp + number(words, 5) * 1e-4 * lm / beam.brho() * 1e3
+    elif kind == "bend":
+        _, bg, _ = kinematics(beam.w)
+        delta = kinematics(beam.w + beam.dw)[1] / bg - 1.0
+        beam.xp = beam.xp - np.radians(number(words, 5)) * 1e3 * delta
+    elif kind in ("cell", "trwave"):
+        ez = number(words, 5)
+        freq = number(words, 9 if kind == "cell" else 8, beam.f0) or beam.f0
+        if kind == "cell" and number(words, 8) == -1:
+            beam.set_energy(beam.w + ez * lm, beam.w + beam.dw + ez * lm)  # field map, see the module docstring
+        else:
+            if kind == "cell":
+                beam.start_section(freq)
+            beam.accelerate(ez * lm, number(words, 4) + beam.rf_phase + TRWAVE_PHASE * (kind == "trwave"), freq)
+    beam.drift(length / 2)
+    beam.aperture(radius)
+    return ez
+
+
+# --- Outputs ---
+
+def header(sim, kind):
+    lines = [f" PARMELA stand-in (parmela_sim.py), linear model: {kind}",
+             f" Input file: {sim.path}", f" {sim.title}",
+             f" f0 = {sim.f0} MHz, W0 = {sim.w0} MeV, {sim.particles} particles"]
+    lines += [""] * (HEADER_LINES - len(lines) - len(TITLES) - 4)
+    lines += ["TITLES"] + TITLES + ["ENDTITLES", "DATA", "; " + " ".join(NAMES)]
+    return "\n".join(lines) + "\n"
+
+
+def write_table(path, sim, kind, rows):
+    with open(path, 'w') as f:
+        f.write(header(sim, kind))
+        if len(rows):
+            np.savetxt(f, rows, fmt='%14.6E')
+
+
+def write_outpar(path, sim, elements):
+    with open(path, 'w') as f:
+        f.write(" PARMELA stand-in (parmela_sim.py)\n")
+        f.write(f" Input file: {sim.path}\n {sim.title}\n\n")
+        f.write("   El   Particles       Z(cm)       W(MeV)  Type\n")
+        for n, (kind, count, z, w) in enumerate(elements, 1):
+            f.write(f"{n:5d} {count:11d} {z:11.4f} {w:12.6f}  {kind}\n")
+
+
+def timestep_rows(phi0, segments, bounds):
+    """Interpolates the element-boundary rows onto the time steps (T within the tracked range)."""
+    t, steps = phi0, [phi0]
+    for dphi, nsteps, _ in segments:
+        t_end = bounds[-1, 0]
+        n = min(nsteps, int((t_end - t) / dphi) + 1) if dphi > 0 else 0
+        steps.extend(t + dphi * np.arange(1, n + 1))
+        t += dphi * nsteps
+    steps = np.array([s for s in steps if bounds[0, 0] <= s <= bounds[-1, 0]])
+    rows = np.empty((len(steps), bounds.shape[1]))
+    for c in range(bounds.shape[1]):
+        rows[:, c] = np.interp(steps, bounds[:, 0], bounds[:, c])
+    return rows
+
+
+# --- Run ---
+
+def simulate(path, workdir='.'):
+    """
+    Runs the model on the deck at path and writes the output files into workdir.
+
+    Raises:
+        FileNotFoundError: If a restart card reads a SAVECO file that is not there.
+    """
+    sim = SimDeck(path)
+    phi0, reads, segments = sim.schedule()
+    beam = Beam(sim, SIM_PARTICLES)
+    first = 0
+    if reads is not None:
+        with np.load(os.path.join(workdir, f"SAVECO{reads}"), allow_pickle=False) as saved:
+            state = {k: saved[k] for k in saved.files}
+        first = int(state.pop("element")) + 1
+        phi0 = float(state.pop("phase"))
+        beam.restore(state)
+    else:
+        beam.t = phi0
+    # phases of the save cards, and the element boundary before each one once it is passed
+    saves, t = [], phi0
+    for dphi, nsteps, n in segments:
+        t += dphi * nsteps
+        if n is not None:
+            saves.append((t, n))
+    bounds = [beam.moments()]
+    outpar = []
+    last = (first - 1, beam.state())
+    for e in range(first, len(sim.elements)):
+        kind, words = sim.elements[e]
+        ez = track(beam, kind, words)
+        while saves and beam.t > saves[0][0]:
+            phase, n = saves.pop(0)
+            with open(os.path.join(workdir, f"SAVECO{n}"), 'wb') as f:
+                np.savez(f, element=last[0], phase=phase, **last[1])
+        if kind == "poisson":
+            continue
+        count = int(round(sim.particles * len(beam.x) / beam.n0)) + 1 if len(beam.x) else 0
+        outpar.append((kind, count, beam.z, beam.w))
+        if len(beam.x) < 2:
+            break  # the beam is lost
+        bounds.append(beam.moments(ez))
+        last = (e, beam.state())
+    bounds = np.array(bounds)
+    write_table(os.path.join(workdir, "EMITTANCE.TBL"), sim, "element ends", bounds[1:])
+    write_table(os.path.join(workdir, "TIMESTEPEMITTANCE.TBL"), sim, "time steps",
+                timestep_rows(phi0, segments, bounds))
+    write_outpar(os.path.join(workdir, "OUTPAR.TXT"), sim, outpar)
+
+
+def main(argv):
+    if len(argv) < 1:
+        print("Usage: parmela_sim.py <deck.inp>")
+        sys.exit(1)
+    t0 = time.perf_counter()
+    if SIM_FAIL > 0 and np.random.default_rng().random() < SIM_FAIL:
+        sys.stderr.write("parmela_sim: simulated failure (PARMELA_SIM_FAIL)\n")
+        sys.exit(1)
+    try:
+        simulate(argv[0])
+    except FileNotFoundError as e:
+        sys.stderr.write(f"parmela_sim: {e}\n")
+        sys.exit(1)
+    time.sleep(max(0.0, SIM_TIME - (time.perf_counter() - t0)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
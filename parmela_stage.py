@@ -0,0 +1,93 @@
+'''parmela tool, staging of run inputs from a shared content-addressed pool.
+
+Every parallel run needs the field maps (*.T7) of the deck next to it, and a
+deck like rr6.inp reads several large ones. Copying them into each run folder
+costs O(runs x map size) in time and disk. The maps are never written by
+PARMELA, so each one is put once into a pool keyed by its sha256 and every run
+folder gets a hardlink to the pooled file (a symlink where hardlinks are not
+possible, a copy as the last resort).
+
+SAVECO* files are still copied: a deck with `save` cards writes them again in
+its own folder, and a write through a hardlink would change the pooled file.
+
+Usage:
+    stage_inputs(folder)            # links *.T7, copies SAVECO*
+    ...write the perturbed deck into folder and run it...
+'''
+import os
+import glob
+import shutil
+from parmela_cache import file_digest
+
+POOL_DIR = os.environ.get("PARMELA_POOL_DIR", ".parmela_pool")
+LINK_PATTERNS = ("*.T7",)  # read-only inputs, linked from the pool
+COPY_PATTERNS = ("SAVECO*",)  # may be rewritten by the run, copied
+
+
+def pool_file(path, pool=POOL_DIR):
+    """
+    Puts a file into the pool unless an identical one is there already.
+
+    Returns:
+        str: Path of the pooled file.
+    """
+    digest = file_digest(path)
+    blob = os.path.join(pool, digest[:2], digest)
+    if not os.path.exists(blob):
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp = f"{blob}.{os.getpid()}.tmp"
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, blob)
+    return blob
+
+
+def link_file(src, dst):
+    """
+    Makes dst refer to src: a hardlink, else a symlink, else a copy.
+
+    Returns:
+        str: 'link', 'symlink' or 'copy'.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return "link"
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src), dst)
+        return "symlink"
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def stage_inputs(workdir, src_dir='.', link=LINK_PATTERNS, copy=COPY_PATTERNS, pool=None):
+    """
+    Stages the run inputs of src_dir into workdir.
+
+    Args:
+        workdir (str): The run folder (must exist).
+        src_dir (str): Where the inputs are.
+        link (tuple): Patterns of read-only inputs, linked from the pool.
+        copy (tuple): Patterns of inputs that are copied.
+        pool (str): Pool directory; default src_dir/.parmela_pool.
+
+    Returns:
+        dict: Staged file name -> 'link', 'symlink' or 'copy'.
+    """
+    if pool is None:
+        pool = os.path.join(src_dir, POOL_DIR)
+    staged = {}
+    for pattern in link:
+        for f in glob.glob(os.path.join(src_dir, pattern)):
+            name = os.path.basename(f)
+            staged[name] = link_file(pool_file(f, pool), os.path.join(workdir, name))
+    for pattern in copy:
+        for f in glob.glob(os.path.join(src_dir, pattern)):
+            name = os.path.basename(f)
+            shutil.copyfile(f, os.path.join(workdir, name))
+            staged[name] = "copy"
+    return staged
@@ -0,0 +1,319 @@
+'''parmela tool, append-only columnar store for error-study results.
+
+An error study runs the same deck with many random perturbations. Instead of
+keeping a folder with the full output table of every case, each finished case
+is appended to one HDF5 file and its folder can be removed:
+
+    /run              (N,)      int64    case number
+    /perturbation     (N, P)    float64  applied errors, names in attrs['names']
+    /final            (N, C)    float64  final row of TIMESTEPEMITTANCE.TBL,
+                                         names in attrs['names']
+    /orbit/offset     (N + 1,)  int64    rows of case k are data[offset[k]:offset[k+1]]
+    /orbit/data       (R, 3)    float64  decimated Z(cm), <X>(mm), <Y>(mm)
+    /plan             (runs, P) float64  errors drawn for every case before the
+                                         runs, row k-1 is case k; attrs 'names', 'seed'
+
+Every dataset is chunked and grows along its first axis, so appending a case
+costs the same for the 1st and the 1000th case, and the file holds only the
+numbers that are analysed afterwards.
+
+h5py is only needed when a store is opened.
+
+The orbits of all cases are also folded, as the cases finish, into an
+OrbitEnvelope: one preallocated (runs, points, 2) float32 array of <X>, <Y>
+on a common Z grid, with running mean, std, min and max per Z. It is saved
+as a .npy file (np.load(..., mmap_mode='r') reads it without loading it) and
+a small text table of the envelope.
+
+Usage:
+    with ResultStore('error_1a2b3c4d.h5') as store:
+        store.append(k, pert, final_row(tbl), decimate_orbit(tbl, 10))
+    finals = ResultStore('error_1a2b3c4d.h5', 'r').finals()
+
+    orbits = OrbitEnvelope(runs=1000, z_range=(0.0, Deck('rr6.inp').beamline_length()))
+    orbits.add(k, read_orbit(tbl))
+    orbits.save('orbit_1a2b3c4d.npy', 'orbit_envelope_1a2b3c4d.txt')
+'''
+import json
+import numpy as np
+import pandas as pd
+from parmela_table import read_table
+
+ORBIT_COLUMNS = ('Z(cm)', '<X>(mm)', '<Y>(mm)')
+CHUNK_ROWS = 256
+ORBIT_POINTS = 2000
+
+
+def read_orbit(tbl_path):
+    """
+    Reads the orbit columns of a table.
+
+    Returns:
+        numpy.ndarray: (rows, 3) array of Z(cm), <X>(mm), <Y>(mm).
+    """
+    table = read_table(tbl_path, list(ORBIT_COLUMNS))
+    return np.column_stack([table[c] for c in ORBIT_COLUMNS])
+
+
+def thin_orbit(orbit, every=10):
+    """Keeps every `every`-th row of an orbit, plus the last one."""
+    if every > 1 and len(orbit) > 1:
+        keep = np.arange(0, len(orbit), every)
+        if keep[-1] != len(orbit) - 1:
+            keep = np.append(keep, len(orbit) - 1)
+        orbit = orbit[keep]
+    return orbit
+
+
+def decimate_orbit(tbl_path, every=10):
+    """
+    Reads the orbit columns of a table and keeps every `every`-th row, plus
+    the last one.
+
+    Returns:
+        numpy.ndarray: (rows, 3) array of Z(cm), <X>(mm), <Y>(mm).
+    """
+    return thin_orbit(read_orbit(tbl_path), every)
+
+
+class ResultStore:
+    """
+    One HDF5 file of error-study cases.
+
+    Args:
+        path (str): The store file.
+        mode (str): h5py file mode; 'a' creates or appends, 'r' reads.
+        attrs (dict): Values stored as file attributes when the file is
+            created (e.g. run_id, the error parameters).
+    """
+
+    def __init__(self, path, mode='a', attrs=None):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("The results store needs h5py (pip install h5py)")
+        self.path = path
+        self.file = h5py.File(path, mode)
+        if attrs and mode != 'r':
+            for k, v in attrs.items():
+                if k not in self.file.attrs:
+                    self.file.attrs[k] = v if isinstance(v, (str, int, float)) else json.dumps(v)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return len(self.file["run"]) if "run" in self.file else 0
+
+    # --- Writing ---
+
+    def _grow(self, name, values, names=None, dtype=np.float64):
+        values = np.asarray(values, dtype=dtype)
+        if name not in self.file:
+            shape = (0,) + values.shape[1:]
+            ds = self.file.create_dataset(name, shape=shape, maxshape=(None,) + values.shape[1:],
+                                          dtype=dtype, chunks=(CHUNK_ROWS,) + values.shape[1:])
+            if names is not None:
+                ds.attrs["names"] = json.dumps(list(names))
+        ds = self.file[name]
+        if names is not None and json.loads(ds.attrs["names"]) != list(names):
+            raise ValueError(f"Columns of {name} changed: {list(names)}")
+        n = ds.shape[0]
+        ds.resize(n + len(values), axis=0)
+        ds[n:] = values
+
+    def append(self, run, perturbation, final, orbit=None):
+        """
+        Appends one finished case.
+
+        Args:
+            run (int): Case number.
+            perturbation (dict): Error name -> applied value.
+            final (dict): Final-row column name -> value (see parmela_table.final_row).
+            orbit (numpy.ndarray): Optional (rows, 3) orbit, see decimate_orbit().
+        """
+        self._grow("run", [run], dtype=np.int64)
+        self._grow("perturbation", [list(perturbation.values())], names=perturbation.keys())
+        self._grow("final", [list(final.values())], names=final.keys())
+        if "orbit/offset" not in self.file:
+            self._grow("orbit/offset", [0], dtype=np.int64)
+        rows = np.empty((0, len(ORBIT_COLUMNS))) if orbit is None else orbit
+        self._grow("orbit/data", rows)
+        self._grow("orbit/offset", [self.file["orbit/offset"][-1] + len(rows)], dtype=np.int64)
+        self.file.flush()
+
+    def put_plan(self, names, matrix, seed):
+        """
+        Stores the error matrix drawn for the whole study, unless the store
+        already has one (a resumed study draws the same matrix again).
+        """
+        if "plan" in self.file:
+            return
+        ds = self.file.create_dataset("plan", data=np.asarray(matrix, dtype=np.float64))
+        ds.attrs["names"] = json.dumps(list(names))
+        ds.attrs["seed"] = str(seed)  # SeedSequence entropy may not fit in 64 bits
+        self.file.flush()
+
+    # --- Reading ---
+
+    def runs(self):
+        return self.file["run"][:] if "run" in self.file else np.empty(0, dtype=np.int64)
+
+    def _frame(self, name):
+        if name not in self.file:
+            return pd.DataFrame()
+        ds = self.file[name]
+        df = pd.DataFrame(ds[:], columns=json.loads(ds.attrs["names"]))
+        df.index = pd.Index(self.runs(), name="run")
+        return df
+
+    def perturbations(self):
+        """The applied errors, one row per case."""
+        return self._frame("perturbation")
+
+    def finals(self):
+        """The final-row beam parameters, one row per case."""
+        return self._frame("final")
+
+    def plan(self):
+        """The drawn errors of every case, finished or not, indexed by case number."""
+        if "plan" not in self.file:
+            return pd.DataFrame()
+        ds = self.file["plan"]
+        return pd.DataFrame(ds[:], columns=json.loads(ds.attrs["names"]),
+                            index=pd.RangeIndex(1, ds.shape[0] + 1, name="run"))
+
+    def orbit(self, k):
+        """The stored orbit of the k-th appended case as a (rows, 3) array."""
+        offset = self.file["orbit/offset"]
+        return self.file["orbit/data"][offset[k]:offset[k + 1]]
+
+    def orbits(self):
+        """Yields (run, orbit) for every case that has a stored orbit."""
+        if "orbit/offset" not in self.file:
+            return
+        offset = self.file["orbit/offset"][:]
+        data = self.file["orbit/data"]
+        for k, run in enumerate(self.runs()):
+            if offset[k + 1] > offset[k]:
+                yield run, data[offset[k]:offset[k + 1]]
+
+
+class OrbitEnvelope:
+    """
+    Orbits of an error study on a common Z grid, folded in case by case.
+
+    <X> and <Y> of each case are interpolated onto a uniform Z grid and
+    written to row k-1 of a preallocated (runs, points, 2) float32 array;
+    points a case does not reach (e.g. past where its beam was lost) are NaN
+    and left out of the statistics. Mean and std (Welford), min and max are
+    updated per Z with every case, so the memory does not grow with the
+    cases and nothing is re-read at the end.
+
+    The grid is fixed up front: `points` points over z_range, normally 0 to
+    the beamline length of the deck (parmela_deck.Deck.beamline_length). A
+    case that reaches past it is clipped to it.
+
+    Args:
+        runs (int): Cases of the study; case k goes to row k-1.
+        z_range (tuple): (first, last) Z (cm) of the grid.
+        points (int): Grid points over z_range.
+
+    Raises:
+        ValueError: If z_range is empty.
+    """
+
+    def __init__(self, runs, z_range, points=ORBIT_POINTS):
+        lo, hi = (float(v) for v in z_range)
+        if not hi > lo:
+            raise ValueError(f"Empty orbit Z range {lo} to {hi} cm")
+        self.runs = int(runs)
+        self.points = max(2, int(points))
+        self.z = np.linspace(lo, hi, self.points)
+        self.data = np.full((self.runs, self.points, 2), np.nan, dtype=np.float32)
+        self.filled = np.zeros(self.runs, dtype=bool)
+        self.count = np.zeros((self.points, 2), dtype=np.int64)
+        self.mean = np.zeros((self.points, 2))
+        self._m2 = np.zeros((self.points, 2))
+        self.min = np.full((self.points, 2), np.nan)
+        self.max = np.full((self.points, 2), np.nan)
+
+    def __len__(self):
+        return int(self.filled.sum())
+
+    def add(self, run, orbit):
+        """
+        Folds in the orbit of case run; a case already added is ignored.
+
+        Args:
+            run (int): Case number, 1 to runs.
+            orbit (numpy.ndarray): (rows, 3) Z(cm), <X>(mm), <Y>(mm), see read_orbit().
+        """
+        orbit = np.asarray(orbit, dtype=float)
+        if len(orbit) == 0:
+            return
+        if not 1 <= run <= self.runs:
+            raise ValueError(f"Case {run} outside 1..{self.runs}")
+        if self.filled[run - 1]:
+            return
+        # timesteps may repeat a Z (e.g. while the beam leaves the cathode): keep the first
+        z, first = np.unique(orbit[:, 0], return_index=True)
+        values = np.column_stack([np.interp(self.z, z, orbit[first, c], left=np.nan, right=np.nan)
+                                  for c in (1, 2)])
+        self.data[run - 1] = values
+        self.filled[run - 1] = True
+        ok = ~np.isnan(values)
+        self.count += ok
+        delta = np.where(ok, values - self.mean, 0.0)
+        self.mean += np.divide(delta, self.count, out=np.zeros_like(delta), where=ok)
+        self._m2 += delta * np.where(ok, values - self.mean, 0.0)
+        self.min = np.fmin(self.min, values)
+        self.max = np.fmax(self.max, values)
+
+    @property
+    def std(self):
+        """Sample standard deviation per Z, (points, 2); NaN where fewer than two cases."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self._m2 / (self.count - 1)), np.nan)
+
+    def envelope(self):
+        """
+        Returns:
+            pandas.DataFrame: Z(cm), the case count and mean, std, min, max of
+                <X>(mm) and <Y>(mm) per grid point.
+        """
+        table = {"Z(cm)": self.z}
+        std = self.std
+        for c, name in enumerate(("<X>(mm)", "<Y>(mm)")):
+            table[f"n{name[1]}"] = self.count[:, c]
+            mean = np.where(self.count[:, c] > 0, self.mean[:, c], np.nan)
+            for stat, values in (("mean", mean), ("std", std[:, c]),
+                                 ("min", self.min[:, c]), ("max", self.max[:, c])):
+                table[f"{name}_{stat}"] = values
+        return pd.DataFrame(table)
+
+    def save(self, array_path, envelope_path):
+        """
+        Writes the (runs, points, 2) array to array_path (.npy) and the
+        envelope() table, whose first column is the Z grid, to envelope_path.
+        """
+        np.save(array_path, self.data)
+        self.envelope().to_csv(envelope_path, sep='\t', index=False, float_format='%.6e')
+
+
+def load_orbits(array_path, envelope_path):
+    """
+    Reads an OrbitEnvelope.save()d study.
+
+    Returns:
+        tuple: (z, data, envelope): the Z grid, the (runs, points, 2) array
+            (memory-mapped) and the envelope table.
+    """
+    envelope = pd.read_csv(envelope_path, sep='\t')
+    return envelope["Z(cm)"].to_numpy(), np.load(array_path, mmap_mode='r'), envelope
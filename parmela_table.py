@@ -0,0 +1,243 @@
+'''parmela tool, columnar reader for PARMELA output tables.
+
+TIMESTEPEMITTANCE.TBL and EMITTANCE.TBL share one layout: a header of about
+84 lines with the column titles between TITLES and ENDTITLES, a DATA line, a
+'; <names>' line, then one whitespace-separated row per output step. The
+header is parsed once per file into a TableSchema; the rows are handed to
+numpy's C parser (np.loadtxt) as one block, restricted to the requested
+columns, and come back as float64 arrays.
+
+Columns are looked up by name. The titles and the names of the '; ' line
+differ slightly ('kE(MeV)' vs '<kE>(MeV)', 'Xn' vs 'Xn(mm-mrad)'); either
+spelling is accepted.
+
+Usage:
+    t = read_table('TIMESTEPEMITTANCE.TBL', ['Z(cm)', '<X>(mm)'])
+    plt.plot(t['Z(cm)'], t['<X>(mm)'])
+    last = read_table('TIMESTEPEMITTANCE.TBL', last=3, mmap=True)
+'''
+import io
+import os
+import mmap as _mmap
+import numpy as np
+import pandas as pd
+
+TIMESTEP_TBL = "TIMESTEPEMITTANCE.TBL"
+EMITTANCE_TBL = "EMITTANCE.TBL"
+
+# The same quantity under the spellings of the TITLES block and of the data header line
+ALIASES = {
+    "del-ke(mev)": "del-erms",
+    "zrms(mm)": "zrmz(mm)",
+}
+
+_ROW_START = b"0123456789+-."
+_schemas = {}
+
+
+def _canonical(name):
+    key = name.replace('<', '').replace('>', '').lower()
+    return ALIASES.get(key, key)
+
+
+class TableSchema:
+    """
+    Column layout of one table file.
+
+    Attributes:
+        names (list): Column names of the '; ' line after DATA (the titles
+            if the file has no such line).
+        titles (list): Column titles of the TITLES block.
+        data_offset (int): Byte offset of the first data row.
+    """
+
+    def __init__(self, names, titles, data_offset):
+        self.names = names
+        self.titles = titles
+        self.data_offset = data_offset
+
+    def index(self, name):
+        """
+        Column index of name, given in either spelling, or with the unit
+        left out ('Xn' for 'Xn(mm-mrad)').
+
+        Raises:
+            KeyError: If no column matches.
+        """
+        for names in (self.names, self.titles):
+            if name in names:
+                return names.index(name)
+        key = _canonical(name)
+        for names in (self.names, self.titles):
+            for k, n in enumerate(names):
+                c = _canonical(n)
+                if c == key or c.split('(')[0] == key:
+                    return k
+        raise KeyError(f"No column {name!r}; columns are {self.names}")
+
+    def __repr__(self):
+        return f"TableSchema({len(self.names)} columns, data at byte {self.data_offset})"
+
+
+def read_schema(path):
+    """
+    Parses the header of a table, memoized on (path, mtime, size).
+
+    Raises:
+        ValueError: If the file has no DATA line.
+    """
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    schema = _schemas.get(memo_key)
+    if schema is not None:
+        return schema
+    titles = []
+    in_titles = False
+    with open(path, 'rb') as f:
+        for raw in iter(f.readline, b''):
+            clean = raw.strip().decode('latin-1')
+            if clean == "TITLES":
+                in_titles = True
+            elif clean == "ENDTITLES":
+                in_titles = False
+            elif in_titles:
+                titles.append(clean)
+            elif clean == "DATA":
+                break
+        else:
+            raise ValueError(f"No DATA block in {path}")
+        offset = f.tell()
+        header = f.readline().decode('latin-1').strip()
+        if header.startswith(';'):
+            names = header.lstrip(';').split()
+            offset = f.tell()
+        else:
+            names = list(titles)
+    schema = TableSchema(names, titles, offset)
+    _schemas[memo_key] = schema
+    return schema
+
+
+def _is_row(line):
+    line = line.strip()
+    return bool(line) and line[:1] in _ROW_START
+
+
+def _line_start(buf, lo, end):
+    # start of the last line of buf[lo:end], a trailing newline not counted
+    stop = end - 1 if end > lo and buf[end - 1:end] == b'\n' else end
+    nl = buf.rfind(b'\n', lo, stop)
+    return lo if nl < 0 else nl + 1
+
+
+def _bounds(buf, lo, last=None):
+    """
+    Byte range of the data rows in buf[lo:]: trailing lines that are not
+    rows are dropped, and with last only the final last rows are kept.
+
+    Returns:
+        tuple: (start, end, complete); complete is False if buf ran out
+            before last rows were found.
+    """
+    end = len(buf)
+    while end > lo:
+        start = _line_start(buf, lo, end)
+        if _is_row(buf[start:end]):
+            break
+        end = start
+    if last is None:
+        return lo, end, True
+    start = end
+    for _ in range(last):
+        if start <= lo:
+            return lo, end, False
+        start = _line_start(buf, lo, start)
+    return start, end, True
+
+
+def _data_bytes(path, schema, last, use_mmap):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= schema.data_offset:
+            return b''
+        if use_mmap:
+            with _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ) as mm:
+                start, end, _ = _bounds(mm, schema.data_offset, last)
+                return mm[start:end]
+        if last is None:
+            f.seek(schema.data_offset)
+            buf = f.read()
+            _, end, _ = _bounds(buf, 0)
+            return buf[:end]
+        # read backwards in growing blocks until the last rows are in the block
+        block = 512 * (last + 2)
+        while True:
+            first = max(schema.data_offset, size - block)
+            f.seek(first)
+            buf = f.read(size - first)
+            start, end, complete = _bounds(buf, 0, last)
+            # a row starting at the block edge may be cut off
+            if (complete and start > 0) or first == schema.data_offset:
+                return buf[start:end]
+            block *= 4
+
+
+def read_table(path, columns=None, last=None, mmap=False):
+    """
+    Reads the data rows of a TIMESTEPEMITTANCE/EMITTANCE table.
+
+    Args:
+        path (str): The table file.
+        columns (list): Column names to read (see TableSchema.index); all
+            columns if None.
+        last (int): Read only the final last rows. Only the end of the file
+            is read.
+        mmap (bool): Memory-map the file instead of reading it; with last
+            only the pages holding the final rows are touched.
+
+    Returns:
+        dict: Column name (as requested, or as in the data header) -> float64
+            array, in column order.
+    """
+    schema = read_schema(path)
+    if columns is None:
+        columns = list(schema.names)
+    usecols = [schema.index(c) for c in columns]
+    data = _data_bytes(path, schema, last, mmap)
+    if not data.strip():
+        return {c: np.empty(0) for c in columns}
+    rows = np.loadtxt(io.StringIO(data.decode('latin-1')), dtype=np.float64,
+                      comments=';', usecols=usecols, ndmin=2)
+    return {c: rows[:, k] for k, c in enumerate(columns)}
+
+
+def read_frame(path, columns=None, last=None, mmap=False, titles=False):
+    """
+    read_table() as a pandas DataFrame. With titles=True the columns are
+    named after the TITLES block instead of the data header line.
+    """
+    table = read_table(path, columns, last, mmap)
+    df = pd.DataFrame(table)
+    if titles:
+        schema = read_schema(path)
+        if len(schema.titles) == len(schema.names):
+            df.columns = [schema.titles[schema.index(c)] for c in df.columns]
+    return df
+
+
+def final_row(path, columns=None):
+    """
+    Named fields of the last data row of a table. Only the end of the file
+    is read, so the cost does not grow with the number of rows.
+
+    Args:
+        path (str): The table file.
+        columns (list): Column names to decode; all columns if None.
+
+    Returns:
+        dict: Column name -> float, or None if the table has no rows.
+    """
+    table = read_table(path, columns, last=1)
+    if not table or len(next(iter(table.values()))) == 0:
+        return None
+    return {c: float(v[-1]) for c, v in table.items()}
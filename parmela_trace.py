@@ -0,0 +1,219 @@
+'''parmela tool, per-run trace of every PARMELA invocation.
+
+Every run_parmela() / run_parmela_async() call appends one JSON object per
+line to the trace file, so the cost of a study can be read off afterwards:
+
+    time        start of the run (epoch seconds)
+    host, pid   where the driver ran
+    deck, hash  the deck name and the first 16 hex digits of its sha256
+    workdir     the folder the run was started in
+    wall        wall-clock seconds
+    cpu         user + system CPU seconds of parmela
+    maxrss_mb   peak resident memory of parmela in MB
+    usage       'wait4' (exact, of this one child) or 'children' (the
+                asyncio runner: CPU of every child that exited while it ran,
+                peak RSS of any child so far; exact when runs do not overlap)
+    returncode, status ('ok', 'failed' or 'timeout')
+    outputs     {file name: bytes} of the files the run wrote
+    ...         the tags of the driver, e.g. section, iteration, job
+
+The trace is PARMELA_TRACE (default parmela_trace.jsonl in the directory the
+driver was started from); an empty PARMELA_TRACE turns it off. Tags are set
+with `with tags(...)`; they are context variables, so asyncio tasks inherit
+them, and a thread pool gets them with contextvars.copy_context().run.
+
+Usage:
+    with tags(section=3, iteration=2):
+        run_parmela(workdir, 'rr6_temp.inp')
+    python parmela_trace.py summary [parmela_trace.jsonl] [--top n] [--by key]
+'''
+import os
+import sys
+import json
+import socket
+import contextlib
+import contextvars
+import pandas as pd
+from parmela_cache import file_digest
+
+TRACE_FILE = os.environ.get("PARMELA_TRACE", "parmela_trace.jsonl")
+TRACE_FILE = os.path.abspath(TRACE_FILE) if TRACE_FILE else None
+SUMMARY_KEYS = ("deck", "section")
+
+_tags = contextvars.ContextVar("parmela_trace_tags", default={})
+_host = socket.gethostname()
+
+
+@contextlib.contextmanager
+def tags(**values):
+    """Adds values (e.g. section=3, iteration=2) to the records of the runs started inside."""
+    token = _tags.set({**_tags.get(), **values})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def current_tags():
+    return dict(_tags.get())
+
+
+def call_with_tags(values, fn, *args):
+    """fn(*args) with tags(**values); picklable, for process pools (parmela_queue)."""
+    with tags(**values):
+        return fn(*args)
+
+
+def maxrss_mb(usage):
+    # ru_maxrss is in kB on Linux, in bytes on macOS
+    return usage.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+def deck_hash(path):
+    try:
+        return file_digest(path)[:16]
+    except OSError:
+        return None
+
+
+def record_run(result, start, usage=None, cpu=None, rss=None, status=None):
+    """
+    Appends the record of a finished run to the trace.
+
+    Args:
+        result (parmela_runner.RunResult): The run.
+        start (float): time.time() at its start.
+        usage (resource.struct_rusage): os.wait4 usage of the parmela
+            process; or cpu / rss (seconds / MB) measured otherwise.
+        status (str): 'timeout' for a killed run; default from the exit code.
+
+    Returns:
+        dict: The record, or None if tracing is off.
+    """
+    if TRACE_FILE is None:
+        return None
+    if usage is not None:
+        cpu, rss = usage.ru_utime + usage.ru_stime, maxrss_mb(usage)
+    rec = {
+        "time": round(start, 3), "host": _host, "pid": os.getpid(),
+        "deck": result.deck, "hash": deck_hash(os.path.join(result.workdir, result.deck)),
+        "workdir": os.path.abspath(result.workdir), "wall": round(result.wall, 4),
+        "cpu": None if cpu is None else round(cpu, 4),
+        "maxrss_mb": None if rss is None else round(rss, 2),
+        "usage": "wait4" if usage is not None else ("children" if cpu is not None else None),
+        "returncode": result.returncode,
+        "status": status or ("ok" if result.ok else "failed"),
+        "outputs": {os.path.basename(p): os.path.getsize(p) for p in result.outputs if os.path.exists(p)},
+    }
+    rec.update(current_tags())
+    # one write of one line on an O_APPEND file, so parallel runs do not interleave
+    line = (json.dumps(rec, default=str) + "\n").encode()
+    try:
+        fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Warning: cannot write the run trace {TRACE_FILE}: {e}")
+    return rec
+
+
+def load_trace(path=TRACE_FILE):
+    """Returns the records of a trace as a DataFrame, one row per run."""
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # a line cut off by a crash
+    return pd.DataFrame(records)
+
+
+def peak_concurrency(trace):
+    """Most runs that were going on at the same time, from their start times and wall times."""
+    events = sorted([(t, 1) for t in trace["time"]] + [(t + w, -1) for t, w in zip(trace["time"], trace["wall"])],
+                    key=lambda e: (e[0], e[1]))
+    running = peak = 0
+    for _, step in events:
+        running += step
+        peak = max(peak, running)
+    return peak
+
+
+def group_summary(trace, key):
+    """
+    Runs, wall (total, mean, max), mean CPU and peak RSS per value of key,
+    slowest (highest mean wall) first.
+    """
+    trace = trace[trace[key].notna()] if key in trace else trace.iloc[:0]
+    if trace.empty:
+        return None
+    values = trace[key]
+    if values.dtype.kind == 'f' and (values == values.round()).all():
+        trace = trace.assign(**{key: values.astype(int)})  # made float by the runs without the tag
+    table = trace.groupby(key).agg(runs=("wall", "size"), failed=("status", lambda s: int((s != "ok").sum())),
+                                   wall_total=("wall", "sum"), wall_mean=("wall", "mean"),
+                                   wall_max=("wall", "max"), cpu_mean=("cpu", "mean"),
+                                   maxrss_mb=("maxrss_mb", "max"))
+    return table.sort_values("wall_mean", ascending=False)
+
+
+def summary(path=TRACE_FILE, top=10, keys=SUMMARY_KEYS):
+    """Prints the totals of a trace and its slowest decks and sections (or other tags)."""
+    trace = load_trace(path)
+    if trace.empty:
+        print(f"{path}: no runs")
+        return
+    for column in ("cpu", "maxrss_mb"):
+        trace[column] = pd.to_numeric(trace.get(column), errors="coerce")
+    wall, cpu = trace["wall"].sum(), trace["cpu"].sum()
+    cpu_wall = trace.loc[trace["cpu"].notna(), "wall"].sum()
+    span = (trace["time"] + trace["wall"]).max() - trace["time"].min()
+    counts = trace["status"].value_counts()
+    print(f"{path}: {len(trace)} runs on {trace['host'].nunique()} host(s), "
+          + ", ".join(f"{n} {status}" for status, n in counts.items()))
+    print(f"wall {wall:.1f} s in total, {trace['wall'].mean():.2f} s mean, {trace['wall'].max():.2f} s max; "
+          f"{span:.1f} s from the first start to the last end")
+    print(f"cpu {cpu:.1f} s ({cpu / cpu_wall if cpu_wall else 0:.2f} of wall); peak RSS {trace['maxrss_mb'].max():.1f} MB; "
+          f"up to {peak_concurrency(trace)} runs at the same time")
+    with pd.option_context("display.width", 200, "display.float_format", "{:.2f}".format):
+        for key in keys:
+            table = group_summary(trace, key)
+            if table is not None:
+                print(f"\nslowest by {key}:")
+                print(table.head(top).to_string())
+
+
+def print_usage_and_exit():
+    print("Usage: python parmela_trace.py summary [trace.jsonl] [--top n] [--by key ...]")
+    print("  default trace: PARMELA_TRACE or parmela_trace.jsonl; default keys: deck section")
+    sys.exit(1)
+
+
+def main(argv):
+    if not argv or argv[0] != "summary":
+        print_usage_and_exit()
+    argv = argv[1:]
+    top, keys = 10, []
+    try:
+        while "--top" in argv:
+            i = argv.index("--top")
+            top = int(argv[i + 1])
+            del argv[i:i + 2]
+        while "--by" in argv:
+            i = argv.index("--by")
+            keys.append(argv[i + 1])
+            del argv[i:i + 2]
+    except (IndexError, ValueError):
+        print_usage_and_exit()
+    path = argv[0] if argv else TRACE_FILE or "parmela_trace.jsonl"
+    if not os.path.exists(path):
+        print(f"Error: no trace {path}")
+        sys.exit(1)
+    summary(path, top, keys or SUMMARY_KEYS)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
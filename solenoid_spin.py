@@ -9,6 +9,7 @@ import numpy as np
 from scipy import interpolate
 from scipy.integrate import quad
 import matplotlib.pyplot as plt
+from parmela_table import read_table
 
 
 def readfile():
@@ -32,15 +33,9 @@ def readfile():
     z_end=z_magnet[-1]
    
     
-    with open("../TIMESTEPEMITTANCE.dat") as t:
-        tfile=[line.split() for line in t]
-    t.close()
-    t_usef=tfile[84:]
-    t_headname=[elem for elem in t_usef[0]][1:]
-    t_usef[0]=t_headname
-    col_t={t_usef[0][i]:[line[i] for line in t_usef[1:]] for i in range(len(t_usef[0]))}
-    z_beam=np.array([float(i) for i in col_t['Z(cm)']])
-    energy_beam=np.array([float(i) for i in col_t['<kE>(MeV)']])
+    beam=read_table("../TIMESTEPEMITTANCE.dat",['Z(cm)','<kE>(MeV)'])
+    z_beam=beam['Z(cm)']
+    energy_beam=beam['<kE>(MeV)']
     gamma_beam=(energy_beam+0.511)/0.511
     p_beam=energy_beam*1000*((gamma_beam+1)/(gamma_beam-1))**0.5  #momentum of the beam in unit keV/c
     beam_pvsz=interpolate.interp1d(z_beam,p_beam)